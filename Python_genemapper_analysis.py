@@ -1,12 +1,807 @@
 import pandas as pd
 import numpy as np
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
+import functools
+import io
+import logging
 import os
 
+from openpyxl import Workbook
+
+from genemapper_bins import discover_bins
+from genemapper_cache import cached_read
+from genemapper_matrix import CODE_EMPTY, ClassificationMatrix, encode_classification
+from genemapper_qc import PeakQC
+from genemapper_readers import (PEAKS_COLUMNS, compact_peaks, excel_engine, find_peaks_export, iter_peaks_export,
+                                read_peaks_export)
+from genemapper_registry import SampleRegistry, sample_order_source
+from genemapper_report import RunReport, logger, profile_path_from_env, profiled, report_path_from_env, stage_context
+from genemapper_writer import write_matrix_workbook
+
+
+# Classification letters assigned by the A/B columns of the size ranges file
+CLASS_FROM_A = "c"
+CLASS_FROM_B = "b"
+
+# Columns of the size ranges file
+SIZE_RANGES_COLUMNS = ["A", "B", "Lower", "Upper"]
+
+# Peaks must be strictly higher than this to be called (default of height_threshold)
+HEIGHT_THRESHOLD = 160
+
+# Stages reported to progress callbacks, in pipeline order
+PIPELINE_STAGES = ("load", "rename", "filter", "classify", "matrix", "fill", "render", "done")
+
+
+class SizeRangeIndex:
+    """
+    Interval lookup engine over the rows of a size ranges table.
+
+    The Lower/Upper bounds of all ranges are sorted once into breakpoints. A size then
+    falls either exactly on a breakpoint or in the open gap between two breakpoints, so
+    every peak is mapped to one of these elementary cells with a single
+    ``np.searchsorted`` call. Each range covers a contiguous run of cells, which lets the
+    index precompute, per cell, the ranges that contain it and the classification of
+    the last classifying range (matching the original loop, where later rows overwrite
+    earlier ones).
+
+    Sizes stored as float32 (see ``genemapper_readers``) are compared with bounds
+    rounded to float32, so that a size equal to a bound in the export still matches it.
+
+    Args:
+        size_ranges (pd.DataFrame): Table with the columns A, B, Lower and Upper
+        dtype (np.dtype): Precision of the bounds (default: float64)
+    """
+
+    def __init__(self, size_ranges, dtype=np.float64):
+        lower = pd.to_numeric(size_ranges['Lower'], errors='coerce').to_numpy(dtype=float)
+        upper = pd.to_numeric(size_ranges['Upper'], errors='coerce').to_numpy(dtype=float)
+        # Bounds are rounded to the precision of the sizes they are compared with
+        lower = lower.astype(dtype).astype(float)
+        upper = upper.astype(dtype).astype(float)
+        self.size_ranges = size_ranges
+        self.dtype = np.dtype(dtype)
+        self._float32_index = None
+        # Ranges with missing or inverted bounds can never match a size
+        valid = ~np.isnan(lower) & ~np.isnan(upper) & (lower <= upper)
+        range_ids = np.flatnonzero(valid)
+
+        self.n_ranges = len(size_ranges)
+        self.points = np.unique(np.concatenate([lower[valid], upper[valid]]))
+        n_cells = 2 * len(self.points) + 1
+
+        # Cell 2k+1 is breakpoint k, cell 2k is the gap just below breakpoint k
+        start = 2 * np.searchsorted(self.points, lower[valid]) + 1
+        stop = 2 * np.searchsorted(self.points, upper[valid]) + 1
+        widths = stop - start + 1
+
+        # Expand every range into the cells it covers, then group them by cell while
+        # keeping the ranges of each cell in file order
+        pair_range = np.repeat(range_ids, widths)
+        pair_cell = (np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+                     + np.repeat(start, widths))
+        order = np.lexsort((pair_range, pair_cell))
+        self.cell_ranges = pair_range[order]
+        self.cell_ptr = np.concatenate([[0], np.cumsum(np.bincount(pair_cell, minlength=n_cells))])
+
+        # Classification of each range row: A only -> "c", B only -> "b", otherwise none
+        a_nonzero = (size_ranges['A'] != 0).to_numpy()
+        b_nonzero = (size_ranges['B'] != 0).to_numpy()
+        b_zero = (size_ranges['B'] == 0).to_numpy()
+        a_zero = (size_ranges['A'] == 0).to_numpy()
+        self.range_class = np.full(self.n_ranges, np.nan, dtype=object)
+        self.range_class[a_nonzero & b_zero] = CLASS_FROM_A
+        self.range_class[b_nonzero & a_zero] = CLASS_FROM_B
+
+        # Last classifying range covering each cell (-1 when there is none)
+        classifying = pd.notna(self.range_class[pair_range])
+        self.cell_last = np.full(n_cells, -1, dtype=np.int64)
+        np.maximum.at(self.cell_last, pair_cell[classifying], pair_range[classifying])
+
+    def for_sizes(self, sizes):
+        """
+        Return the index matching the precision of some sizes.
+
+        Args:
+            sizes (np.ndarray): Peak sizes
+
+        Returns:
+            SizeRangeIndex: self, or a float32 twin built once for float32 sizes
+        """
+        if sizes.dtype != np.float32 or self.dtype == np.float32:
+            return self
+        if self._float32_index is None:
+            self._float32_index = SizeRangeIndex(self.size_ranges, dtype=np.float32)
+        return self._float32_index
+
+    def cells(self, sizes):
+        """
+        Map sizes to elementary cells of the index.
+
+        Args:
+            sizes (array-like): Peak sizes (NaN never matches a range), in the index precision
+
+        Returns:
+            np.ndarray: Cell number of every size
+        """
+        sizes = np.asarray(sizes, dtype=float)
+        idx = np.searchsorted(self.points, sizes, side='left')
+        on_point = np.zeros(len(sizes), dtype=bool)
+        inside = idx < len(self.points)
+        on_point[inside] = self.points[idx[inside]] == sizes[inside]
+        return 2 * idx + on_point
+
+    def classify(self, sizes):
+        """
+        Classify sizes in a single vectorized pass.
+
+        Args:
+            sizes (array-like): Peak sizes
+
+        Returns:
+            tuple: (in_range, classification) where ``in_range`` flags sizes inside at
+            least one range and ``classification`` holds "c", "b" or NaN per size
+        """
+        sizes = np.asarray(sizes)
+        index = self.for_sizes(sizes)
+        cells = index.cells(sizes)
+        in_range = index.cell_ptr[cells + 1] > index.cell_ptr[cells]
+        last = index.cell_last[cells]
+        classification = np.full(len(cells), np.nan, dtype=object)
+        classification[last >= 0] = index.range_class[last[last >= 0]]
+        return in_range, classification
+
+    def pairs(self, sizes):
+        """
+        List every (size, range) match, including matches of overlapping ranges.
+
+        Args:
+            sizes (array-like): Peak sizes
+
+        Returns:
+            tuple: (positions, range_ids) arrays; positions index into ``sizes`` and are
+            in ascending order, range ids follow file order for each position
+        """
+        sizes = np.asarray(sizes)
+        index = self.for_sizes(sizes)
+        cells = index.cells(sizes)
+        first = index.cell_ptr[cells]
+        counts = index.cell_ptr[cells + 1] - first
+        positions = np.repeat(np.arange(len(cells)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return positions, index.cell_ranges[np.repeat(first, counts) + offsets]
+
+
+def _sample_numbers_by_row(names, df_sample_order):
+    """
+    Look the sample number of every peak up once per distinct sample name.
+
+    Returns:
+        np.ndarray or None: Sample number per row (NaN when unknown), or None when the
+        lookup would differ from a merge (repeated names, or missing names on both sides)
+    """
+    default_names = df_sample_order['Default_name']
+    keyed = df_sample_order[default_names.notna()]
+    if not keyed['Default_name'].is_unique or (default_names.isna().any() and names.isna().any()):
+        return None
+    if not isinstance(names.dtype, pd.CategoricalDtype):
+        names = names.astype('category')
+    lookup = pd.Series(keyed['Sample_number'].to_numpy(), index=keyed['Default_name'].to_numpy())
+    per_category = lookup.reindex(names.cat.categories).to_numpy()
+    # Code -1 (missing name) is not in the index and gives NaN
+    numbers = pd.Series(per_category).reindex(names.cat.codes.to_numpy()).to_numpy()
+    if pd.api.types.is_integer_dtype(df_sample_order['Sample_number']) and not pd.isna(numbers).any():
+        numbers = numbers.astype(df_sample_order['Sample_number'].dtype)
+    return numbers
+
+
+def rename_samples(df_exported_table, df_sample_order, unmapped=None):
+    """
+    Replace sample file names by sample numbers.
+
+    Names missing from the sample order keep their file name. Sample names are looked up
+    once per distinct name (the names are categorical) rather than merged row by row,
+    unless the sample order repeats a name, where the merge gives one row per match.
+
+    Args:
+        df_exported_table (pd.DataFrame): Peaks with (de-spaced) Sample File Name
+        df_sample_order (pd.DataFrame): Sample order with Default_name and Sample_number
+        unmapped (set): Receives the sample names missing from the sample order (optional)
+
+    Returns:
+        pd.DataFrame: Peaks with renamed Sample File Name
+    """
+    numbers = _sample_numbers_by_row(df_exported_table['Sample File Name'], df_sample_order)
+    if numbers is not None:
+        df_exported_table = df_exported_table.reset_index(drop=True)
+        numbers = pd.Series(numbers, index=df_exported_table.index)
+    else:
+        df_exported_table = df_exported_table.merge(
+            df_sample_order[['Default_name', 'Sample_number']],
+            left_on='Sample File Name',
+            right_on='Default_name',
+            how='left'
+        )
+        numbers = df_exported_table.pop('Sample_number')
+        df_exported_table = df_exported_table.drop('Default_name', axis=1)
+    names = df_exported_table['Sample File Name']
+    if unmapped is not None:
+        unmapped.update(pd.unique(names[numbers.isna() & names.notna()].astype(object)))
+    df_exported_table['Sample File Name'] = numbers.fillna(names)
+    return df_exported_table
+
+
+def filter_peaks(df_exported_table, height_threshold=HEIGHT_THRESHOLD):
+    """
+    Keep the peaks higher than the height threshold.
+
+    Args:
+        df_exported_table (pd.DataFrame): Renamed peaks
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+
+    Returns:
+        pd.DataFrame: Height-filtered peaks
+    """
+    return df_exported_table[df_exported_table['Height'] > height_threshold]
+
+
+def classify_peaks(height_filtered, range_index):
+    """
+    Keep the peaks that fall in a size range and classify them.
+
+    Args:
+        height_filtered (pd.DataFrame): Height-filtered peaks
+        range_index (SizeRangeIndex): Index over the size ranges
+
+    Returns:
+        pd.DataFrame: Filtered peaks with a Classification column ("c", "b" or NaN)
+    """
+    # Classify every peak against the size ranges in one pass; the last matching
+    # classifying range wins, exactly as when looping over the ranges in order
+    size_mask, classification = range_index.classify(height_filtered['Size'])
+    df_filtered = height_filtered[size_mask].copy()
+    df_filtered['Classification'] = classification[size_mask]
+    return df_filtered
+
+
+def last_per_cell(cells, n_cells, return_counts=False):
+    """
+    Find the last occurrence of every distinct cell.
+
+    Hits are scattered into a dense array of their positions, one slot per cell, unless
+    they are few compared with the cells, where sorting them is cheaper.
+
+    Args:
+        cells (np.ndarray): Flat cell index (range * samples + column) of every hit
+        n_cells (int): Number of cells
+        return_counts (bool): Also count the hits of every cell (default: False)
+
+    Returns:
+        np.ndarray or tuple: Positions in ``cells`` of the last hit of every cell, in cell
+        order, and with ``return_counts`` the number of hits of these cells
+    """
+    if len(cells) * 8 < n_cells:
+        if return_counts:
+            _, first_reversed, counts = np.unique(cells[::-1], return_index=True, return_counts=True)
+            return len(cells) - 1 - first_reversed, counts
+        _, first_reversed = np.unique(cells[::-1], return_index=True)
+        return len(cells) - 1 - first_reversed
+    dtype = np.int32 if len(cells) < np.iinfo(np.int32).max else np.int64
+    order = np.arange(len(cells), dtype=dtype)
+    latest = np.full(n_cells, -1, dtype=dtype)
+    latest[cells] = order
+    # NumPy does not define which of repeated indices is assigned last: assign the hits
+    # later than the one kept again until every cell holds its last hit (every pass
+    # only raises the positions kept)
+    later = np.flatnonzero(latest[cells] < order)
+    while len(later):
+        latest[cells[later]] = order[later]
+        later = later[latest[cells[later]] < order[later]]
+    hit = latest >= 0
+    if return_counts:
+        # This path is only taken with at least one hit per 8 cells, so the per-cell count
+        # costs no more than the scatter
+        return latest[hit], np.bincount(cells, minlength=n_cells)[hit]
+    return latest[hit]
+
+
+def peak_hits(df_filtered, sample_numbers, range_index, qc=None):
+    """
+    List the matrix cells set by classified peaks.
+
+    Every (peak, range) match is looked up at once through the size range index and
+    only the last peak of each (range, sample) pair is kept, which reproduces the
+    cell-by-cell assignment of the original loop. Peaks whose sample is not one of
+    ``sample_numbers`` are dropped.
+
+    Args:
+        df_filtered (pd.DataFrame): Classified peaks with Sample File Name, Size and Classification
+        sample_numbers (list): Sample numbers labelling the matrix columns
+        range_index (SizeRangeIndex): Index over the size ranges
+        qc (PeakQC): Counts the hits of every cell set, duplicates included (optional)
+
+    Returns:
+        tuple: (range_ids, columns, codes) arrays of the cells set, one entry per cell,
+        sorted by range and column
+    """
+    # All (peak, range) matches, in peak order
+    positions, range_ids = range_index.pairs(df_filtered['Size'])
+    columns = pd.Index(sample_numbers).get_indexer(df_filtered['Sample File Name'])[positions]
+    codes = encode_classification(df_filtered['Classification'])[positions]
+
+    # Unknown samples are skipped
+    known = columns >= 0
+    range_ids, columns, codes = range_ids[known], columns[known], codes[known]
+
+    # The last peak of each (range, sample) pair wins
+    n_samples = max(len(sample_numbers), 1)
+    cells = range_ids.astype(np.int64) * n_samples + columns
+    if qc is None:
+        last = last_per_cell(cells, range_index.n_ranges * n_samples)
+    else:
+        last, counts = last_per_cell(cells, range_index.n_ranges * n_samples, return_counts=True)
+        qc.count_hits(cells[last], counts)
+    return range_ids[last], columns[last], codes[last]
+
+
+def scatter_peaks(codes, df_filtered, sample_numbers, range_index, qc=None):
+    """
+    Write the classification of peaks into a code matrix, in place.
+
+    The cells are those of ``peak_hits``. Calling this on consecutive chunks of peaks
+    gives the same matrix as calling it once on all of them.
+
+    Args:
+        codes (np.ndarray): int8 matrix of shape (ranges, samples)
+        df_filtered (pd.DataFrame): Classified peaks with Sample File Name, Size and Classification
+        sample_numbers (list): Sample numbers labelling the matrix columns
+        range_index (SizeRangeIndex): Index over the size ranges
+        qc (PeakQC): Collects the QC counts of the hits (optional)
+
+    Returns:
+        np.ndarray: ``codes``
+    """
+    range_ids, columns, hit_codes = peak_hits(df_filtered, sample_numbers, range_index, qc)
+    codes[range_ids, columns] = hit_codes
+    return codes
+
+
+def build_code_matrix(df_filtered, size_ranges, sample_numbers, range_index=None, qc=None):
+    """
+    Build the size range x sample matrix of classification codes.
+
+    Args:
+        df_filtered (pd.DataFrame): Classified peaks with Sample File Name, Size and Classification
+        size_ranges (pd.DataFrame): Size ranges table (one matrix row per range)
+        sample_numbers (list): Sample numbers used as matrix columns, in output order
+        range_index (SizeRangeIndex): Prebuilt index over ``size_ranges`` (optional)
+        qc (PeakQC): Collects the QC counts of the hits (optional)
+
+    Returns:
+        np.ndarray: int8 array of shape (ranges, samples)
+    """
+    if range_index is None:
+        range_index = SizeRangeIndex(size_ranges)
+    codes = np.full((len(size_ranges), len(sample_numbers)), CODE_EMPTY, dtype=np.int8)
+    return scatter_peaks(codes, df_filtered, sample_numbers, range_index, qc)
+
+
+def build_classification_matrix(df_filtered, size_ranges, sample_numbers, emx_mey_label, range_index=None,
+                                qc=None):
+    """
+    Build the size range x sample classification matrix.
+
+    Args:
+        df_filtered (pd.DataFrame): Classified peaks with Sample File Name, Size and Classification
+        size_ranges (pd.DataFrame): Size ranges table (one matrix row per range)
+        sample_numbers (list): Sample numbers used as matrix columns, in output order
+        emx_mey_label (str): Label of the EMX_MEY rows
+        range_index (SizeRangeIndex): Prebuilt index over ``size_ranges`` (optional)
+        qc (PeakQC): Collects the QC counts of the hits (optional)
+
+    Returns:
+        ClassificationMatrix: Matrix of codes, not yet filled
+    """
+    codes = build_code_matrix(df_filtered, size_ranges, sample_numbers, range_index=range_index, qc=qc)
+    return ClassificationMatrix(codes, emx_mey_label, size_range_labels(size_ranges), sample_numbers)
+
+
+def excel_ready(df):
+    """
+    Return a frame whose float32 columns are widened for writing to Excel.
+
+    float32 values are converted through their shortest decimal representation, so
+    that a size read as 351.2 is written as 351.2 and not 351.20001220703125.
+
+    Args:
+        df (pd.DataFrame): Frame to write
+
+    Returns:
+        pd.DataFrame: Shallow copy with float32 columns as float64
+    """
+    float32_columns = [column for column, dtype in df.dtypes.items() if dtype == np.float32]
+    return df.assign(**{column: df[column].astype(str).astype(float) for column in float32_columns})
+
+
+def size_range_labels(size_ranges):
+    """Return the "Lower - Upper" label of every size range."""
+    return size_ranges['Lower'].astype(str) + " - " + size_ranges['Upper'].astype(str)
 
-def gene_mapper_analysis(input_file_path, config_file_path, output_file_path, X=4, Y=8):
+
+def build_matrix_streaming(chunks, df_sample_order, size_ranges, sample_numbers, emx_mey_label,
+                           range_index=None, on_renamed=None, unmapped=None, height_threshold=HEIGHT_THRESHOLD,
+                           qc=None):
+    """
+    Build the classification matrix from chunks of peaks, with bounded memory.
+
+    Each chunk is renamed, height-filtered and classified on its own and folded into
+    the matrix, so memory use depends on the matrix size and the chunk size, not on
+    the size of the export. The result equals the one of the in-memory pipeline.
+
+    Args:
+        chunks (iterable): Cleaned peaks DataFrames, in file order (see ``iter_peaks_export``)
+        df_sample_order (pd.DataFrame): Sample order with Default_name and Sample_number
+        size_ranges (pd.DataFrame): Size ranges table (one matrix row per range)
+        sample_numbers (list): Sample numbers used as matrix columns, in output order
+        emx_mey_label (str): Label of the EMX_MEY rows
+        range_index (SizeRangeIndex): Prebuilt index over ``size_ranges`` (optional)
+        on_renamed (callable): Called with every renamed chunk, e.g. to write it out (optional)
+        unmapped (set): Receives the sample names missing from the sample order (optional)
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+        qc (PeakQC): Collects the QC counts of every chunk (optional)
+
+    Returns:
+        ClassificationMatrix: Matrix of codes, not yet filled
+    """
+    if range_index is None:
+        range_index = SizeRangeIndex(size_ranges)
+    codes = np.full((len(size_ranges), len(sample_numbers)), CODE_EMPTY, dtype=np.int8)
+    for chunk in chunks:
+        chunk = rename_samples(chunk, df_sample_order, unmapped)
+        if on_renamed is not None:
+            on_renamed(chunk)
+        height_filtered = filter_peaks(chunk, height_threshold)
+        df_filtered = classify_peaks(height_filtered, range_index)
+        if qc is not None:
+            qc.count_peaks("peaks", chunk)
+            qc.count_peaks("above_threshold", height_filtered)
+            qc.count_peaks("in_range", df_filtered)
+        scatter_peaks(codes, df_filtered, sample_numbers, range_index, qc)
+    return ClassificationMatrix(codes, emx_mey_label, size_range_labels(size_ranges), sample_numbers)
+
+
+class _RenamedTableWriter:
+    """Stream renamed peak chunks to a write-only workbook."""
+
+    def __init__(self, output):
+        self.output = output
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet("Sheet1")
+        self.header_written = False
+
+    def __call__(self, chunk):
+        if not self.header_written:
+            self.ws.append(chunk.columns.tolist())
+            self.header_written = True
+        chunk = excel_ready(chunk)
+        for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False):
+            self.ws.append(list(row))
+
+    def save(self):
+        self.wb.save(self.output)
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def _read_workbook(path):
+    return pd.read_excel(path, engine=excel_engine())
+
+
+def load_peaks_export(source, columns=PEAKS_COLUMNS):
+    """
+    Load a GeneMapper peaks export (.txt/.tsv/.csv/.xlsx).
+
+    Only the Sample File Name, Size and Height columns are read unless ``columns`` asks
+    for more. Column names are
+    stripped, spaces are removed from the sample file names (categorical), Size is
+    numeric float32 and Height a compact integer. Paths go through the parsed-input
+    cache.
+
+    Args:
+        source (str, file-like or pd.DataFrame): Path of the {EMX_MEY}_peaks_exported file,
+            an open/uploaded file (typed by its name) or an already read table
+        columns (list): Columns to read (default: PEAKS_COLUMNS; None reads every column,
+            e.g. for the renamed table written by ``run_pipeline``)
+
+    Returns:
+        pd.DataFrame: Cleaned peaks table
+    """
+    if isinstance(source, pd.DataFrame):
+        return compact_peaks(source.copy())
+    if _is_path(source):
+        return cached_read(source, functools.partial(read_peaks_export, columns=columns), "peaks",
+                           options={"columns": columns})
+    return read_peaks_export(source, columns=columns)
+
+
+def load_sample_order(source):
+    """
+    Load the sample order workbook (Default_name -> Sample_number).
+
+    Args:
+        source (str, file-like, pd.DataFrame or SampleRegistry): Hyssop_sample_numbers_Genemapper.xlsx
+            as a path (read through the cache), a file object, a table or its registry
+
+    Returns:
+        pd.DataFrame: Sample order table
+    """
+    if isinstance(source, pd.DataFrame):
+        return source
+    if isinstance(source, SampleRegistry):
+        return source.sample_order()
+    if _is_path(source):
+        return cached_read(source, _read_workbook, "sample_order")
+    return _read_workbook(source)
+
+
+def load_size_ranges(source):
+    """
+    Load a size ranges workbook (A, B, Lower, Upper).
+
+    Args:
+        source (str, file-like, pd.DataFrame or None): Size_ranges_{EMX_MEY}.xlsx as a path
+            (read through the cache), a file object or a table; None gives an empty table
+
+    Returns:
+        pd.DataFrame: Size ranges table
+    """
+    if source is None:
+        return pd.DataFrame(columns=SIZE_RANGES_COLUMNS)
+    if isinstance(source, pd.DataFrame):
+        return source
+    if _is_path(source):
+        return cached_read(source, _read_workbook, "size_ranges")
+    return _read_workbook(source)
+
+
+def propose_size_ranges(peaks, chunksize=None, height_threshold=HEIGHT_THRESHOLD, **options):
+    """
+    Propose size ranges from the height-filtered peaks of all samples.
+
+    Args:
+        peaks (str, file-like or pd.DataFrame): Peaks export
+        chunksize (int): Read the export in chunks of this many rows, keeping only the
+            sizes and sample names of the filtered peaks (default: load it whole)
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+        **options: Clustering options of ``genemapper_bins.discover_bins``
+
+    Returns:
+        pd.DataFrame: Size ranges with blank A and B columns, and the Peaks and Samples
+        supporting every range
+    """
+    if chunksize and _is_path(peaks):
+        chunks = (filter_peaks(chunk, height_threshold)[['Sample File Name', 'Size']]
+                  for chunk in iter_peaks_export(peaks, chunksize))
+        df_filtered = pd.concat([chunk.astype({'Sample File Name': object}) for chunk in chunks], ignore_index=True)
+    else:
+        df_filtered = filter_peaks(load_peaks_export(peaks), height_threshold)
+    return discover_bins(df_filtered['Size'].to_numpy(), df_filtered['Sample File Name'].to_numpy(), **options)
+
+
+def auto_bins_enabled():
+    """Return False when automatic bin discovery is disabled through GENEMAPPER_AUTO_BINS=0."""
+    return os.environ.get("GENEMAPPER_AUTO_BINS", "").lower() not in ("0", "false", "no", "off")
+
+
+def render_workbook(matrix, output=None, extra_sheets=None):
+    """
+    Render a filled matrix as the colour-coded workbook.
+
+    Args:
+        matrix (ClassificationMatrix): Filled classification matrix
+        output (str or file-like): Destination (default: return the workbook as bytes)
+        extra_sheets (dict): Tables written after the matrix, as worksheet title ->
+            DataFrame (optional, e.g. ``PeakQC.tables``)
+
+    Returns:
+        bytes or None: The xlsx contents when ``output`` is None
+    """
+    if output is not None:
+        write_matrix_workbook(matrix, output, extra_sheets=extra_sheets)
+        return None
+    buffer = io.BytesIO()
+    write_matrix_workbook(matrix, buffer, extra_sheets=extra_sheets)
+    return buffer.getvalue()
+
+
+def report_progress(progress_callback, stage):
+    """
+    Report the start of a pipeline stage to a progress callback.
+
+    The callback is called as ``progress_callback(stage, fraction)``, where fraction is
+    the share of PIPELINE_STAGES already completed (1.0 for "done"). It may raise an
+    exception (e.g. to cancel a job), which aborts the pipeline.
+
+    Args:
+        progress_callback (callable or None): Callback to notify (None: do nothing)
+        stage (str): One of PIPELINE_STAGES
+    """
+    if progress_callback is not None:
+        progress_callback(stage, PIPELINE_STAGES.index(stage) / (len(PIPELINE_STAGES) - 1))
+
+
+class PipelineResult:
+    """
+    In-memory results of ``run_pipeline``.
+
+    Attributes:
+        emx_mey_label (str): EMX_MEY label of the panel
+        size_ranges (pd.DataFrame): Size ranges used
+        peaks (pd.DataFrame): Renamed peaks (None in streaming mode)
+        filtered (pd.DataFrame): Height-filtered, classified peaks (None in streaming mode)
+        matrix (ClassificationMatrix): Filled classification matrix
+        workbook (bytes): Colour-coded xlsx contents (None when not rendered)
+        unmapped (list): Sample names missing from the sample order, sorted
+        qc (PeakQC): QC counts of the run (None when not collected)
+    """
+
+    def __init__(self, emx_mey_label, size_ranges, peaks, filtered, matrix, workbook, unmapped=None, qc=None):
+        self.emx_mey_label = emx_mey_label
+        self.size_ranges = size_ranges
+        self.peaks = peaks
+        self.filtered = filtered
+        self.matrix = matrix
+        self.workbook = workbook
+        self.unmapped = unmapped or []
+        self.qc = qc
+
+
+def report_unmapped(emx_mey_label, unmapped, max_names=20):
+    """
+    Log the sample names missing from the sample order in one warning.
+
+    Args:
+        emx_mey_label (str): EMX_MEY label of the run
+        unmapped (iterable): Unmapped sample names
+        max_names (int): Number of names listed in the message (default: 20)
+
+    Returns:
+        list: The names, sorted
+    """
+    unmapped = sorted(unmapped, key=str)
+    if unmapped:
+        listed = ", ".join(map(str, unmapped[:max_names])) + (", ..." if len(unmapped) > max_names else "")
+        logger.warning("%s: %d sample names are missing from the sample order and keep their file name: %s",
+                       emx_mey_label, len(unmapped), listed)
+    return unmapped
+
+
+def _pipeline_stage(name, progress_callback, run_report):
+    """Report the start of a stage and return the context measuring it in ``run_report``."""
+    report_progress(progress_callback, name)
+    return stage_context(run_report, name)
+
+
+def run_pipeline(peaks, sample_order, size_ranges=None, X=4, Y=8, render=True, renamed_output=None,
+                 chunksize=None, progress_callback=None, run_report=None, height_threshold=HEIGHT_THRESHOLD,
+                 qc=True):
+    """
+    Run the analysis stages (load, rename, filter, classify, matrix, render) in memory.
+
+    Nothing is written to disk unless ``renamed_output`` is given.
+
+    Args:
+        peaks (str, file-like or pd.DataFrame): Peaks export
+        sample_order (str, file-like, pd.DataFrame or SampleRegistry): Sample order workbook
+        size_ranges (str, file-like, pd.DataFrame or None): Size ranges (None: no ranges)
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        render (bool): Render the colour-coded workbook to bytes (default: True)
+        renamed_output (str or file-like): Where to write the renamed peaks table (optional)
+        chunksize (int): Stream the peaks export in chunks of this many rows, keeping
+            memory proportional to the matrix (optional; ``peaks`` must not be a DataFrame)
+        progress_callback (callable): Called as ``progress_callback(stage, fraction)`` at
+            the start of every stage of PIPELINE_STAGES (optional, see ``report_progress``)
+        run_report (RunReport): Records the time, rows and memory of every stage (optional)
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+        qc (bool): Collect per-bin and per-sample QC counts while building the matrix; they
+            are added to the rendered workbook as QC sheets and to the run report
+            (default: True)
+
+    Returns:
+        PipelineResult: Intermediate and final results
+    """
+    emx_mey_label = f"EM{X}_ME{Y}"
+    unmapped = set()
+
+    with _pipeline_stage("load", progress_callback, run_report) as stage:
+        df_sample_order = load_sample_order(sample_order)
+        size_ranges = load_size_ranges(size_ranges)
+        range_index = SizeRangeIndex(size_ranges)
+        # Get unique sample numbers to use as column names
+        sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+        peak_qc = PeakQC(size_ranges, sample_numbers, range_index) if qc else None
+        # The renamed table keeps every column of the export; the analysis needs only PEAKS_COLUMNS
+        columns = None if renamed_output is not None else PEAKS_COLUMNS
+        if not chunksize:
+            df_exported_table = load_peaks_export(peaks, columns)
+            stage["rows"] = len(df_exported_table)
+
+    df_filtered = None
+    if chunksize:
+        # Stream the export: each chunk is renamed, filtered, classified and folded into the matrix
+        with _pipeline_stage("classify", progress_callback, run_report) as stage:
+            renamed_writer = _RenamedTableWriter(renamed_output) if renamed_output is not None else None
+            n_rows = [0]
+
+            def on_renamed(chunk):
+                n_rows[0] += len(chunk)
+                if renamed_writer is not None:
+                    renamed_writer(chunk)
+
+            matrix = build_matrix_streaming(iter_peaks_export(peaks, chunksize, columns), df_sample_order, size_ranges,
+                                            sample_numbers, emx_mey_label, range_index=range_index,
+                                            on_renamed=on_renamed, unmapped=unmapped,
+                                            height_threshold=height_threshold, qc=peak_qc)
+            if renamed_writer is not None:
+                renamed_writer.save()
+            stage["rows"] = n_rows[0]
+        df_exported_table = None
+    else:
+        # Rename the samples of the exported table
+        with _pipeline_stage("rename", progress_callback, run_report) as stage:
+            df_exported_table = rename_samples(df_exported_table, df_sample_order, unmapped)
+            stage["rows"] = len(df_exported_table)
+        if renamed_output is not None:
+            with stage_context(run_report, "write_renamed") as stage:
+                excel_ready(df_exported_table).to_excel(renamed_output, index=False)
+                stage["rows"] = len(df_exported_table)
+
+        # Keep the peaks higher than the threshold inside a size range and classify them
+        with _pipeline_stage("filter", progress_callback, run_report) as stage:
+            df_filtered = filter_peaks(df_exported_table, height_threshold)
+            stage["rows"] = len(df_filtered)
+        with _pipeline_stage("classify", progress_callback, run_report) as stage:
+            if peak_qc is not None:
+                peak_qc.count_peaks("peaks", df_exported_table)
+                peak_qc.count_peaks("above_threshold", df_filtered)
+            df_filtered = classify_peaks(df_filtered, range_index)
+            if peak_qc is not None:
+                peak_qc.count_peaks("in_range", df_filtered)
+            stage["rows"] = len(df_filtered)
+
+        # Build the sample x size range matrix
+        with _pipeline_stage("matrix", progress_callback, run_report) as stage:
+            matrix = build_classification_matrix(df_filtered, size_ranges, sample_numbers, emx_mey_label,
+                                                 range_index=range_index, qc=peak_qc)
+            stage["rows"] = matrix.shape[0]
+
+    # Fill empty cells based on row content: rows containing "c" get "a", otherwise
+    # rows containing "b" get "d"
+    with _pipeline_stage("fill", progress_callback, run_report) as stage:
+        matrix.fill_empty()
+        stage["rows"] = matrix.shape[0]
+
+    workbook = None
+    if render:
+        with _pipeline_stage("render", progress_callback, run_report) as stage:
+            workbook = render_workbook(matrix, extra_sheets=peak_qc.tables(matrix) if peak_qc is not None else None)
+            stage["rows"] = matrix.shape[0]
+    report_progress(progress_callback, "done")
+    unmapped = report_unmapped(emx_mey_label, unmapped)
+    if run_report is not None:
+        run_report.info.update({"ranges": matrix.shape[0], "samples": matrix.shape[1], "chunksize": chunksize,
+                                "height_threshold": height_threshold, "unmapped_samples": unmapped})
+        if peak_qc is not None:
+            run_report.info["qc"] = peak_qc.summary(matrix)
+    return PipelineResult(emx_mey_label, size_ranges, df_exported_table, df_filtered, matrix, workbook, unmapped,
+                          peak_qc)
+
+
+def gene_mapper_analysis(input_file_path, config_file_path, output_file_path, X=4, Y=8, df_sample_order=None,
+                         chunksize=None, write_intermediate=True, report_path=None, profile_path=None,
+                         height_threshold=HEIGHT_THRESHOLD, qc=True):
     """
     Analyze gene mapper data and create a formatted Excel output with conditional formatting.
     
@@ -16,6 +811,23 @@ def gene_mapper_analysis(input_file_path, config_file_path, output_file_path, X=
         output_file_path (str): Path to the output files directory
         X (int): X value for EMX_MEY format (default: 4)
         Y (int): Y value for EMX_MEY format (default: 8)
+        df_sample_order (pd.DataFrame or SampleRegistry): Already parsed
+            Hyssop_sample_numbers_Genemapper.xlsx, or its registry (optional, read from
+            input_file_path through the sample registry when not given)
+        chunksize (int): Stream the peaks export in chunks of this many rows, keeping
+            memory proportional to the matrix instead of the export (default: load it whole)
+        write_intermediate (bool): Write Exported_table_changed_sample_names_EM{X}_ME{Y}.xlsx
+            to config_file_path (default: True)
+        report_path (str): Write the JSON run report (time, rows and memory of every
+            stage) to this file or directory (default: $GENEMAPPER_REPORT, else no report)
+        profile_path (str): Profile the run with cProfile and dump the statistics to this
+            file (default: a file named after the panel and process in $GENEMAPPER_PROFILE,
+            see ``profile_path_from_env``, else no profiling)
+        height_threshold (float): Peaks must be strictly higher than this to be called
+            (default: 160)
+        qc (bool): Add the QC_summary, QC_bins and QC_samples sheets (peaks outside every
+            range, several peaks per cell, overlapping ranges, ranges matching no rule) to
+            the output workbook, and the QC summary to the run report (default: True)
     
     Returns:
         str: Path to the created output file
@@ -23,205 +835,57 @@ def gene_mapper_analysis(input_file_path, config_file_path, output_file_path, X=
     # User input for EMX_MEY format
     emx_mey_label = f"EM{X}_ME{Y}"
 
-    # Load exported table and sample order
-    df_exported_table = pd.read_excel(f"{input_file_path}/{emx_mey_label}_peaks_exported.xlsx")
-    # After reading the DataFrame:
-    df_exported_table.columns = df_exported_table.columns.str.strip()
-    df_exported_table["Size"] = pd.to_numeric(df_exported_table["Size"], errors="coerce")
-    # print(df_exported_table.columns)
-    df_sample_order = pd.read_excel(f"{input_file_path}/Hyssop_sample_numbers_Genemapper.xlsx")
+    if df_sample_order is None:
+        df_sample_order = sample_order_source(f"{input_file_path}/Hyssop_sample_numbers_Genemapper.xlsx")
+
+    peaks_path = find_peaks_export(input_file_path, emx_mey_label)
 
-    # Create and save empty size ranges file if needed
+    # Without a size ranges file, propose ranges from the peaks for curation (or save an
+    # empty template when bin discovery is disabled)
     size_ranges_path = f"{input_file_path}/Size_ranges_{emx_mey_label}.xlsx"
+    size_ranges = size_ranges_path
     if not pd.io.common.file_exists(size_ranges_path):
-        pd.DataFrame([["A", "B", "Lower", "Upper"]]).to_excel(size_ranges_path, header=False, index=False)
-
-    df_exported_table['Sample File Name'] = df_exported_table['Sample File Name'].str.replace(' ', '', regex=False)   
-
-    # Alternative approach using merge if you prefer:
-    df_exported_table = df_exported_table.merge(
-        df_sample_order[['Default_name', 'Sample_number']], 
-        left_on='Sample File Name', 
-        right_on='Default_name', 
-        how='left'
-    )
-    df_exported_table['Sample File Name'] = df_exported_table['Sample_number'].fillna(df_exported_table['Sample File Name'])
-    df_exported_table = df_exported_table.drop(['Default_name', 'Sample_number'], axis=1)
-
-    # Save the modified dataframe to Excel
-    df_exported_table.to_excel(f"{config_file_path}/Exported_table_changed_sample_names_{emx_mey_label}.xlsx", index=False)
-
-    # Step 1: Load the size ranges from Excel file
-    size_ranges = pd.read_excel(os.path.join(input_file_path, f"Size_ranges_{emx_mey_label}.xlsx"))
-
-    # Step 2: Create the filtered dataframe first (all rows that match ANY criteria)
-    # First filter by Height
-    height_filtered = df_exported_table[df_exported_table['Height'] > 160]
-
-    # Create a function to check if a size falls within any of the ranges
-    def size_in_any_range(size_value):
-        """Check if size falls within any of the defined ranges"""
-        return ((size_value >= size_ranges['Lower']) & (size_value <= size_ranges['Upper'])).any()
-
-    # Apply the size range filter
-    # Using apply with the function to check each Size value
-    size_mask = height_filtered['Size'].apply(size_in_any_range)
-    df_filtered = height_filtered[size_mask].copy()
+        if auto_bins_enabled():
+            size_ranges = propose_size_ranges(peaks_path, chunksize=chunksize, height_threshold=height_threshold)
+            size_ranges.to_excel(size_ranges_path, index=False)
+            logger.warning("%s: no size ranges file, %d proposed ranges written to %s; fill in their A/B "
+                           "columns", emx_mey_label, len(size_ranges), size_ranges_path)
+        else:
+            pd.DataFrame([SIZE_RANGES_COLUMNS]).to_excel(size_ranges_path, header=False, index=False)
+            size_ranges = None
+
+    renamed_output = None
+    if write_intermediate:
+        renamed_output = f"{config_file_path}/Exported_table_changed_sample_names_{emx_mey_label}.xlsx"
 
-    # Step 3: Add the classification column
-    df_filtered['Classification'] = np.nan  # Initialize with NaN values
-
-    # Step 4: Loop through each range and assign classifications
-    for i in range(len(size_ranges)):
-        lower_bound = size_ranges.iloc[i]['Lower']
-        upper_bound = size_ranges.iloc[i]['Upper']
-        a_value = size_ranges.iloc[i]['A']
-        b_value = size_ranges.iloc[i]['B']
-        
-        # Create condition for this range
-        in_range = (df_filtered['Size'] >= lower_bound) & (df_filtered['Size'] <= upper_bound)
-        
-        # Assign classification based on A/B columns
-        if a_value != 0 and b_value == 0:
-            # Size is in column A, assign "c"
-            df_filtered.loc[in_range, 'Classification'] = "c"
-        elif b_value != 0 and a_value == 0:
-            # Size is in column B, assign "b"
-            df_filtered.loc[in_range, 'Classification'] = "b"
-
-    # Create the new dataframe structure
-    # First, get unique sample numbers to use as column names
-    sample_numbers = df_sample_order['Sample_number'].unique().tolist()
-
-    # Create a dataframe with EMX_MEY column and size ranges as rows
-    df_matrix = pd.DataFrame({
-        'EMX_MEY': [emx_mey_label] * len(size_ranges),  # Add EMX_MEY column
-        'Size_Range': size_ranges['Lower'].astype(str) + " - " + size_ranges['Upper'].astype(str),
-        'Lower': size_ranges['Lower'],
-        'Upper': size_ranges['Upper']
-    })
-
-    # Add columns for each sample number, initialized with NaN
-    for sample in sample_numbers:
-        df_matrix[sample] = np.nan
-
-    # Fill in the matrix with classification values
-    for i in range(len(df_matrix)):
-        lower_bound = df_matrix.iloc[i]['Lower']
-        upper_bound = df_matrix.iloc[i]['Upper']
-        
-        # Find all filtered data that falls within this size range
-        range_data = df_filtered[
-            (df_filtered['Size'] >= lower_bound) & 
-            (df_filtered['Size'] <= upper_bound)
-        ]
-        
-        # For each sample in this size range, add the classification
-        for j in range(len(range_data)):
-            sample_name = range_data.iloc[j]['Sample File Name']
-            classification = range_data.iloc[j]['Classification']
-            
-            # Check if this sample_name exists as a column in our matrix
-            if sample_name in df_matrix.columns:
-                df_matrix.loc[i, sample_name] = classification
-
-    # Remove the helper columns (Lower, Upper) but keep EMX_MEY and Size_Range
-    df_matrix_final = df_matrix.drop(['Lower', 'Upper'], axis=1)
-
-    # Fill empty cells based on row content
-    for i in range(len(df_matrix_final)):
-        # Get all values in this row (excluding the EMX_MEY and Size_Range columns)
-        row_values = df_matrix_final.iloc[i, 2:]  # Exclude first two columns
-        
-        # Check if row contains "c" or "b"
-        has_c = (row_values == "c").any()
-        has_b = (row_values == "b").any()
-        
-        # Fill NaN values based on what's present in the row
-        if has_c:
-            # If row contains "c", fill empty cells with "a"
-            df_matrix_final.iloc[i, 2:] = df_matrix_final.iloc[i, 2:].fillna("a")
-        elif has_b:
-            # If row contains "b", fill empty cells with "d"
-            df_matrix_final.iloc[i, 2:] = df_matrix_final.iloc[i, 2:].fillna("d")
-
-    # View the result
-    print("Matrix created:")
-    print(df_matrix_final)
-
-    # Export to Excel with conditional formatting
-    print("\nCreating formatted Excel file...")
-
-    # Create a formatted version with empty columns every 5 data columns
-    df_formatted = df_matrix_final.copy()
-
-    # Get column names (excluding the first two columns: EMX_MEY and Size_Range)
-    data_columns = df_formatted.columns[2:].tolist()
-
-    # Create new column structure with empty columns every 5
-    new_columns = ["EMX_MEY", "Size_Range"]  # Start with EMX_MEY and Size_Range columns
-    for i, col in enumerate(data_columns):
-        new_columns.append(col)
-        # Add empty column every 5 data columns (but not after the last column)
-        if (i + 1) % 5 == 0 and i < len(data_columns) - 1:
-            new_columns.append("")
-
-    # Create the new formatted dataframe
-    df_formatted_final = pd.DataFrame(index=df_formatted.index, columns=new_columns)
-
-    # Copy EMX_MEY and Size_Range columns
-    df_formatted_final['EMX_MEY'] = df_formatted['EMX_MEY']
-    df_formatted_final['Size_Range'] = df_formatted['Size_Range']
-
-    # Copy data columns to their new positions
-    for col_name in data_columns:
-        df_formatted_final[col_name] = df_formatted[col_name]
-
-    # Create workbook using openpyxl
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Sample_Matrix"
-
-    # Write data to worksheet
-    for r in dataframe_to_rows(df_formatted_final, index=False, header=True):
-        ws.append(r)
-
-    # Define styles for each classification
-    style_c = PatternFill(start_color="00B0F0", end_color="00B0F0", fill_type="solid")  # Light blue
-    style_a = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")  # Red
-    style_b = PatternFill(start_color="00B050", end_color="00B050", fill_type="solid")  # Green
-    style_d = PatternFill(start_color="BFBFBF", end_color="BFBFBF", fill_type="solid")  # Grey
-
-    # Apply conditional formatting for each classification
-    # Get the data range (excluding headers)
-    for row_idx in range(2, len(df_formatted_final) + 2):  # Start from row 2 (after header)
-        for col_idx in range(1, len(df_formatted_final.columns) + 1):
-            # Skip EMX_MEY and Size_Range columns and empty columns
-            col_name = df_formatted_final.columns[col_idx - 1]
-            if col_name in ["EMX_MEY", "Size_Range"] or col_name == "":
-                continue
-            
-            # Get cell value
-            cell_value = df_formatted_final.iloc[row_idx - 2, col_idx - 1]
-            
-            if pd.notna(cell_value):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                if cell_value == "c":
-                    cell.fill = style_c
-                elif cell_value == "a":
-                    cell.fill = style_a
-                elif cell_value == "b":
-                    cell.fill = style_b
-                elif cell_value == "d":
-                    cell.fill = style_d
-
-    # Save the workbook with updated filename
     output_filename = os.path.join(output_file_path, f"Sample_Size_Matrix_Colored_{emx_mey_label}.xlsx")
+    run_report = RunReport(emx_mey_label)
+    report_path = report_path or report_path_from_env()
+    profile_path = profile_path or profile_path_from_env(output_file_path, emx_mey_label)
+
+    with profiled(profile_path):
+        result = run_pipeline(peaks_path, df_sample_order, size_ranges, X=X, Y=Y, render=False,
+                              renamed_output=renamed_output, chunksize=chunksize, run_report=run_report,
+                              height_threshold=height_threshold, qc=qc)
+
+        # The matrix is only formatted for the log when debug output is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Matrix created:\n%s", result.matrix.to_frame())
+
+        # Export to Excel with conditional formatting
+        logger.info("Creating formatted Excel file...")
+        with stage_context(run_report, "write") as stage:
+            render_workbook(result.matrix, output_filename,
+                            extra_sheets=result.qc.tables(result.matrix) if result.qc is not None else None)
+            stage["rows"] = result.matrix.shape[0]
+        logger.info("Excel file saved to: %s", output_filename)
+
+    if isinstance(df_sample_order, SampleRegistry):
+        df_sample_order.record_unmapped(emx_mey_label, result.unmapped)
+    run_report.info.update({"peaks_export": peaks_path, "output": output_filename, "profile": profile_path})
+    if report_path:
+        run_report.write(report_path)
 
-    # Save workbook
-    wb.save(output_filename)
-    print(f"Excel file saved to: {output_filename}")
-    
     return output_filename
 
 
@@ -231,6 +895,9 @@ if __name__ == "__main__":
     config_file_path = r"C:/Users/bilya/Desktop/bibicode/R_course/GeneMapper_analysis/Config files"
     output_file_path = r"C:/Users/bilya/Desktop/bibicode/R_course/GeneMapper_analysis/Output files"
     
+    # Show progress messages on the console
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Run the analysis
     result = gene_mapper_analysis(input_file_path, config_file_path, output_file_path, X=4, Y=8)
-    print(f"Analysis complete. Output saved to: {result}")
+    logger.info("Analysis complete. Output saved to: %s", result)
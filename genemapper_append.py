@@ -0,0 +1,321 @@
+"""
+Incremental append mode: add new sample plates to a persisted panel matrix.
+
+A MatrixStore keeps the filled classification matrix of one EMx_MEy panel on disk,
+with the a/d fill code of every row and the list of plates already added. Appending a
+plate renames, filters and classifies only the new peaks and writes their cells into
+the stored matrix; the a/d fill is recomputed only for the size ranges the new peaks
+touch, and the new sample columns of the other rows get the fill code already known
+for them. The result is the matrix a full run over the combined exports (earlier
+plates first) would produce.
+
+The "b" and "c" cells of a filled matrix are the cells set by peaks and its "a" and "d"
+cells are fill, so the filled matrix alone is enough to update it. The QC counts of the
+plates (see genemapper_qc.py) are kept in the store too, so the regenerated workbook has
+the QC sheets of the combined exports.
+
+Usage:
+    python genemapper_cli.py append INPUT_DIR NEW_PEAKS_FILE [--output DIR] [-X 4] [-Y 8]
+"""
+
+import datetime
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from Python_genemapper_analysis import (HEIGHT_THRESHOLD, SIZE_RANGES_COLUMNS, SizeRangeIndex, classify_peaks,
+                                        filter_peaks, load_peaks_export, load_sample_order, load_size_ranges,
+                                        peak_hits, rename_samples, render_workbook, report_unmapped,
+                                        size_range_labels)
+from genemapper_cache import file_digest
+from genemapper_matrix import CLASS_CODES, CODE_EMPTY, ClassificationMatrix, row_fill_codes
+from genemapper_qc import PeakQC
+from genemapper_registry import SampleRegistry, sample_order_source
+from genemapper_report import logger, stage_context
+
+
+SAMPLE_ORDER_FILE = "Hyssop_sample_numbers_Genemapper.xlsx"
+
+# Codes written by the a/d fill rather than by peaks
+FILL_CODES = (CLASS_CODES["a"], CLASS_CODES["d"])
+
+
+def size_ranges_digest(size_ranges):
+    """Return a digest identifying the contents of a size ranges table."""
+    table = size_ranges.reindex(columns=SIZE_RANGES_COLUMNS).to_csv(index=False)
+    return hashlib.sha256(table.encode("utf-8")).hexdigest()
+
+
+def default_store_path(output_file_path, emx_mey_label):
+    """Return the path of a panel's matrix store in the output directory."""
+    return os.path.join(output_file_path, f"matrix_store_{emx_mey_label}.npz")
+
+
+class MatrixStore:
+    """
+    Persisted filled classification matrix of one panel.
+
+    Args:
+        emx_mey_label (str): EMX_MEY label of the panel
+        size_ranges (pd.DataFrame): Size ranges the matrix rows follow
+        codes (np.ndarray): Filled int8 codes of shape (ranges, samples) (default: no samples)
+        samples (list): Sample numbers labelling the columns (default: none)
+        row_fill (np.ndarray): a/d fill code of every row (default: computed from ``codes``)
+        plates (list): Records of the plates already added (default: none)
+        ranges_digest (str): ``size_ranges_digest`` of the size ranges file the store was
+            created from (default: computed from ``size_ranges``)
+        height_threshold (float): Height threshold of every plate of the store (default: 160)
+        qc (PeakQC): QC counts of every plate of the store, over ``samples`` (default: none;
+            an empty store starts collecting them with its first plate)
+    """
+
+    def __init__(self, emx_mey_label, size_ranges, codes=None, samples=None, row_fill=None, plates=None,
+                 ranges_digest=None, height_threshold=HEIGHT_THRESHOLD, qc=None):
+        self.emx_mey_label = emx_mey_label
+        self.height_threshold = height_threshold
+        self.size_ranges = size_ranges
+        self.ranges_digest = ranges_digest or size_ranges_digest(size_ranges)
+        self.samples = list(samples or [])
+        if codes is None:
+            codes = np.full((len(size_ranges), len(self.samples)), CODE_EMPTY, dtype=np.int8)
+        self.codes = codes
+        self.row_fill = row_fill_codes(self._peak_codes(codes)) if row_fill is None else row_fill
+        self.plates = list(plates or [])
+        if qc is None and not self.plates:
+            qc = PeakQC(size_ranges, self.samples, SizeRangeIndex(size_ranges))
+        self.qc = qc
+
+    @staticmethod
+    def _peak_codes(codes):
+        """Return a copy of filled codes with the a/d fill removed."""
+        return np.where(np.isin(codes, FILL_CODES), CODE_EMPTY, codes).astype(np.int8)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a store written by ``save``.
+
+        Args:
+            path (str): Path of the .npz store
+
+        Returns:
+            MatrixStore: Stored panel
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            codes = data["codes"]
+            row_fill = data["row_fill"]
+            qc_cells = [data[key] for key in ("qc_ranges", "qc_columns", "qc_counts")] if "qc_counts" in data else None
+        size_ranges = pd.read_json(io.StringIO(meta["size_ranges"]), orient="split")
+        # Stores written without QC counts (older ones, or with a plate appended without them) have none
+        qc = None
+        if qc_cells is not None:
+            qc = PeakQC(size_ranges, meta["samples"], SizeRangeIndex(size_ranges))
+            qc.add_sample_counts({stage: pd.Series(dict(map(tuple, counts)), dtype=np.int64)
+                                  for stage, counts in meta["qc_sample_counts"].items()})
+            qc.add_cell_counts(*qc_cells, meta["samples"])
+        return cls(meta["emx_mey"], size_ranges, codes=codes, samples=meta["samples"], row_fill=row_fill,
+                   plates=meta["plates"], ranges_digest=meta["ranges_digest"],
+                   height_threshold=meta.get("height_threshold", HEIGHT_THRESHOLD), qc=qc)
+
+    def save(self, path):
+        """
+        Write the store atomically, so that a crash never leaves it half written.
+
+        Args:
+            path (str): Path of the .npz store
+        """
+        meta = {
+            "emx_mey": self.emx_mey_label,
+            "samples": self.samples,
+            "size_ranges": self.size_ranges.to_json(orient="split", index=False),
+            "ranges_digest": self.ranges_digest,
+            "height_threshold": self.height_threshold,
+            "plates": self.plates,
+        }
+        arrays = {}
+        if self.qc is not None:
+            # Sample names keep their types as [name, count] pairs
+            meta["qc_sample_counts"] = {stage: list(map(list, zip(counts.index.tolist(), counts.tolist())))
+                                        for stage, counts in self.qc.sample_counts.items()}
+            arrays = dict(zip(("qc_ranges", "qc_columns", "qc_counts"), self.qc.cell_hits))
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, codes=self.codes, row_fill=self.row_fill, meta=np.array(json.dumps(meta, default=str)),
+                 **arrays)
+        os.replace(tmp_path, path)
+
+    def matrix(self):
+        """
+        Return the stored matrix.
+
+        Returns:
+            ClassificationMatrix: Filled matrix sharing the store's codes
+        """
+        return ClassificationMatrix(self.codes, self.emx_mey_label, size_range_labels(self.size_ranges), self.samples)
+
+    def _set_columns(self, sample_numbers):
+        """
+        Lay the columns out in the order of ``sample_numbers``.
+
+        Known samples keep their cells, new samples get the fill code of every row.
+
+        Returns:
+            bool: True when a stored sample was dropped, which changes the row contents
+        """
+        if list(sample_numbers) == self.samples:
+            return False
+        old_columns = pd.Index(self.samples).get_indexer(sample_numbers)
+        known = old_columns >= 0
+        codes = np.empty((len(self.size_ranges), len(sample_numbers)), dtype=np.int8)
+        codes[:, known] = self.codes[:, old_columns[known]]
+        codes[:, ~known] = self.row_fill[:, None]
+        dropped = known.sum() < len(self.samples)
+        self.codes = codes
+        self.samples = list(sample_numbers)
+        return dropped
+
+    def append(self, peaks, df_sample_order, plate=None, run_report=None, unmapped=None, qc=True):
+        """
+        Add the peaks of a new plate to the matrix, in place.
+
+        The QC counts of the plate are added to those of the store. They are dropped for
+        good when a plate is appended with ``qc=False``, since they would no longer cover
+        every plate.
+
+        Args:
+            peaks (pd.DataFrame, str or file-like): Peaks export of the new plate (see
+                ``load_peaks_export``)
+            df_sample_order (pd.DataFrame): Current sample order, including the new samples
+            plate (dict): Record of the plate kept in ``plates`` (optional)
+            run_report (RunReport): Records the time, rows and memory of every stage (optional)
+            unmapped (set): Receives the sample names missing from the sample order (optional)
+            qc (bool): Add the QC counts of the plate to those of the store (default: True)
+
+        Returns:
+            np.ndarray: Indices of the rows whose fill was recomputed
+        """
+        with stage_context(run_report, "load") as stage:
+            df_peaks = load_peaks_export(peaks)
+            stage["rows"] = len(df_peaks)
+        with stage_context(run_report, "rename") as stage:
+            df_peaks = rename_samples(df_peaks, df_sample_order, unmapped)
+            stage["rows"] = len(df_peaks)
+        with stage_context(run_report, "filter") as stage:
+            df_filtered = filter_peaks(df_peaks, self.height_threshold)
+            stage["rows"] = len(df_filtered)
+        range_index = SizeRangeIndex(self.size_ranges)
+        sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+        peak_qc = None
+        if qc and self.qc is not None:
+            # The counts of the earlier plates, laid out over the new sample order
+            peak_qc = PeakQC(self.size_ranges, sample_numbers, range_index)
+            peak_qc.add_sample_counts(self.qc.sample_counts)
+            peak_qc.add_cell_counts(*self.qc.cell_hits, self.qc.sample_numbers)
+        with stage_context(run_report, "classify") as stage:
+            if peak_qc is not None:
+                peak_qc.count_peaks("peaks", df_peaks)
+                peak_qc.count_peaks("above_threshold", df_filtered)
+            df_filtered = classify_peaks(df_filtered, range_index)
+            if peak_qc is not None:
+                peak_qc.count_peaks("in_range", df_filtered)
+            stage["rows"] = len(df_filtered)
+
+        with stage_context(run_report, "matrix") as stage:
+            dropped = self._set_columns(sample_numbers)
+            range_ids, columns, hit_codes = peak_hits(df_filtered, sample_numbers, range_index, peak_qc)
+            rows = np.arange(len(self.size_ranges)) if dropped else np.unique(range_ids)
+            # Strip the fill of the touched rows, write the new cells and fill them again
+            touched = self._peak_codes(self.codes[rows])
+            touched[np.searchsorted(rows, range_ids), columns] = hit_codes
+            stage["rows"] = len(range_ids)
+
+        with stage_context(run_report, "fill") as stage:
+            fill = row_fill_codes(touched)
+            self.codes[rows] = np.where(touched == CODE_EMPTY, fill[:, None], touched)
+            self.row_fill[rows] = fill
+            stage["rows"] = len(rows)
+
+        self.qc = peak_qc
+        if plate is not None:
+            self.plates.append(plate)
+        return rows
+
+
+def append_plate(input_file_path, peaks_file, output_file_path=None, X=4, Y=8, store_path=None, run_report=None,
+                 height_threshold=HEIGHT_THRESHOLD, qc=True):
+    """
+    Add a new plate to a panel's matrix store and regenerate the output workbook.
+
+    The sample order and size ranges are read from ``input_file_path`` as in
+    ``gene_mapper_analysis``; the sample order must include the new samples. The store is
+    created with the first plate. Appending a plate twice, or with size ranges or a height
+    threshold that differ from those of the store, raises ValueError: rebuild the store
+    (delete it and append every plate again) after changing them.
+
+    Args:
+        input_file_path (str): Path to the input files directory
+        peaks_file (str): Peaks export of the new plate (.txt/.tsv/.csv/.xlsx)
+        output_file_path (str): Path to the output files directory (default: the input directory)
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        store_path (str): Matrix store (default: matrix_store_EM{X}_ME{Y}.npz in the output directory)
+        run_report (RunReport): Records the time, rows and memory of every stage (optional)
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+        qc (bool): Add the QC sheets of all the plates to the output workbook and the QC
+            summary to the run report (default: True). They are left out, with a warning,
+            when a plate of the store was appended without them
+
+    Returns:
+        str: Path to the regenerated output file
+    """
+    emx_mey_label = f"EM{X}_ME{Y}"
+    output_file_path = output_file_path or input_file_path
+    store_path = store_path or default_store_path(output_file_path, emx_mey_label)
+
+    size_ranges = load_size_ranges(os.path.join(input_file_path, f"Size_ranges_{emx_mey_label}.xlsx"))
+    if os.path.exists(store_path):
+        store = MatrixStore.load(store_path)
+        if store.ranges_digest != size_ranges_digest(size_ranges):
+            raise ValueError(f"the size ranges of {emx_mey_label} changed since the store {store_path} was "
+                             f"created; delete it and append every plate again")
+        if store.height_threshold != height_threshold:
+            raise ValueError(f"the store {store_path} was built with height threshold {store.height_threshold}, "
+                             f"not {height_threshold}; delete it and append every plate again")
+        # Same contents: keep the table as read from the file, with its original types
+        store.size_ranges = size_ranges
+    else:
+        store = MatrixStore(emx_mey_label, size_ranges, height_threshold=height_threshold)
+
+    digest = file_digest(peaks_file)
+    if any(plate["digest"] == digest for plate in store.plates):
+        raise ValueError(f"{peaks_file} was already added to {store_path}")
+
+    sample_order = sample_order_source(os.path.join(input_file_path, SAMPLE_ORDER_FILE))
+    plate = {"file": os.path.abspath(peaks_file), "digest": digest,
+             "added": datetime.datetime.now().isoformat(timespec="seconds")}
+    unmapped = set()
+    had_qc = store.qc is not None
+    rows = store.append(peaks_file, load_sample_order(sample_order), plate=plate, run_report=run_report,
+                        unmapped=unmapped, qc=qc)
+    if qc and not had_qc:
+        logger.warning("%s: the store %s has no QC counts for its earlier plates, so the QC sheets are left out; "
+                       "delete it and append every plate again to get them", emx_mey_label, store_path)
+    unmapped = report_unmapped(emx_mey_label, unmapped)
+    if isinstance(sample_order, SampleRegistry):
+        sample_order.record_unmapped(emx_mey_label, unmapped)
+    logger.info("%s: %s added, fill recomputed for %d of %d size ranges", emx_mey_label, peaks_file, len(rows),
+                len(size_ranges))
+    store.save(store_path)
+
+    output_filename = os.path.join(output_file_path, f"Sample_Size_Matrix_Colored_{emx_mey_label}.xlsx")
+    matrix = store.matrix()
+    with stage_context(run_report, "write") as stage:
+        render_workbook(matrix, output_filename, extra_sheets=store.qc.tables(matrix) if store.qc is not None else None)
+        stage["rows"] = len(size_ranges)
+    if run_report is not None and store.qc is not None:
+        run_report.info["qc"] = store.qc.summary(matrix)
+    return output_filename
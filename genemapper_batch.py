@@ -0,0 +1,392 @@
+"""
+Batch mode: run many EMx_MEy primer combinations in parallel.
+
+The shared sample order is loaded once in the parent process, through the sample
+registry, and handed to every worker of a process pool. A failing combination is recorded in the summary and
+does not stop the others.
+
+Manifests describe whole sequencing runs: one job per input directory and combination.
+``run_manifest`` keeps a state file next to the manifest with the SHA-256 of every
+job's input files. It is updated as each job finishes, so jobs whose inputs are
+unchanged and whose output still exists are skipped, and a crashed run resumes where it
+stopped.
+
+``--study-workbook`` also consolidates the outputs of the run into one workbook with a
+sheet per panel and a combined sheet (see genemapper_study.py).
+
+Usage:
+    python genemapper_batch.py INPUT_DIR CONFIG_DIR OUTPUT_DIR [--combinations 4:8 3:5] [--workers N]
+                               [--study-workbook FILE]
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Python_genemapper_analysis import HEIGHT_THRESHOLD, gene_mapper_analysis, load_sample_order
+from genemapper_cache import file_digest
+from genemapper_readers import PEAKS_EXTENSIONS, find_peaks_export
+from genemapper_registry import SampleRegistry, sample_order_source
+from genemapper_study import write_study_workbook
+
+
+PEAKS_FILE_PATTERN = re.compile(r"^EM(\d+)_ME(\d+)_peaks_exported(%s)$"
+                                % "|".join(re.escape(extension) for extension in PEAKS_EXTENSIONS))
+SAMPLE_ORDER_FILE = "Hyssop_sample_numbers_Genemapper.xlsx"
+
+# Bump when a change to the analysis invalidates the outputs recorded in state files
+STATE_VERSION = 1
+
+# Manifest keys of a job, and the keys that may be set once under "defaults"
+MANIFEST_KEYS = ("input", "config", "output", "X", "Y", "combinations", "chunksize", "height_threshold")
+
+# Sample order shared by all the combinations run in a worker process
+_worker_sample_order = None
+
+
+def discover_combinations(input_file_path):
+    """
+    Find the (X, Y) combinations that have a peaks export in the input directory.
+
+    Args:
+        input_file_path (str): Path to the input files directory
+
+    Returns:
+        list: Sorted list of (X, Y) tuples
+    """
+    combinations = set()
+    for file_name in os.listdir(input_file_path):
+        match = PEAKS_FILE_PATTERN.match(file_name)
+        if match:
+            combinations.add((int(match.group(1)), int(match.group(2))))
+    return sorted(combinations)
+
+
+def _init_worker(df_sample_order):
+    """Store the sample order (table or registry) loaded by the parent process."""
+    global _worker_sample_order
+    _worker_sample_order = df_sample_order
+
+
+def _run_combination(input_file_path, config_file_path, output_file_path, X, Y, chunksize=None,
+                     height_threshold=HEIGHT_THRESHOLD):
+    """Run one combination in a worker process and report its outcome."""
+    start = time.perf_counter()
+    result = {"label": f"EM{X}_ME{Y}", "X": X, "Y": Y, "output": None, "error": None}
+    try:
+        result["output"] = gene_mapper_analysis(input_file_path, config_file_path, output_file_path,
+                                                X=X, Y=Y, df_sample_order=_worker_sample_order,
+                                                chunksize=chunksize, height_threshold=height_threshold)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(input_file_path, config_file_path, output_file_path, combinations=None, max_workers=None,
+              chunksize=None, height_threshold=HEIGHT_THRESHOLD, study_workbook=None):
+    """
+    Analyze several EMX_MEY combinations in a process pool.
+
+    Args:
+        input_file_path (str): Path to the input files directory
+        config_file_path (str): Path to the config files directory
+        output_file_path (str): Path to the output files directory
+        combinations (list): (X, Y) tuples to run (default: every peaks export found in
+            input_file_path)
+        max_workers (int): Number of worker processes (default: one per CPU)
+        chunksize (int): Stream every peaks export in chunks of this many rows (optional)
+        height_threshold (float): Peaks must be strictly higher than this (default: 160)
+        study_workbook (str): Also write the successful outputs, in the order of
+            ``combinations``, to this consolidated workbook (optional, see
+            ``write_study_workbook``)
+
+    Returns:
+        list: One dict per combination, in the order of ``combinations``, with the keys
+        label, X, Y, output (path or None), error (message or None) and seconds
+    """
+    if combinations is None:
+        combinations = discover_combinations(input_file_path)
+    combinations = [(int(X), int(Y)) for X, Y in combinations]
+    if not combinations:
+        return []
+
+    # Load the shared sample order once for all combinations; a registry is handed to the
+    # workers by path and records the names each combination could not map
+    df_sample_order = sample_order_source(os.path.join(input_file_path, SAMPLE_ORDER_FILE))
+    if not isinstance(df_sample_order, SampleRegistry):
+        df_sample_order = load_sample_order(df_sample_order)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(df_sample_order,)) as executor:
+        futures = {
+            executor.submit(_run_combination, input_file_path, config_file_path, output_file_path, X, Y,
+                            chunksize, height_threshold): (X, Y)
+            for X, Y in combinations
+        }
+        for future in as_completed(futures):
+            X, Y = futures[future]
+            try:
+                results[(X, Y)] = future.result()
+            except Exception as e:
+                # The worker itself died (e.g. out of memory)
+                results[(X, Y)] = {"label": f"EM{X}_ME{Y}", "X": X, "Y": Y, "output": None,
+                                   "error": f"{type(e).__name__}: {e}", "seconds": None}
+
+    results = [results[combination] for combination in combinations]
+    outputs = [result["output"] for result in results if result["error"] is None]
+    if study_workbook and outputs:
+        write_study_workbook(outputs, study_workbook, max_workers=max_workers)
+    return results
+
+
+def format_summary(results):
+    """
+    Format batch results as a plain-text table.
+
+    Args:
+        results (list): Result dicts returned by ``run_batch``
+
+    Returns:
+        str: One line per combination with its status and timing
+    """
+    lines = []
+    for result in results:
+        seconds = "-" if result["seconds"] is None else f"{result['seconds']:.1f}s"
+        if result["error"] is not None:
+            status = f"FAILED {result['error']}"
+        elif result.get("skipped"):
+            status = f"SKIP   {result['output']}"
+        else:
+            status = f"OK     {result['output']}"
+        lines.append(f"{result['label']:<12} {seconds:>8}  {status}")
+    n_failed = sum(result["error"] is not None for result in results)
+    n_skipped = sum(bool(result.get("skipped")) for result in results)
+    summary = f"{len(results) - n_failed - n_skipped} succeeded, {n_failed} failed"
+    lines.append(summary + (f", {n_skipped} up to date" if n_skipped else ""))
+    return "\n".join(lines)
+
+
+def _read_manifest_rows(manifest_path):
+    """Return the job rows and the defaults of a CSV or YAML manifest."""
+    extension = os.path.splitext(manifest_path)[1].lower()
+    if extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("YAML manifests need PyYAML (pip install pyyaml); use a CSV manifest otherwise")
+        with open(manifest_path) as f:
+            data = yaml.safe_load(f) or []
+        if isinstance(data, dict):
+            return data.get("jobs") or [], data.get("defaults") or {}
+        return data, {}
+    with open(manifest_path, newline="") as f:
+        rows = [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                for row in csv.DictReader(f)]
+    return rows, {}
+
+
+def load_manifest(manifest_path):
+    """
+    Read a job manifest and expand it to one job per input directory and combination.
+
+    A CSV manifest has the columns input, config, output, X and Y (chunksize and
+    height_threshold are optional). A YAML manifest is a list of jobs, or a mapping with ``defaults`` and
+    ``jobs``; a YAML job may list ``combinations`` ("X:Y" strings) instead of X and Y.
+    Jobs without a combination run every peaks export found in their input directory,
+    and config and output default to the input directory. Relative paths are resolved
+    against the manifest directory.
+
+    Args:
+        manifest_path (str): Path of the .csv, .yaml or .yml manifest
+
+    Returns:
+        list: Job dicts with the keys input, config, output, X, Y, chunksize and height_threshold
+    """
+    rows, defaults = _read_manifest_rows(manifest_path)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+
+    jobs = []
+    for number, row in enumerate(rows, start=1):
+        row = {**defaults, **row}
+        unknown = set(row) - set(MANIFEST_KEYS)
+        if unknown:
+            raise ValueError(f"{manifest_path}: job {number} has unknown keys {sorted(unknown)}")
+        if not row.get("input"):
+            raise ValueError(f"{manifest_path}: job {number} has no input directory")
+        input_file_path = os.path.join(base, str(row["input"]))
+        config_file_path = os.path.join(base, str(row.get("config") or row["input"]))
+        output_file_path = os.path.join(base, str(row.get("output") or row["input"]))
+
+        if row.get("X") is not None and row.get("Y") is not None:
+            combinations = [(int(row["X"]), int(row["Y"]))]
+        elif row.get("combinations"):
+            combinations = [parse_combination(str(value)) for value in row["combinations"]]
+        else:
+            combinations = discover_combinations(input_file_path)
+        chunksize = int(row["chunksize"]) if row.get("chunksize") else None
+        height_threshold = float(row["height_threshold"]) if row.get("height_threshold") else HEIGHT_THRESHOLD
+
+        for X, Y in combinations:
+            jobs.append({"input": os.path.normpath(input_file_path), "config": os.path.normpath(config_file_path),
+                         "output": os.path.normpath(output_file_path), "X": X, "Y": Y, "chunksize": chunksize,
+                         "height_threshold": height_threshold})
+    return jobs
+
+
+def job_key(job):
+    """Return the identifier of a job in a state file."""
+    return f"{job['input']}|EM{job['X']}_ME{job['Y']}|{job['output']}"
+
+
+def job_fingerprint(job):
+    """
+    Hash the files a job reads.
+
+    Args:
+        job (dict): Job from ``load_manifest``
+
+    Returns:
+        dict: SHA-256 (or None when missing) of the peaks export, sample order and
+        size ranges files, plus the height threshold and the state version
+    """
+    label = f"EM{job['X']}_ME{job['Y']}"
+    paths = {
+        "peaks": find_peaks_export(job["input"], label),
+        "sample_order": os.path.join(job["input"], SAMPLE_ORDER_FILE),
+        "size_ranges": os.path.join(job["input"], f"Size_ranges_{label}.xlsx"),
+    }
+    fingerprint = {name: file_digest(path) if os.path.exists(path) else None for name, path in paths.items()}
+    fingerprint["height_threshold"] = job.get("height_threshold", HEIGHT_THRESHOLD)
+    fingerprint["version"] = STATE_VERSION
+    return fingerprint
+
+
+def read_state(state_path):
+    """Return the jobs recorded in a state file, keyed by ``job_key``."""
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f).get("jobs", {})
+
+
+def write_state(state_path, jobs):
+    """Atomically replace a state file, so that a crash never leaves it half written."""
+    tmp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": STATE_VERSION, "jobs": jobs}, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def is_current(job, record):
+    """Return True when a state record shows the job's output is up to date."""
+    return (record is not None and record.get("error") is None and record.get("output") is not None
+            and os.path.exists(record["output"]) and record.get("fingerprint") == job_fingerprint(job))
+
+
+def _run_manifest_job(job, report_path=None):
+    """Run one manifest job in a worker process and report its outcome."""
+    start = time.perf_counter()
+    result = {"label": f"EM{job['X']}_ME{job['Y']}", "X": job["X"], "Y": job["Y"], "output": None, "error": None}
+    try:
+        result["output"] = gene_mapper_analysis(job["input"], job["config"], job["output"], X=job["X"], Y=job["Y"],
+                                                chunksize=job["chunksize"], report_path=report_path,
+                                                height_threshold=job["height_threshold"])
+        # Hash the inputs as the run left them: a missing size ranges file is created by the run
+        result["fingerprint"] = job_fingerprint(job)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_manifest(manifest_path, max_workers=None, state_path=None, force=False, report_path=None):
+    """
+    Run the jobs of a manifest in a process pool, skipping those that are current.
+
+    Args:
+        manifest_path (str): Path of the .csv, .yaml or .yml manifest
+        max_workers (int): Number of worker processes (default: one per CPU)
+        state_path (str): State file (default: the manifest path + ".state.json")
+        force (bool): Run every job, even when its output is current
+        report_path (str): Directory for the JSON run report of every job (optional)
+
+    Returns:
+        list: One dict per job, in manifest order, with the keys of ``run_batch``
+        results plus input and skipped
+    """
+    jobs = load_manifest(manifest_path)
+    state_path = state_path or f"{manifest_path}.state.json"
+    state = read_state(state_path)
+
+    results = {}
+    pending = []
+    for job in jobs:
+        record = state.get(job_key(job))
+        if not force and is_current(job, record):
+            results[job_key(job)] = {"label": f"EM{job['X']}_ME{job['Y']}", "X": job["X"], "Y": job["Y"],
+                                     "output": record["output"], "error": None, "seconds": None, "skipped": True}
+        else:
+            pending.append(job)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_run_manifest_job, job, report_path): job for job in pending}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. out of memory)
+                    result = {"label": f"EM{job['X']}_ME{job['Y']}", "X": job["X"], "Y": job["Y"], "output": None,
+                              "error": f"{type(e).__name__}: {e}", "seconds": None}
+                result["skipped"] = False
+                results[job_key(job)] = result
+                state[job_key(job)] = {"output": result["output"], "error": result["error"],
+                                       "fingerprint": result.pop("fingerprint", None),
+                                       "finished": datetime.datetime.now().isoformat(timespec="seconds")}
+                write_state(state_path, state)
+
+    return [{**results[job_key(job)], "input": job["input"]} for job in jobs]
+
+
+def parse_combination(value):
+    """Parse an "X:Y" command-line argument."""
+    try:
+        X, Y = value.split(":")
+        return int(X), int(Y)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected X:Y, got {value!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run gene mapper analysis for many EMX_MEY combinations.")
+    parser.add_argument("input_file_path", help="Input files directory")
+    parser.add_argument("config_file_path", help="Config files directory")
+    parser.add_argument("output_file_path", help="Output files directory")
+    parser.add_argument("--combinations", nargs="+", type=parse_combination, metavar="X:Y",
+                        help="Combinations to run (default: all *_peaks_exported.* files)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Stream peaks exports in chunks of this many rows (bounded memory)")
+    parser.add_argument("--height-threshold", type=float, default=HEIGHT_THRESHOLD,
+                        help=f"Peaks must be higher than this to be called (default: {HEIGHT_THRESHOLD})")
+    parser.add_argument("--study-workbook", default=None,
+                        help="Also write all panels to this workbook, with a combined sheet")
+    args = parser.parse_args(argv)
+
+    results = run_batch(args.input_file_path, args.config_file_path, args.output_file_path,
+                        combinations=args.combinations, max_workers=args.workers, chunksize=args.chunksize,
+                        height_threshold=args.height_threshold, study_workbook=args.study_workbook)
+    print(format_summary(results))
+    return 1 if any(result["error"] is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,567 @@
+"""
+Synthetic-data benchmark and equivalence check for the gene mapper analysis.
+
+Synthetic peaks exports, sample order sheets and size ranges sheets are generated in
+memory for any size. The benchmark times every pipeline stage and records its peak
+memory (tracemalloc) over a grid of peak, sample and bin counts. The equivalence check
+compares the matrices of the vectorized, streaming and append engines cell by cell with a
+loop-based reference, a copy of the original implementation, and the counts of the size
+ranges proposed from the peaks with a pandas groupby.
+
+Usage:
+    python genemapper_benchmark.py [--peaks 10000 100000] [--samples 96 384] [--bins 50 500]
+    python genemapper_benchmark.py --check [--peaks 5000] [--samples 96] [--bins 50]
+    python genemapper_benchmark.py --write DIR --peaks 100000 --samples 96 --bins 500
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from Python_genemapper_analysis import (SIZE_RANGES_COLUMNS, SizeRangeIndex, build_classification_matrix,
+                                        build_matrix_streaming, classify_peaks, filter_peaks, load_peaks_export,
+                                        render_workbook, rename_samples, run_pipeline)
+from genemapper_append import MatrixStore
+from genemapper_bins import discover_bins
+from genemapper_readers import compact_peaks
+
+
+# Default scaling grid: every count is varied around the first value of the others
+DEFAULT_PEAKS = [10000, 100000, 1000000, 5000000]
+DEFAULT_SAMPLES = [96, 384, 1536]
+DEFAULT_BINS = [50, 500, 5000]
+
+# Sizes covered by the synthetic size ranges (bp)
+SIZE_MIN, SIZE_MAX = 50.0, 500.0
+
+
+def make_size_ranges(n_bins, rng):
+    """
+    Generate a size ranges table.
+
+    Bins are 0.5-3 bp wide and spread over SIZE_MIN-SIZE_MAX, so that dense grids
+    overlap. A and B mark about a third of the bins each as "c" and "b" rules; some
+    bins have both or neither set, and a few A values are missing, as in hand-edited
+    sheets.
+
+    Args:
+        n_bins (int): Number of size ranges
+        rng (np.random.Generator): Random generator
+
+    Returns:
+        pd.DataFrame: Table with the columns A, B, Lower and Upper
+    """
+    lower = np.sort(rng.uniform(SIZE_MIN, SIZE_MAX, n_bins)).round(1)
+    upper = (lower + rng.uniform(0.5, 3.0, n_bins)).round(1)
+    rule = rng.choice(3, n_bins, p=[0.35, 0.35, 0.3])
+    a_value = (rule == 0).astype(float)
+    b_value = (rule == 1).astype(int)
+    # A few bins with both flags (not classifying) and missing A values
+    both = rng.random(n_bins) < 0.05
+    a_value[both] = 1.0
+    b_value[both] = 1
+    a_value[rng.random(n_bins) < 0.02] = np.nan
+    return pd.DataFrame({"A": a_value, "B": b_value, "Lower": lower, "Upper": upper})[SIZE_RANGES_COLUMNS]
+
+
+def make_sample_order(n_samples):
+    """
+    Generate a sample order table for plates of 96 wells.
+
+    Args:
+        n_samples (int): Number of samples
+
+    Returns:
+        pd.DataFrame: Default_name (de-spaced file name) and Sample_number columns
+    """
+    return pd.DataFrame({
+        "Default_name": [name.replace(" ", "") for name in sample_file_names(n_samples)],
+        "Sample_number": np.arange(1, n_samples + 1),
+    })
+
+
+def sample_file_names(n_samples):
+    """Return GeneMapper-style sample file names (with spaces) of ``n_samples`` wells."""
+    wells = [f"{row}{column:02d}" for row in "ABCDEFGH" for column in range(1, 13)]
+    return [f"Plate {i // 96 + 1}_{wells[i % 96]} Hyssop.fsa" for i in range(n_samples)]
+
+
+def make_peaks(n_peaks, n_samples, size_ranges, rng, unmapped_fraction=0.01):
+    """
+    Generate a peaks export table.
+
+    Sizes have two decimals, like GeneMapper exports. About a third of the peaks are
+    drawn inside the size ranges and some fall exactly on a bound; 1% have no size.
+    Heights span both sides of the height threshold. A fraction of the peaks belongs to
+    samples missing from the sample order.
+
+    Args:
+        n_peaks (int): Number of peaks
+        n_samples (int): Number of samples in the sample order
+        size_ranges (pd.DataFrame): Size ranges the peaks are drawn around
+        rng (np.random.Generator): Random generator
+        unmapped_fraction (float): Share of peaks from unknown samples (default: 0.01)
+
+    Returns:
+        pd.DataFrame: Sample File Name, Marker, Size and Height columns
+    """
+    size = rng.uniform(SIZE_MIN - 10, SIZE_MAX + 10, n_peaks).round(2)
+    if len(size_ranges):
+        lower = size_ranges["Lower"].to_numpy(dtype=float)
+        upper = size_ranges["Upper"].to_numpy(dtype=float)
+        in_bin = rng.random(n_peaks) < 0.35
+        bins = rng.integers(0, len(size_ranges), in_bin.sum())
+        size[in_bin] = (lower[bins] + rng.random(in_bin.sum()) * (upper[bins] - lower[bins])).round(2)
+        on_bound = rng.random(n_peaks) < 0.02
+        bins = rng.integers(0, len(size_ranges), on_bound.sum())
+        size[on_bound] = np.where(rng.random(on_bound.sum()) < 0.5, lower[bins], upper[bins])
+    size[rng.random(n_peaks) < 0.01] = np.nan
+
+    names = np.array(sample_file_names(n_samples) + ["Ladder_01 Unknown.fsa"], dtype=object)
+    sample = rng.integers(0, n_samples, n_peaks)
+    sample[rng.random(n_peaks) < unmapped_fraction] = n_samples
+    return pd.DataFrame({
+        " Sample File Name ": pd.Categorical.from_codes(sample, names),
+        "Marker": "x",
+        "Size": size,
+        "Height": rng.integers(20, 4000, n_peaks),
+    })
+
+
+def make_dataset(n_peaks, n_samples, n_bins, seed=0):
+    """
+    Generate a complete synthetic input set.
+
+    Args:
+        n_peaks (int): Number of peaks
+        n_samples (int): Number of samples
+        n_bins (int): Number of size ranges
+        seed (int): Random seed (default: 0)
+
+    Returns:
+        dict: peaks, sample_order and size_ranges DataFrames
+    """
+    rng = np.random.default_rng(seed)
+    size_ranges = make_size_ranges(n_bins, rng)
+    return {
+        "peaks": make_peaks(n_peaks, n_samples, size_ranges, rng),
+        "sample_order": make_sample_order(n_samples),
+        "size_ranges": size_ranges,
+    }
+
+
+def write_dataset(dataset, input_file_path, X=4, Y=8, text=False):
+    """
+    Write a synthetic dataset with the file names expected by ``gene_mapper_analysis``.
+
+    Args:
+        dataset (dict): Tables returned by ``make_dataset``
+        input_file_path (str): Input directory (created if needed)
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        text (bool): Write the peaks as a tab-delimited .txt export instead of xlsx
+
+    Returns:
+        str: Path of the peaks export
+    """
+    os.makedirs(input_file_path, exist_ok=True)
+    emx_mey_label = f"EM{X}_ME{Y}"
+    dataset["sample_order"].to_excel(os.path.join(input_file_path, "Hyssop_sample_numbers_Genemapper.xlsx"),
+                                     index=False)
+    dataset["size_ranges"].to_excel(os.path.join(input_file_path, f"Size_ranges_{emx_mey_label}.xlsx"),
+                                    index=False)
+    peaks_path = os.path.join(input_file_path, f"{emx_mey_label}_peaks_exported." + ("txt" if text else "xlsx"))
+    if text:
+        dataset["peaks"].to_csv(peaks_path, sep="\t", index=False)
+    else:
+        dataset["peaks"].to_excel(peaks_path, index=False)
+    return peaks_path
+
+
+def reference_matrix(df_exported_table, df_sample_order, size_ranges, emx_mey_label):
+    """
+    Build the filled matrix with the original loop-based algorithm.
+
+    This is the implementation the vectorized engines replaced, kept as the ground
+    truth of the equivalence check. Cells are initialized as object columns so that it
+    also runs on pandas versions that refuse to upcast float columns to strings. It is
+    quadratic: use it on small datasets only.
+
+    Args:
+        df_exported_table (pd.DataFrame): Peaks table as exported
+        df_sample_order (pd.DataFrame): Sample order table
+        size_ranges (pd.DataFrame): Size ranges table
+        emx_mey_label (str): Label of the EMX_MEY rows
+
+    Returns:
+        pd.DataFrame: EMX_MEY and Size_Range columns followed by one column per sample
+    """
+    df_exported_table = df_exported_table.copy()
+    df_exported_table.columns = df_exported_table.columns.str.strip()
+    df_exported_table["Size"] = pd.to_numeric(df_exported_table["Size"], errors="coerce")
+    df_exported_table['Sample File Name'] = (df_exported_table['Sample File Name'].astype(str)
+                                             .str.replace(' ', '', regex=False))
+    df_exported_table = df_exported_table.merge(
+        df_sample_order[['Default_name', 'Sample_number']],
+        left_on='Sample File Name',
+        right_on='Default_name',
+        how='left'
+    )
+    df_exported_table['Sample File Name'] = df_exported_table['Sample_number'].astype(object).fillna(
+        df_exported_table['Sample File Name'])
+
+    height_filtered = df_exported_table[df_exported_table['Height'] > 160]
+
+    def size_in_any_range(size_value):
+        return ((size_value >= size_ranges['Lower']) & (size_value <= size_ranges['Upper'])).any()
+
+    df_filtered = height_filtered[height_filtered['Size'].apply(size_in_any_range)].copy()
+    df_filtered['Classification'] = pd.Series(np.nan, index=df_filtered.index, dtype=object)
+    for i in range(len(size_ranges)):
+        lower_bound = size_ranges.iloc[i]['Lower']
+        upper_bound = size_ranges.iloc[i]['Upper']
+        a_value = size_ranges.iloc[i]['A']
+        b_value = size_ranges.iloc[i]['B']
+        in_range = (df_filtered['Size'] >= lower_bound) & (df_filtered['Size'] <= upper_bound)
+        if a_value != 0 and b_value == 0:
+            df_filtered.loc[in_range, 'Classification'] = "c"
+        elif b_value != 0 and a_value == 0:
+            df_filtered.loc[in_range, 'Classification'] = "b"
+
+    sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+    df_matrix = pd.DataFrame({
+        'EMX_MEY': [emx_mey_label] * len(size_ranges),
+        'Size_Range': size_ranges['Lower'].astype(str) + " - " + size_ranges['Upper'].astype(str),
+    })
+    cells = pd.DataFrame(np.full((len(df_matrix), len(sample_numbers)), np.nan, dtype=object),
+                         columns=sample_numbers)
+    df_matrix = pd.concat([df_matrix, cells], axis=1)
+
+    for i in range(len(df_matrix)):
+        lower_bound = size_ranges.iloc[i]['Lower']
+        upper_bound = size_ranges.iloc[i]['Upper']
+        range_data = df_filtered[(df_filtered['Size'] >= lower_bound) & (df_filtered['Size'] <= upper_bound)]
+        for j in range(len(range_data)):
+            sample_name = range_data.iloc[j]['Sample File Name']
+            if sample_name in df_matrix.columns:
+                df_matrix.loc[i, sample_name] = range_data.iloc[j]['Classification']
+
+    for i in range(len(df_matrix)):
+        row_values = df_matrix.iloc[i, 2:]
+        if (row_values == "c").any():
+            df_matrix.iloc[i, 2:] = row_values.fillna("a")
+        elif (row_values == "b").any():
+            df_matrix.iloc[i, 2:] = row_values.fillna("d")
+    return df_matrix
+
+
+def compare_frames(expected, actual, max_mismatches=20):
+    """
+    Compare two matrices cell by cell (NaN equals NaN).
+
+    Args:
+        expected (pd.DataFrame): Reference matrix
+        actual (pd.DataFrame): Matrix under test
+        max_mismatches (int): Number of mismatching cells to report (default: 20)
+
+    Returns:
+        list: Descriptions of the differences; empty when the matrices are equal
+    """
+    if expected.shape != actual.shape:
+        return [f"shape {actual.shape} != expected {expected.shape}"]
+    if list(expected.columns) != list(actual.columns):
+        return ["column labels differ"]
+    left = expected.to_numpy(dtype=object)
+    right = actual.to_numpy(dtype=object)
+    same = (left == right) | (pd.isna(left) & pd.isna(right))
+    rows, columns = np.nonzero(~same)
+    mismatches = [f"row {row} ({left[row, 1]}), column {expected.columns[column]!r}: "
+                  f"{right[row, column]!r} != expected {left[row, column]!r}"
+                  for row, column in zip(rows[:max_mismatches], columns[:max_mismatches])]
+    if len(rows) > max_mismatches:
+        mismatches.append(f"... {len(rows) - max_mismatches} more")
+    return mismatches
+
+
+def check_bins(dataset, missing_fraction=0.05, seed=0):
+    """
+    Compare the peak and sample counts of proposed size ranges with a pandas groupby.
+
+    A share of the sample names is blanked, as in exports with empty Sample File Name
+    cells: those peaks must not count towards any range.
+
+    Args:
+        dataset (dict): Tables returned by ``make_dataset``
+        missing_fraction (float): Share of peaks without a sample name (default: 0.05)
+        seed (int): Random seed of the blanked names (default: 0)
+
+    Returns:
+        list: Descriptions of the differences; empty when the counts are equal
+    """
+    peaks = filter_peaks(dataset["peaks"].rename(columns=lambda column: column.strip()))
+    sizes = peaks["Size"].to_numpy(dtype=float)
+    samples = peaks["Sample File Name"].to_numpy(dtype=object)
+    samples[np.random.default_rng(seed).random(len(samples)) < missing_fraction] = np.nan
+    # Every group is kept, so that every named peak falls in exactly one range
+    bins = discover_bins(sizes, samples, min_samples=1)
+
+    named = ~np.isnan(sizes) & pd.notna(samples)
+    range_ids = np.searchsorted(bins["Lower"].to_numpy(), sizes[named], side="right") - 1
+    expected = pd.DataFrame({"range": range_ids, "sample": samples[named]}).groupby("range")["sample"].agg(
+        ["size", "nunique"]).reindex(range(len(bins)), fill_value=0)
+    mismatches = []
+    for column, reference in (("Peaks", "size"), ("Samples", "nunique")):
+        differ = np.flatnonzero(bins[column].to_numpy() != expected[reference].to_numpy())
+        mismatches += [f"range {i} ({bins['Lower'].iloc[i]}-{bins['Upper'].iloc[i]}): {column} "
+                       f"{bins[column].iloc[i]} != expected {expected[reference].iloc[i]}" for i in differ[:20]]
+    return mismatches
+
+
+def check_equivalence(dataset, X=4, Y=8, chunksize=None):
+    """
+    Compare the vectorized, streaming and append engines with the loop-based reference,
+    the QC tables of the append engine with those of a single run over its plates, and
+    the counts of the proposed size ranges with a pandas groupby (see ``check_bins``).
+
+    Args:
+        dataset (dict): Tables returned by ``make_dataset``
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        chunksize (int): Rows per chunk of the streaming engine (default: a tenth of the peaks)
+
+    Returns:
+        dict: Engine name -> list of differences (empty lists mean equivalent)
+    """
+    emx_mey_label = f"EM{X}_ME{Y}"
+    peaks, df_sample_order, size_ranges = dataset["peaks"], dataset["sample_order"], dataset["size_ranges"]
+    expected = reference_matrix(peaks, df_sample_order, size_ranges, emx_mey_label)
+
+    results = {}
+    result = run_pipeline(peaks, df_sample_order, size_ranges, X=X, Y=Y, render=False)
+    results["vectorized"] = compare_frames(expected, result.matrix.to_frame())
+
+    chunksize = chunksize or max(1, len(peaks) // 10)
+    chunks = (compact_peaks(peaks.iloc[start:start + chunksize].copy())
+              for start in range(0, len(peaks), chunksize))
+    sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+    matrix = build_matrix_streaming(chunks, df_sample_order, size_ranges, sample_numbers, emx_mey_label)
+    results["streaming"] = compare_frames(expected, matrix.fill_empty().to_frame())
+
+    # Two plates appended in turn, the second one adding the second half of the samples
+    n_first = len(df_sample_order) // 2
+    first_plate = peaks[" Sample File Name "].cat.codes < n_first
+    store = MatrixStore(emx_mey_label, size_ranges)
+    store.append(peaks[first_plate], df_sample_order.iloc[:n_first])
+    store.append(peaks[~first_plate], df_sample_order)
+    plates_peaks = pd.concat([peaks[first_plate], peaks[~first_plate]], ignore_index=True)
+    plates_expected = reference_matrix(plates_peaks, df_sample_order, size_ranges, emx_mey_label)
+    results["append"] = compare_frames(plates_expected, store.matrix().to_frame())
+    # The QC counts kept by the store are those of a run over the combined plates
+    plates_result = run_pipeline(plates_peaks, df_sample_order, size_ranges, X=X, Y=Y, render=False)
+    expected_qc = plates_result.qc.tables(plates_result.matrix)
+    for title, table in store.qc.tables(store.matrix()).items():
+        results["append"] += [f"{title}: {mismatch}" for mismatch in compare_frames(expected_qc[title], table)]
+    results["bins"] = check_bins(dataset)
+    return results
+
+
+def _run_stages(stages, trace):
+    """Run (name, function) stages in order; return their seconds or tracemalloc peaks."""
+    measures = []
+    if trace:
+        tracemalloc.start()
+    try:
+        for stage, function in stages:
+            if trace:
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            function()
+            seconds = time.perf_counter() - start
+            if trace:
+                _, peak = tracemalloc.get_traced_memory()
+                measures.append((peak - baseline) / 1024 / 1024)
+            else:
+                measures.append(seconds)
+    finally:
+        if trace:
+            tracemalloc.stop()
+    return measures
+
+
+def time_stages(dataset, X=4, Y=8, render=True, memory=True):
+    """
+    Run the pipeline stages one by one and measure each of them.
+
+    Stages are timed in a first pass. tracemalloc slows Python-heavy stages (such as
+    the xlsx rendering) several times, so peak memory is measured in a second, traced
+    pass: the tracemalloc peak of the stage (numpy and pandas buffers included) above
+    the memory held when the stage starts.
+
+    Args:
+        dataset (dict): Tables returned by ``make_dataset``
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        render (bool): Also time the xlsx rendering (default: True)
+        memory (bool): Measure the peak memory of every stage (default: True)
+
+    Returns:
+        list: One dict per stage with the keys stage, seconds and peak_mb (None when
+        ``memory`` is False)
+    """
+    emx_mey_label = f"EM{X}_ME{Y}"
+    df_sample_order, size_ranges = dataset["sample_order"], dataset["size_ranges"]
+    sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+    state = {}
+
+    def stage(name, function):
+        def run():
+            state[name] = function()
+        return name, run
+
+    stages = [
+        stage("load", lambda: load_peaks_export(dataset["peaks"])),
+        stage("index", lambda: SizeRangeIndex(size_ranges)),
+        stage("rename", lambda: rename_samples(state["load"], df_sample_order)),
+        stage("filter", lambda: filter_peaks(state["rename"])),
+        stage("classify", lambda: classify_peaks(state["filter"], state["index"])),
+        stage("matrix", lambda: build_classification_matrix(state["classify"], size_ranges, sample_numbers,
+                                                            emx_mey_label, range_index=state["index"])),
+        stage("fill", lambda: state["matrix"].fill_empty()),
+    ]
+    if render:
+        stages.append(stage("render", lambda: render_workbook(state["fill"])))
+
+    seconds = _run_stages(stages, trace=False)
+    state.clear()
+    peaks = _run_stages(stages, trace=True) if memory else [None] * len(stages)
+    return [{"stage": name, "seconds": stage_seconds, "peak_mb": peak}
+            for (name, _), stage_seconds, peak in zip(stages, seconds, peaks)]
+
+
+def scaling_grid(peaks, samples, bins):
+    """
+    Build the grid of (peaks, samples, bins) points to benchmark.
+
+    Each count is varied on its own with the others at their first value, which keeps
+    the grid linear in the number of values instead of taking every combination.
+
+    Args:
+        peaks (list): Peak counts
+        samples (list): Sample counts
+        bins (list): Bin counts
+
+    Returns:
+        list: Unique (n_peaks, n_samples, n_bins) tuples, in order
+    """
+    points = [(n, samples[0], bins[0]) for n in peaks]
+    points += [(peaks[0], n, bins[0]) for n in samples]
+    points += [(peaks[0], samples[0], n) for n in bins]
+    return list(dict.fromkeys(points))
+
+
+def run_benchmark(points, render=True, memory=True, seed=0):
+    """
+    Benchmark the pipeline over a list of grid points.
+
+    Args:
+        points (list): (n_peaks, n_samples, n_bins) tuples (see ``scaling_grid``)
+        render (bool): Include the xlsx rendering (default: True)
+        memory (bool): Measure peak memory in a second, traced pass (default: True)
+        seed (int): Random seed of the synthetic data (default: 0)
+
+    Returns:
+        list: One dict per point with peaks, samples, bins, stages (see ``time_stages``),
+        total_seconds and peak_mb (None without ``memory``)
+    """
+    results = []
+    for n_peaks, n_samples, n_bins in points:
+        dataset = make_dataset(n_peaks, n_samples, n_bins, seed=seed)
+        stages = time_stages(dataset, render=render, memory=memory)
+        results.append({
+            "peaks": n_peaks,
+            "samples": n_samples,
+            "bins": n_bins,
+            "stages": stages,
+            "total_seconds": sum(stage["seconds"] for stage in stages),
+            "peak_mb": max(stage["peak_mb"] for stage in stages) if memory else None,
+        })
+    return results
+
+
+def format_benchmark(results):
+    """
+    Format benchmark results as a plain-text table.
+
+    Args:
+        results (list): Results returned by ``run_benchmark``
+
+    Returns:
+        str: One line per grid point with the seconds of every stage
+    """
+    if not results:
+        return ""
+    stage_names = [stage["stage"] for stage in results[0]["stages"]]
+    lines = [f"{'peaks':>9} {'samples':>7} {'bins':>6} " + " ".join(f"{name:>9}" for name in stage_names)
+             + f" {'total':>9} {'peak MB':>9}"]
+    for result in results:
+        seconds = " ".join(f"{stage['seconds']:>9.3f}" for stage in result["stages"])
+        peak_mb = "-" if result["peak_mb"] is None else f"{result['peak_mb']:.1f}"
+        lines.append(f"{result['peaks']:>9} {result['samples']:>7} {result['bins']:>6} {seconds} "
+                     f"{result['total_seconds']:>9.3f} {peak_mb:>9}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the gene mapper analysis on synthetic data.")
+    parser.add_argument("--peaks", nargs="+", type=int, default=None, help="Peak counts")
+    parser.add_argument("--samples", nargs="+", type=int, default=None, help="Sample counts")
+    parser.add_argument("--bins", nargs="+", type=int, default=None, help="Size range counts")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--no-render", action="store_true", help="Skip the xlsx rendering stage")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the (slower) traced peak memory pass")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    parser.add_argument("--check", action="store_true",
+                        help="Compare the engines with the loop-based reference instead of timing them "
+                             "(every peaks x samples x bins combination; keep the sizes small)")
+    parser.add_argument("--write", metavar="DIR", default=None,
+                        help="Write the synthetic input files for the first grid point to DIR and exit")
+    parser.add_argument("--text", action="store_true", help="With --write, write a tab-delimited peaks export")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        points = itertools.product(args.peaks or [5000], args.samples or [96], args.bins or [50])
+        failed = False
+        for n_peaks, n_samples, n_bins in points:
+            results = check_equivalence(make_dataset(n_peaks, n_samples, n_bins, seed=args.seed))
+            for engine, mismatches in results.items():
+                status = "EQUAL" if not mismatches else f"{len(mismatches)} DIFFERENCES"
+                print(f"{n_peaks:>9} peaks {n_samples:>5} samples {n_bins:>5} bins  {engine:<10} {status}")
+                for mismatch in mismatches:
+                    print(f"    {mismatch}")
+                failed = failed or bool(mismatches)
+        return 1 if failed else 0
+
+    points = scaling_grid(args.peaks or DEFAULT_PEAKS, args.samples or DEFAULT_SAMPLES, args.bins or DEFAULT_BINS)
+    if args.write:
+        n_peaks, n_samples, n_bins = points[0]
+        path = write_dataset(make_dataset(n_peaks, n_samples, n_bins, seed=args.seed), args.write, text=args.text)
+        print(f"Synthetic input written to: {args.write} (peaks export {path})")
+        return 0
+
+    results = run_benchmark(points, render=not args.no_render, memory=not args.no_memory, seed=args.seed)
+    print(format_benchmark(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,156 @@
+"""
+Automatic bin discovery: propose size ranges from the sizes of the peaks.
+
+Peaks of the same fragment in different samples have nearly the same size, so the
+sorted sizes of all height-filtered peaks form tight groups separated by gaps. The
+sizes are sorted once (O(n log n)) and cut wherever two consecutive sizes are more than
+``max_gap`` apart; groups wider than ``max_width`` (neighbouring fragments merged by a
+run of close peaks) are cut again at their widest internal gaps, and groups still too
+wide, where many peaks leave no gap, at the least dense point of their size histogram.
+Every gap pass is a vectorized O(n) scan of the sorted sizes. Groups seen in fewer than
+``min_samples`` samples are dropped as noise.
+
+The proposed ranges use the Size_ranges format with the A and B columns left blank:
+they classify nothing until they are curated.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Columns of the size ranges file (see Python_genemapper_analysis.SIZE_RANGES_COLUMNS)
+SIZE_RANGES_COLUMNS = ["A", "B", "Lower", "Upper"]
+
+# Bounds are written with this many decimals (sizes have two)
+BOUND_DECIMALS = 3
+
+
+def _group_starts(sizes, max_gap, max_width, min_gap):
+    """
+    Return the start positions of the size groups.
+
+    Args:
+        sizes (np.ndarray): Sorted sizes
+        max_gap (float): Consecutive sizes further apart start a new group
+        max_width (float): Groups wider than this are cut at their widest gaps
+        min_gap (float): Gaps narrower than this never cut a group
+
+    Returns:
+        np.ndarray: Sorted start positions, the first one being 0
+    """
+    gaps = np.diff(sizes)
+    cut = np.concatenate([[True], gaps > max_gap])
+    gap = max_gap / 2
+    while gap >= min_gap:
+        starts = np.flatnonzero(cut)
+        stops = np.append(starts[1:], len(sizes)) - 1
+        wide = sizes[stops] - sizes[starts] > max_width
+        if not wide.any():
+            break
+        # Cut the wide groups (and only them) at gaps wider than the current threshold
+        in_wide = np.repeat(wide, stops - starts + 1)[1:]
+        cut[1:] |= in_wide & (gaps > gap)
+        gap /= 2
+    return np.flatnonzero(cut)
+
+
+def _split_at_valleys(sizes, starts, max_width, resolution):
+    """
+    Cut the groups wider than ``max_width`` at the least dense point of their histogram.
+
+    Args:
+        sizes (np.ndarray): Sorted sizes
+        starts (np.ndarray): Start positions of the groups (see ``_group_starts``)
+        max_width (float): Widest group left uncut
+        resolution (float): Width of the histogram bins
+
+    Returns:
+        np.ndarray: Sorted start positions
+    """
+    stops = np.append(starts[1:], len(sizes))
+    pending = [(start, stop) for start, stop in zip(starts, stops) if sizes[stop - 1] - sizes[start] > max_width]
+    cuts = []
+    while pending:
+        start, stop = pending.pop()
+        segment = sizes[start:stop]
+        counts, edges = np.histogram(segment, np.arange(segment[0], segment[-1] + resolution, resolution))
+        # Only look for the valley between the outer quarters of the group
+        margin = len(counts) // 4
+        if len(counts) - 2 * margin < 1:
+            continue
+        valley = margin + np.argmin(counts[margin:len(counts) - margin])
+        cut = start + np.searchsorted(segment, edges[valley] + resolution / 2)
+        if not start < cut < stop:
+            continue
+        cuts.append(cut)
+        pending.extend(part for part in ((start, cut), (cut, stop))
+                       if sizes[part[1] - 1] - sizes[part[0]] > max_width)
+    return np.unique(np.concatenate([starts, np.asarray(cuts, dtype=starts.dtype)]))
+
+
+def discover_bins(sizes, samples=None, max_gap=0.5, max_width=1.0, min_samples=2, padding=0.1, min_gap=0.02,
+                  resolution=0.05):
+    """
+    Propose size ranges from peak sizes with a sort-and-gap clustering.
+
+    Args:
+        sizes (array-like): Sizes of the height-filtered peaks (NaN are ignored)
+        samples (array-like): Sample of every peak, to count the samples supporting a
+            bin (default: every peak counts as its own sample); peaks without a sample
+            name are ignored
+        max_gap (float): Gap between consecutive sizes that separates two bins (default: 0.5)
+        max_width (float): Widest bin before it is split at its widest gaps (default: 1.0)
+        min_samples (int): Samples a bin must be seen in to be kept (default: 2)
+        padding (float): Margin added on both sides of the observed sizes, reduced so that
+            neighbouring bins never touch (default: 0.1)
+        min_gap (float): Narrowest gap used to split a wide bin (default: 0.02)
+        resolution (float): Histogram bin width used to split wide bins without gaps
+            (default: 0.05)
+
+    Returns:
+        pd.DataFrame: A and B (blank), Lower and Upper of every bin, in size order, plus
+        the Peaks and Samples supporting it
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    known = ~np.isnan(sizes)
+    if samples is not None:
+        # factorize codes missing names as -1, which would collide with the pair keys below
+        samples = np.asarray(samples, dtype=object)
+        known &= pd.notna(samples)
+    sizes = sizes[known]
+    order = np.argsort(sizes, kind="stable")
+    sizes = sizes[order]
+    if samples is None:
+        sample_codes = np.arange(len(sizes))
+    else:
+        sample_codes = pd.factorize(samples[known][order])[0]
+
+    if len(sizes) == 0:
+        return pd.DataFrame(columns=SIZE_RANGES_COLUMNS + ["Peaks", "Samples"])
+
+    starts = _split_at_valleys(sizes, _group_starts(sizes, max_gap, max_width, min_gap), max_width, resolution)
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(sizes))))
+    lower = sizes[starts]
+    upper = np.maximum.reduceat(sizes, starts)
+    peaks = np.bincount(group)
+    # Distinct (group, sample) pairs give the number of samples of every group
+    pairs = np.unique(group.astype(np.int64) * (sample_codes.max() + 1) + sample_codes)
+    n_samples = np.bincount(pairs // (sample_codes.max() + 1), minlength=len(starts))
+
+    keep = n_samples >= min_samples
+    lower, upper, peaks, n_samples = lower[keep], upper[keep], peaks[keep], n_samples[keep]
+
+    # Pad each side by at most 30% of the gap to the neighbouring bin, so that the
+    # rounded bounds of two bins never meet
+    gaps = lower[1:] - upper[:-1]
+    below = np.minimum(padding, 0.3 * np.concatenate([[np.inf], gaps]))
+    above = np.minimum(padding, 0.3 * np.concatenate([gaps, [np.inf]]))
+    scale = 10 ** BOUND_DECIMALS
+    return pd.DataFrame({
+        "A": np.nan,
+        "B": np.nan,
+        "Lower": np.floor((lower - below) * scale) / scale,
+        "Upper": np.ceil((upper + above) * scale) / scale,
+        "Peaks": peaks,
+        "Samples": n_samples,
+    })
@@ -0,0 +1,258 @@
+"""
+On-disk cache of parsed input tables.
+
+Parsing xlsx files dominates the loading time, so cleaned DataFrames are stored in a
+columnar format keyed by the SHA-256 of the file contents plus the parse options. A
+cache hit reads the stored frame instead of the workbook. The cache directory is
+capped in size and the least recently used entries are evicted first.
+
+Entries are written as Parquet when pyarrow is installed, otherwise (or when a frame
+cannot be represented in Parquet) as pickle files.
+
+Environment variables:
+    GENEMAPPER_CACHE: set to 0 to disable the cache
+    GENEMAPPER_CACHE_DIR: cache directory (default: ~/.cache/genemapper)
+    GENEMAPPER_CACHE_MAX_MB: size cap in megabytes (default: 1024)
+
+Usage:
+    python genemapper_cache.py info
+    python genemapper_cache.py clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+# Bump when the cleaning applied by the loaders changes, to invalidate old entries
+CACHE_VERSION = 2
+
+DEFAULT_MAX_MB = 1024
+ENTRY_SUFFIXES = (".parquet", ".pkl")
+
+
+def cache_enabled():
+    """Return False when the cache is disabled through GENEMAPPER_CACHE=0."""
+    return os.environ.get("GENEMAPPER_CACHE", "1").lower() not in ("0", "false", "no", "off")
+
+
+def default_cache_dir():
+    """Return the cache directory from GENEMAPPER_CACHE_DIR or ~/.cache/genemapper."""
+    return os.environ.get("GENEMAPPER_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "genemapper")
+
+
+def default_max_bytes():
+    """Return the cache size cap from GENEMAPPER_CACHE_MAX_MB."""
+    return int(float(os.environ.get("GENEMAPPER_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024)
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Compute the SHA-256 of a file's contents.
+
+    Args:
+        path (str): File path
+        block_size (int): Read size in bytes
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(digest, kind, options=None):
+    """
+    Build the cache key of a parsed file.
+
+    Args:
+        digest (str): SHA-256 of the file contents
+        kind (str): Name of the loader (e.g. "peaks")
+        options (dict): Parse options that change the resulting frame
+
+    Returns:
+        str: Hex key
+    """
+    payload = json.dumps({"digest": digest, "kind": kind, "options": options or {}, "version": CACHE_VERSION},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _entry_paths(cache_dir, key):
+    return [os.path.join(cache_dir, key + suffix) for suffix in ENTRY_SUFFIXES]
+
+
+def _write_entry(cache_dir, key, df):
+    """Store a frame as Parquet, falling back to pickle."""
+    os.makedirs(cache_dir, exist_ok=True)
+    parquet_path, pickle_path = _entry_paths(cache_dir, key)
+    tmp_path = os.path.join(cache_dir, f".{key}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, parquet_path)
+        return
+    except Exception:
+        # pyarrow missing, or columns with mixed types that Parquet cannot store
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, pickle_path)
+
+
+def _read_entry(cache_dir, key):
+    """Return the cached frame for a key, or None on a miss."""
+    parquet_path, pickle_path = _entry_paths(cache_dir, key)
+    for path, reader in ((parquet_path, pd.read_parquet), (pickle_path, pd.read_pickle)):
+        if os.path.exists(path):
+            try:
+                df = reader(path)
+            except Exception:
+                # Corrupt or unreadable entry: drop it and parse again
+                os.remove(path)
+                return None
+            # Touch the entry so that eviction is least-recently-used
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return df
+    return None
+
+
+def cached_read(path, loader, kind, options=None, cache_dir=None, max_bytes=None):
+    """
+    Load a file through the cache.
+
+    Args:
+        path (str): File to load
+        loader (callable): Function taking the path and returning the cleaned DataFrame
+        kind (str): Name of the loader, part of the cache key
+        options (dict): Parse options, part of the cache key
+        cache_dir (str): Cache directory (default: ``default_cache_dir()``)
+        max_bytes (int): Size cap of the cache (default: ``default_max_bytes()``)
+
+    Returns:
+        pd.DataFrame: Cleaned frame
+    """
+    if not cache_enabled():
+        return loader(path)
+    cache_dir = cache_dir or default_cache_dir()
+
+    key = cache_key(file_digest(path), kind, options)
+    df = _read_entry(cache_dir, key)
+    if df is not None:
+        return df
+
+    df = loader(path)
+    try:
+        _write_entry(cache_dir, key, df)
+        evict(cache_dir, max_bytes)
+    except OSError:
+        # A read-only or full cache directory must not break the analysis
+        pass
+    return df
+
+
+def _entries(cache_dir):
+    """List (path, size, mtime) of the cache entries."""
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(ENTRY_SUFFIXES):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Evicted by a concurrent process
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """
+    Remove least recently used entries until the cache fits in ``max_bytes``.
+
+    Args:
+        cache_dir (str): Cache directory (default: ``default_cache_dir()``)
+        max_bytes (int): Size cap (default: ``default_max_bytes()``)
+
+    Returns:
+        int: Number of entries removed
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    max_bytes = default_max_bytes() if max_bytes is None else max_bytes
+    entries = sorted(_entries(cache_dir), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_cache(cache_dir=None):
+    """
+    Remove every cache entry.
+
+    Args:
+        cache_dir (str): Cache directory (default: ``default_cache_dir()``)
+
+    Returns:
+        int: Number of entries removed
+    """
+    return evict(cache_dir, max_bytes=0)
+
+
+def cache_info(cache_dir=None):
+    """
+    Describe the cache contents.
+
+    Args:
+        cache_dir (str): Cache directory (default: ``default_cache_dir()``)
+
+    Returns:
+        dict: directory, entries, bytes and max_bytes
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    entries = _entries(cache_dir)
+    return {
+        "directory": cache_dir,
+        "entries": len(entries),
+        "bytes": sum(size for _, size, _ in entries),
+        "max_bytes": default_max_bytes(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the gene mapper parsed-input cache.")
+    parser.add_argument("command", choices=["info", "clear"])
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache directory (default: $GENEMAPPER_CACHE_DIR or ~/.cache/genemapper)")
+    args = parser.parse_args(argv)
+
+    if args.command == "clear":
+        print(f"Removed {clear_cache(args.cache_dir)} cache entries")
+    else:
+        info = cache_info(args.cache_dir)
+        print(f"Cache directory: {info['directory']}")
+        print(f"Entries: {info['entries']}")
+        print(f"Size: {info['bytes'] / 1024 / 1024:.1f} MB of {info['max_bytes'] / 1024 / 1024:.0f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
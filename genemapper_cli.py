@@ -0,0 +1,242 @@
+"""
+Command-line entry point of the gene mapper analysis.
+
+Subcommands:
+    run    Analyze one EMX_MEY combination of an input directory
+    append Add a new sample plate to a panel's matrix store (see genemapper_append.py)
+    bins   Propose size ranges from the peaks of an export (see genemapper_bins.py)
+    sweep  Band calls and occupancy for many height thresholds and tolerances in one
+           pass (see genemapper_sweep.py)
+    export Presence/absence matrix of several panels as .npy or Parquet with a label
+           sidecar (see genemapper_export.py)
+    study  One workbook with a sheet per panel and a combined sheet (see
+           genemapper_study.py)
+    batch  Run the jobs of a CSV/YAML manifest in parallel, skipping jobs whose outputs
+           are current and resuming an interrupted manifest
+    bench  Synthetic-data benchmark and equivalence check (see genemapper_benchmark.py)
+
+Usage:
+    python genemapper_cli.py run INPUT_DIR [--config DIR] [--output DIR] [-X 4] [-Y 8]
+    python genemapper_cli.py append INPUT_DIR NEW_PEAKS_FILE [--output DIR] [-X 4] [-Y 8]
+    python genemapper_cli.py bins INPUT_DIR [-X 4] [-Y 8] [--max-gap 0.5] [--output FILE] [--force]
+    python genemapper_cli.py sweep INPUT_DIR [-X 4] [-Y 8] [--thresholds 100 160 200] [--tolerances 0 0.25]
+    python genemapper_cli.py export OUTPUT.npy SOURCE [SOURCE ...]
+    python genemapper_cli.py study STUDY.xlsx SOURCE [SOURCE ...] [--workers N]
+    python genemapper_cli.py batch MANIFEST [--workers N] [--force] [--log-file FILE]
+    python genemapper_cli.py bench [--peaks 10000 100000] [--check]
+"""
+
+import argparse
+import logging
+import os
+
+
+def _configure_logging(verbosity, log_file=None):
+    """Send the "genemapper" log to stderr (and a file) at a level set by -v flags."""
+    level = {0: logging.WARNING, 1: logging.INFO}.get(verbosity, logging.DEBUG)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(message)s", handlers=handlers)
+
+
+def _run(args):
+    from Python_genemapper_analysis import gene_mapper_analysis
+
+    output = gene_mapper_analysis(args.input, args.config or args.input, args.output or args.input, X=args.X,
+                                  Y=args.Y, chunksize=args.chunksize, write_intermediate=not args.no_intermediate,
+                                  report_path=args.report, profile_path=args.profile,
+                                  height_threshold=args.height_threshold, qc=not args.no_qc)
+    print(output)
+    return 0
+
+
+def _append(args):
+    from genemapper_append import append_plate
+    from genemapper_report import RunReport
+
+    run_report = RunReport(f"EM{args.X}_ME{args.Y}")
+    output = append_plate(args.input, args.peaks, args.output, X=args.X, Y=args.Y, store_path=args.store,
+                          run_report=run_report, height_threshold=args.height_threshold, qc=not args.no_qc)
+    if args.report:
+        run_report.write(args.report)
+    print(output)
+    return 0
+
+
+def _bins(args):
+    from Python_genemapper_analysis import find_peaks_export, propose_size_ranges
+
+    emx_mey_label = f"EM{args.X}_ME{args.Y}"
+    output = args.output or os.path.join(args.input, f"Size_ranges_{emx_mey_label}.xlsx")
+    if os.path.exists(output) and not args.force:
+        raise SystemExit(f"{output} exists; use --force to replace it or --output to write elsewhere")
+    size_ranges = propose_size_ranges(find_peaks_export(args.input, emx_mey_label), chunksize=args.chunksize,
+                                      max_gap=args.max_gap, max_width=args.max_width,
+                                      min_samples=args.min_samples, padding=args.padding,
+                                      height_threshold=args.height_threshold)
+    size_ranges.to_excel(output, index=False)
+    print(f"{len(size_ranges)} proposed size ranges written to {output}")
+    return 0
+
+
+def _sweep(args):
+    from Python_genemapper_analysis import find_peaks_export
+    from genemapper_registry import sample_order_source
+    from genemapper_sweep import sweep_parameters
+
+    emx_mey_label = f"EM{args.X}_ME{args.Y}"
+    table = sweep_parameters(find_peaks_export(args.input, emx_mey_label),
+                             sample_order_source(os.path.join(args.input, "Hyssop_sample_numbers_Genemapper.xlsx")),
+                             os.path.join(args.input, f"Size_ranges_{emx_mey_label}.xlsx"),
+                             thresholds=args.thresholds, tolerances=args.tolerances)
+    if args.output:
+        table.to_csv(args.output, index=False)
+    print(table.to_string(index=False))
+    return 0
+
+
+def _export(args):
+    from genemapper_export import labels_path, write_presence
+
+    index = write_presence(args.sources, args.output)
+    print(f"{index['shape'][0]} samples x {index['shape'][1]} loci of {len(index['panels'])} panels written to "
+          f"{args.output} (labels: {labels_path(args.output)})")
+    return 0
+
+
+def _study(args):
+    from genemapper_study import write_study_workbook
+
+    titles = write_study_workbook(args.sources, args.output, max_workers=args.workers)
+    print(f"{len(titles)} panels written to {args.output}")
+    return 0
+
+
+def _batch(args):
+    from genemapper_batch import format_summary, run_manifest
+
+    results = run_manifest(args.manifest, max_workers=args.workers, state_path=args.state, force=args.force,
+                           report_path=args.report)
+    logging.getLogger("genemapper").info("Manifest %s finished:\n%s", args.manifest, format_summary(results))
+    print(format_summary(results))
+    return 1 if any(result["error"] is not None for result in results) else 0
+
+
+def _bench(args):
+    import genemapper_benchmark
+
+    return genemapper_benchmark.main(args.bench_args)
+
+
+def _add_height_threshold(parser):
+    from Python_genemapper_analysis import HEIGHT_THRESHOLD
+
+    parser.add_argument("--height-threshold", type=float, default=HEIGHT_THRESHOLD,
+                        help=f"Peaks must be higher than this to be called (default: {HEIGHT_THRESHOLD})")
+
+
+def build_parser():
+    """Return the argument parser of the command-line interface."""
+    parser = argparse.ArgumentParser(prog="genemapper", description="Gene mapper analysis.")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Log progress (-v) or also the matrix (-vv)")
+    parser.add_argument("--log-file", default=None, help="Also write the log to this file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Analyze one EMX_MEY combination")
+    run.add_argument("input", help="Input files directory")
+    run.add_argument("--config", default=None, help="Config files directory (default: the input directory)")
+    run.add_argument("--output", default=None, help="Output files directory (default: the input directory)")
+    run.add_argument("-X", type=int, default=4, help="X of EMX_MEY (default: 4)")
+    run.add_argument("-Y", type=int, default=8, help="Y of EMX_MEY (default: 8)")
+    run.add_argument("--chunksize", type=int, default=None,
+                     help="Stream the peaks export in chunks of this many rows (bounded memory)")
+    run.add_argument("--no-intermediate", action="store_true",
+                     help="Do not write Exported_table_changed_sample_names_EMX_MEY.xlsx")
+    run.add_argument("--report", default=None, help="JSON run report file or directory")
+    run.add_argument("--profile", default=None, help="cProfile statistics dump file")
+    run.add_argument("--no-qc", action="store_true", help="Do not add the QC sheets to the output workbook")
+    _add_height_threshold(run)
+    run.set_defaults(handler=_run)
+
+    append = subparsers.add_parser("append", help="Add a new sample plate to a panel's matrix store")
+    append.add_argument("input", help="Input files directory (sample order and size ranges)")
+    append.add_argument("peaks", help="Peaks export of the new plate")
+    append.add_argument("--output", default=None, help="Output files directory (default: the input directory)")
+    append.add_argument("-X", type=int, default=4, help="X of EMX_MEY (default: 4)")
+    append.add_argument("-Y", type=int, default=8, help="Y of EMX_MEY (default: 8)")
+    append.add_argument("--store", default=None,
+                        help="Matrix store (default: matrix_store_EMX_MEY.npz in the output directory)")
+    append.add_argument("--report", default=None, help="JSON run report file or directory")
+    append.add_argument("--no-qc", action="store_true",
+                        help="Do not add the QC sheets to the output workbook (the store then drops its QC counts)")
+    _add_height_threshold(append)
+    append.set_defaults(handler=_append)
+
+    bins = subparsers.add_parser("bins", help="Propose size ranges from the peaks of an export")
+    bins.add_argument("input", help="Input files directory")
+    bins.add_argument("-X", type=int, default=4, help="X of EMX_MEY (default: 4)")
+    bins.add_argument("-Y", type=int, default=8, help="Y of EMX_MEY (default: 8)")
+    bins.add_argument("--output", default=None, help="Size ranges file (default: Size_ranges_EMX_MEY.xlsx in the "
+                                                     "input directory)")
+    bins.add_argument("--force", action="store_true", help="Replace an existing size ranges file")
+    bins.add_argument("--max-gap", type=float, default=0.5, help="Gap between sizes that separates bins (default: 0.5)")
+    bins.add_argument("--max-width", type=float, default=1.0, help="Widest bin before it is split (default: 1.0)")
+    bins.add_argument("--min-samples", type=int, default=2, help="Samples a bin must be seen in (default: 2)")
+    bins.add_argument("--padding", type=float, default=0.1, help="Margin around the observed sizes (default: 0.1)")
+    bins.add_argument("--chunksize", type=int, default=None, help="Read the peaks export in chunks of this many rows")
+    _add_height_threshold(bins)
+    bins.set_defaults(handler=_bins)
+
+    sweep = subparsers.add_parser("sweep", help="Evaluate many height thresholds and size range tolerances")
+    sweep.add_argument("input", help="Input files directory")
+    sweep.add_argument("-X", type=int, default=4, help="X of EMX_MEY (default: 4)")
+    sweep.add_argument("-Y", type=int, default=8, help="Y of EMX_MEY (default: 8)")
+    sweep.add_argument("--thresholds", type=float, nargs="+", default=list(range(50, 501, 25)),
+                       help="Height thresholds (default: 50 to 500 by 25)")
+    sweep.add_argument("--tolerances", type=float, nargs="+", default=[0.0],
+                       help="Widening of the size ranges on both sides (default: 0)")
+    sweep.add_argument("--output", default=None, help="Also write the table to this CSV file")
+    sweep.set_defaults(handler=_sweep)
+
+    export = subparsers.add_parser("export", help="Write a presence/absence matrix of several panels")
+    export.add_argument("output", help="Output file (.npy, memory-mappable, or .parquet, requires pyarrow)")
+    export.add_argument("sources", nargs="+",
+                        help="Output workbooks, matrix stores (.npz) or directories of output workbooks")
+    export.set_defaults(handler=_export)
+
+    study = subparsers.add_parser("study", help="Write one workbook with a sheet per panel and a combined sheet")
+    study.add_argument("output", help="Study workbook (.xlsx)")
+    study.add_argument("sources", nargs="+",
+                       help="Output workbooks, matrix stores (.npz) or directories of output workbooks")
+    study.add_argument("--workers", type=int, default=None,
+                       help="Number of worker processes loading the panels (default: one per CPU)")
+    study.set_defaults(handler=_study)
+
+    batch = subparsers.add_parser("batch", help="Run the jobs of a CSV or YAML manifest")
+    batch.add_argument("manifest", help="Manifest file (.csv, .yaml or .yml)")
+    batch.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    batch.add_argument("--state", default=None, help="State file (default: MANIFEST.state.json)")
+    batch.add_argument("--force", action="store_true", help="Rerun jobs whose outputs are current")
+    batch.add_argument("--report", default=None, help="Directory for the JSON run report of every job")
+    batch.set_defaults(handler=_batch)
+
+    bench = subparsers.add_parser("bench", help="Benchmark on synthetic data (arguments of genemapper_benchmark.py)",
+                                  add_help=False)
+    bench.set_defaults(handler=_bench)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    # The bench arguments are parsed by genemapper_benchmark
+    args, args.bench_args = parser.parse_known_args(argv)
+    if args.bench_args and args.command != "bench":
+        parser.error(f"unrecognized arguments: {' '.join(args.bench_args)}")
+    _configure_logging(args.verbose, args.log_file)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,157 @@
+"""
+Thin client of the gene mapper daemon (genemapper_daemon.py).
+
+Only the standard library is imported, so a call starts in a few tens of milliseconds
+instead of paying for pandas, numpy and openpyxl. Requests and responses are single
+lines of JSON sent over the daemon's Unix socket.
+
+Environment variables:
+    GENEMAPPER_SOCKET: daemon socket path (default: ~/.cache/genemapper/daemon.sock)
+
+Usage:
+    python genemapper_client.py run INPUT_DIR [--config DIR] [--output DIR] [-X 4] [-Y 8] [--fallback]
+    python genemapper_client.py ping
+    python genemapper_client.py shutdown
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+class DaemonUnavailable(Exception):
+    """Raised when no daemon listens on the socket."""
+
+
+def default_socket_path():
+    """Return the socket path from GENEMAPPER_SOCKET or ~/.cache/genemapper/daemon.sock."""
+    return os.environ.get("GENEMAPPER_SOCKET") or os.path.join(os.path.expanduser("~"), ".cache", "genemapper",
+                                                               "daemon.sock")
+
+
+def request(message, socket_path=None, timeout=None):
+    """
+    Send one request to the daemon and wait for its response.
+
+    Args:
+        message (dict): Request with a "command" key ("run", "ping", "stats" or "shutdown")
+        socket_path (str): Daemon socket (default: ``default_socket_path()``)
+        timeout (float): Seconds to wait for the response (default: no limit)
+
+    Returns:
+        dict: Response; failed requests have an "error" key
+
+    Raises:
+        DaemonUnavailable: When the daemon is not running
+    """
+    socket_path = socket_path or default_socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise DaemonUnavailable(f"no gene mapper daemon on {socket_path} ({e.strerror})")
+        sock.settimeout(timeout)
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        return {"error": "the daemon closed the connection"}
+    return json.loads(line)
+
+
+def run_analysis(input_file_path, config_file_path=None, output_file_path=None, X=4, Y=8, chunksize=None,
+                 write_intermediate=True, socket_path=None, height_threshold=None):
+    """
+    Run ``gene_mapper_analysis`` in the daemon.
+
+    Args:
+        input_file_path (str): Path to the input files directory
+        config_file_path (str): Path to the config files directory (default: the input directory)
+        output_file_path (str): Path to the output files directory (default: the input directory)
+        X (int): X value for EMX_MEY format (default: 4)
+        Y (int): Y value for EMX_MEY format (default: 8)
+        chunksize (int): Stream the peaks export in chunks of this many rows (optional)
+        write_intermediate (bool): Write the renamed peaks table (default: True)
+        socket_path (str): Daemon socket (default: ``default_socket_path()``)
+        height_threshold (float): Peaks must be strictly higher than this (default: the
+            analysis default, 160)
+
+    Returns:
+        str: Path to the created output file
+
+    Raises:
+        DaemonUnavailable: When the daemon is not running
+        RuntimeError: When the analysis failed
+    """
+    # The daemon has its own working directory
+    input_file_path = os.path.abspath(input_file_path)
+    response = request({
+        "command": "run",
+        "input": input_file_path,
+        "config": os.path.abspath(config_file_path or input_file_path),
+        "output": os.path.abspath(output_file_path or input_file_path),
+        "X": X,
+        "Y": Y,
+        "chunksize": chunksize,
+        "write_intermediate": write_intermediate,
+        "height_threshold": height_threshold,
+    }, socket_path)
+    if response.get("error"):
+        raise RuntimeError(response["error"])
+    return response["output"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Submit gene mapper analyses to the warm daemon.")
+    parser.add_argument("--socket", default=None, help="Daemon socket (default: $GENEMAPPER_SOCKET)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="Analyze one EMX_MEY combination")
+    run.add_argument("input", help="Input files directory")
+    run.add_argument("--config", default=None, help="Config files directory (default: the input directory)")
+    run.add_argument("--output", default=None, help="Output files directory (default: the input directory)")
+    run.add_argument("-X", type=int, default=4, help="X of EMX_MEY (default: 4)")
+    run.add_argument("-Y", type=int, default=8, help="Y of EMX_MEY (default: 8)")
+    run.add_argument("--chunksize", type=int, default=None, help="Stream the peaks export in chunks of this many rows")
+    run.add_argument("--no-intermediate", action="store_true",
+                     help="Do not write Exported_table_changed_sample_names_EMX_MEY.xlsx")
+    run.add_argument("--height-threshold", type=float, default=None,
+                     help="Peaks must be higher than this to be called (default: 160)")
+    run.add_argument("--fallback", action="store_true",
+                     help="Run the analysis in this process when the daemon is not running")
+    subparsers.add_parser("ping", help="Check that the daemon is running")
+    subparsers.add_parser("stats", help="Show the daemon's counters")
+    subparsers.add_parser("shutdown", help="Stop the daemon")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "run":
+            print(run_analysis(args.input, args.config, args.output, X=args.X, Y=args.Y, chunksize=args.chunksize,
+                               write_intermediate=not args.no_intermediate, socket_path=args.socket,
+                               height_threshold=args.height_threshold))
+        else:
+            print(json.dumps(request({"command": args.command}, args.socket)))
+    except DaemonUnavailable as e:
+        if args.command == "run" and args.fallback:
+            from Python_genemapper_analysis import HEIGHT_THRESHOLD, gene_mapper_analysis
+
+            height_threshold = HEIGHT_THRESHOLD if args.height_threshold is None else args.height_threshold
+            print(gene_mapper_analysis(args.input, args.config or args.input, args.output or args.input, X=args.X,
+                                       Y=args.Y, chunksize=args.chunksize,
+                                       write_intermediate=not args.no_intermediate,
+                                       height_threshold=height_threshold))
+            return 0
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+    except RuntimeError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
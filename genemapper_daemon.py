@@ -0,0 +1,232 @@
+"""
+Warm gene mapper daemon.
+
+A long-running process that has already imported pandas, numpy and openpyxl and keeps
+the sample registries of the sample order workbooks open (see genemapper_registry.py),
+listening on a Unix socket. Scripts submit analyses with the thin client in
+genemapper_client.py, which starts without importing any of these libraries, so a LIMS
+hook calling the analysis hundreds of times only pays the startup cost once. Size
+ranges and peaks exports go through the parsed-input cache as in a normal run.
+
+Each connection carries one JSON request line and receives one JSON response line.
+Analyses run on a thread per connection, at most ``workers`` at a time. The socket is
+only accessible to the user running the daemon. Unix sockets are not available on
+Windows.
+
+Usage:
+    python genemapper_daemon.py [--socket PATH] [--workers N] [-v]
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from Python_genemapper_analysis import HEIGHT_THRESHOLD, gene_mapper_analysis, load_sample_order
+from genemapper_client import default_socket_path
+from genemapper_registry import SampleRegistry, registry_enabled
+from genemapper_report import logger
+
+
+SAMPLE_ORDER_FILE = "Hyssop_sample_numbers_Genemapper.xlsx"
+
+
+class SampleOrderMemo:
+    """
+    Sample orders kept in memory, reloaded when their workbook changes.
+
+    Workbooks are served through their sample registry, whose lookup dict stays in
+    memory between runs; with the registry disabled the parsed tables are kept instead.
+    Each workbook has a lock held while it is checked and reloaded, so concurrent
+    requests never reload it twice or see a registry half reloaded, and a slow reload
+    does not hold up the requests of other workbooks.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _workbook_lock(self, key):
+        """Return the lock of the workbook at absolute path ``key``."""
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, path):
+        """
+        Return the parsed sample order workbook at ``path``.
+
+        Args:
+            path (str): Path of Hyssop_sample_numbers_Genemapper.xlsx
+
+        Returns:
+            SampleRegistry or pd.DataFrame: Up-to-date registry, or the sample order table
+        """
+        key = os.path.abspath(path)
+        with self._workbook_lock(key):
+            if registry_enabled():
+                registry = self._tables.get(key)
+                if registry is None:
+                    registry = SampleRegistry(path)
+                    with self._lock:
+                        self._tables[key] = registry
+                registry.refresh()
+                # Load the sample order and lookup dict of a reimported workbook before
+                # releasing the lock
+                registry.mapping()
+                return registry
+            stat = os.stat(path)
+            version = (key, stat.st_size, stat.st_mtime_ns)
+            table = self._tables.get(version)
+            if table is None:
+                table = load_sample_order(path)
+                with self._lock:
+                    # Drop the tables of older versions of the same file
+                    for old in [k for k in self._tables if isinstance(k, tuple) and k[0] == key]:
+                        del self._tables[old]
+                    self._tables[version] = table
+            return table
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        message = {}
+        try:
+            message = json.loads(line)
+            response = self.server.dispatch(message)
+        except Exception as e:
+            logger.exception("daemon request failed")
+            response = {"error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        if message.get("command") == "shutdown":
+            # Stop after answering; shutdown() waits for serve_forever(), which runs on another thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+
+class GeneMapperDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server running analyses in a warm interpreter.
+
+    Args:
+        socket_path (str): Path of the socket to listen on
+        workers (int): Maximum number of analyses running at the same time
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=2):
+        self.socket_path = socket_path
+        self.sample_orders = SampleOrderMemo()
+        self.started = time.time()
+        self.counts = {"runs": 0, "failures": 0}
+        self._slots = threading.BoundedSemaphore(workers)
+        self._counts_lock = threading.Lock()
+        _remove_stale_socket(socket_path)
+        directory = os.path.dirname(socket_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Create the socket readable by its owner only
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def dispatch(self, message):
+        """
+        Handle one request.
+
+        Args:
+            message (dict): Request with a "command" key
+
+        Returns:
+            dict: Response
+        """
+        command = message.get("command")
+        if command == "ping":
+            return {"status": "ok", "pid": os.getpid()}
+        if command == "stats":
+            with self._counts_lock:
+                counts = dict(self.counts)
+            return {**counts, "pid": os.getpid(), "uptime": time.time() - self.started}
+        if command == "shutdown":
+            return {"status": "stopping"}
+        if command == "run":
+            return self._run(message)
+        return {"error": f"unknown command {command!r}"}
+
+    def _run(self, message):
+        start = time.perf_counter()
+        input_file_path = message["input"]
+        height_threshold = message.get("height_threshold")
+        if height_threshold is None:
+            height_threshold = HEIGHT_THRESHOLD
+        with self._slots:
+            try:
+                df_sample_order = self.sample_orders.get(os.path.join(input_file_path, SAMPLE_ORDER_FILE))
+                output = gene_mapper_analysis(input_file_path, message.get("config") or input_file_path,
+                                              message.get("output") or input_file_path, X=int(message.get("X", 4)),
+                                              Y=int(message.get("Y", 8)), df_sample_order=df_sample_order,
+                                              chunksize=message.get("chunksize"),
+                                              write_intermediate=message.get("write_intermediate", True),
+                                              height_threshold=float(height_threshold))
+            except Exception as e:
+                with self._counts_lock:
+                    self.counts["failures"] += 1
+                logger.info("daemon run of %s failed: %s", input_file_path, e)
+                return {"error": f"{type(e).__name__}: {e}"}
+        with self._counts_lock:
+            self.counts["runs"] += 1
+        return {"output": output, "seconds": time.perf_counter() - start}
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_stale_socket(socket_path):
+    """Remove a socket file left by a daemon that died; refuse to replace a live one."""
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"a gene mapper daemon is already listening on {socket_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the warm gene mapper daemon.")
+    parser.add_argument("--socket", default=None, help="Socket path (default: $GENEMAPPER_SOCKET)")
+    parser.add_argument("--workers", type=int, default=2, help="Analyses running at the same time (default: 2)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every analysis")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    socket_path = args.socket or default_socket_path()
+    with GeneMapperDaemon(socket_path, workers=args.workers) as server:
+        print(f"Gene mapper daemon listening on {socket_path} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,229 @@
+"""
+Machine-readable presence/absence export of classification matrices.
+
+The coloured workbooks are meant for people; downstream population-genetics scripts
+need a samples x loci matrix of 0/1 calls. This module concatenates the matrices of
+several panels (each size range of each panel is one locus) into a single int8 array:
+
+    1   band: "b" or "c" cell (a peak in a classifying size range)
+    0   no band: "a" or "d" cell (filled)
+    -1  no call: empty cell (size range without any call, or sample missing from the panel)
+
+The array is written as ``.npy``, which ``np.load(path, mmap_mode="r")`` maps without
+copying, or as Parquet (one column per locus; requires pyarrow). A JSON sidecar next to
+it (``<name>.labels.json``) lists the samples (rows) and loci (columns). The ``.npy``
+file is filled panel by panel through a memory map, so writing it never holds more
+than one panel in memory.
+
+Matrices can be given as ClassificationMatrix objects, output workbooks
+(Sample_Size_Matrix_Colored_EM{X}_ME{Y}.xlsx) or matrix stores (see genemapper_append.py).
+
+Usage:
+    python genemapper_cli.py export study.npy "Output files" [MORE_WORKBOOKS_OR_DIRS ...]
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from genemapper_matrix import CLASS_CODES, ClassificationMatrix, encode_classification
+
+
+PRESENT = 1
+ABSENT = 0
+MISSING = -1
+
+# Presence value of every matrix code (code 0 is an empty cell)
+PRESENCE_OF_CODE = np.full(max(CLASS_CODES.values()) + 1, MISSING, dtype=np.int8)
+PRESENCE_OF_CODE[CLASS_CODES["b"]] = PRESENCE_OF_CODE[CLASS_CODES["c"]] = PRESENT
+PRESENCE_OF_CODE[CLASS_CODES["a"]] = PRESENCE_OF_CODE[CLASS_CODES["d"]] = ABSENT
+
+OUTPUT_PATTERN = "Sample_Size_Matrix_Colored_EM*_ME*.xlsx"
+
+
+def labels_path(path):
+    """Return the path of the sidecar label index of an export."""
+    return f"{os.path.splitext(path)[0]}.labels.json"
+
+
+def presence_codes(codes):
+    """
+    Convert matrix codes to presence values.
+
+    Args:
+        codes (np.ndarray): int8 codes of a filled matrix
+
+    Returns:
+        np.ndarray: int8 array of PRESENT, ABSENT or MISSING, same shape
+    """
+    return PRESENCE_OF_CODE[codes]
+
+
+def read_matrix_workbook(path):
+    """
+    Read the matrix sheet of an output workbook back into a matrix.
+
+    Args:
+        path (str): Sample_Size_Matrix_Colored_EM{X}_ME{Y}.xlsx written by ``render_workbook``
+
+    Returns:
+        ClassificationMatrix: Filled matrix
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        # Sample columns are the labelled ones after EMX_MEY and Size_Range (spacers are empty)
+        positions = [i for i, value in enumerate(header) if i >= 2 and value not in (None, "")]
+        emx_mey, size_range, letters = [], [], []
+        for row in rows:
+            row = tuple(row) + (None,) * (len(header) - len(row))
+            emx_mey.append(row[0])
+            size_range.append(row[1])
+            letters.append([row[i] for i in positions])
+    finally:
+        wb.close()
+    codes = encode_classification(np.asarray(letters, dtype=object).ravel()).reshape(len(letters), len(positions))
+    return ClassificationMatrix(codes, np.asarray(emx_mey, dtype=object), size_range, [header[i] for i in positions])
+
+
+def load_matrix(source):
+    """
+    Load a panel matrix.
+
+    Args:
+        source (ClassificationMatrix or str): Matrix, output workbook (.xlsx) or matrix
+            store (.npz)
+
+    Returns:
+        ClassificationMatrix: Filled matrix
+    """
+    if isinstance(source, ClassificationMatrix):
+        return source
+    if str(source).lower().endswith(".npz"):
+        from genemapper_append import MatrixStore
+
+        return MatrixStore.load(source).matrix()
+    return read_matrix_workbook(source)
+
+
+def expand_sources(sources):
+    """
+    Replace directories by the output workbooks they contain.
+
+    Args:
+        sources (list): Matrices, files or directories
+
+    Returns:
+        list: Matrices and files, directories expanded in sorted order
+    """
+    expanded = []
+    for source in sources:
+        if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+            expanded.extend(sorted(glob.glob(os.path.join(source, OUTPUT_PATTERN))))
+        else:
+            expanded.append(source)
+    return expanded
+
+
+def write_presence(sources, path):
+    """
+    Concatenate panels into one samples x loci presence/absence matrix.
+
+    Samples are the union of the samples of all panels, in order of first appearance;
+    loci are the size ranges of every panel, panel after panel.
+
+    Args:
+        sources (list): ClassificationMatrix objects, output workbooks, matrix stores or
+            directories of output workbooks
+        path (str): Destination, .npy (memory-mappable) or .parquet (requires pyarrow)
+
+    Returns:
+        dict: The sidecar label index, also written to ``labels_path(path)``
+    """
+    sources = expand_sources(sources)
+    if not sources:
+        raise ValueError("no panel matrix to export")
+    parquet = path.lower().endswith(".parquet")
+    if parquet:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise ImportError("pyarrow is required for the Parquet export; use a .npy path instead") from e
+
+    # First pass over the labels only, to size the output
+    samples, loci = [], []
+    for source in sources:
+        matrix = load_matrix(source)
+        samples.extend(matrix.samples)
+        loci.extend({"panel": str(panel), "size_range": str(size_range)}
+                    for panel, size_range in zip(matrix.emx_mey, matrix.size_range))
+        del matrix
+    samples = pd.unique(pd.Series(samples, dtype=object)).tolist()
+    sample_index = pd.Index(samples)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if parquet:
+        array = np.full((len(samples), len(loci)), MISSING, dtype=np.int8)
+    else:
+        array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int8, shape=(len(samples), len(loci)))
+        array[:] = MISSING
+    start = 0
+    for source in sources:
+        # Workbooks are read a second time rather than kept in memory
+        matrix = load_matrix(source)
+        rows = sample_index.get_indexer(matrix.samples)
+        array[rows, start:start + matrix.shape[0]] = presence_codes(matrix.codes).T
+        start += matrix.shape[0]
+        del matrix
+
+    if parquet:
+        columns = [f"{locus['panel']}:{locus['size_range']}" for locus in loci]
+        pd.DataFrame(array, columns=columns).to_parquet(tmp_path, index=False)
+    else:
+        array.flush()
+        del array
+    os.replace(tmp_path, path)
+
+    index = {
+        "data": os.path.basename(path),
+        "shape": [len(samples), len(loci)],
+        "dtype": "int8",
+        "coding": {str(PRESENT): "band (b/c)", str(ABSENT): "no band (a/d)", str(MISSING): "no call"},
+        "panels": pd.unique(pd.Series([locus["panel"] for locus in loci], dtype=object)).tolist(),
+        "samples": samples,
+        "loci": loci,
+    }
+    with open(labels_path(path), "w") as f:
+        json.dump(index, f, indent=1, default=str)
+    return index
+
+
+def load_presence(path, mmap_mode="r"):
+    """
+    Load a presence/absence export and its labels.
+
+    Args:
+        path (str): .npy or .parquet file written by ``write_presence``
+        mmap_mode (str): Memory-map mode of .npy files (default: "r"; None reads into memory)
+
+    Returns:
+        tuple: (array, samples, loci) with the int8 samples x loci array, the sample labels
+        and a DataFrame of the panel and size range of every locus
+    """
+    with open(labels_path(path)) as f:
+        index = json.load(f)
+    if path.lower().endswith(".parquet"):
+        array = pd.read_parquet(path).to_numpy(dtype=np.int8)
+    else:
+        array = np.load(path, mmap_mode=mmap_mode)
+    return array, index["samples"], pd.DataFrame(index["loci"], columns=["panel", "size_range"])
+
+
+def empty_loci(array):
+    """Return a mask of the loci without any band or no-band call (e.g. unclassified ranges)."""
+    return ~(np.asarray(array) != MISSING).any(axis=0)
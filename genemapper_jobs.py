@@ -0,0 +1,173 @@
+"""
+Background analysis jobs.
+
+Analyses are submitted to a bounded thread pool and run outside the caller's thread
+(e.g. the Streamlit script thread), so a large panel does not freeze the interface
+and several users share a fixed number of workers. Each job receives a progress
+callback (see ``Python_genemapper_analysis.report_progress``) that records the current
+stage and checks for cancellation. Cancellation is cooperative: a running job stops at
+its next stage boundary, a queued job never starts.
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled."""
+
+
+class Job:
+    """
+    Handle of a submitted analysis.
+
+    Attributes:
+        job_id (str): Identifier, unique within its JobManager
+        stage (str): Last stage reported by the job ("queued" before it starts)
+        fraction (float): Completed share of the work, from 0 to 1
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stage = "queued"
+        self.fraction = 0.0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancel_event = threading.Event()
+
+    def progress(self, stage, fraction):
+        """
+        Progress callback handed to the job function.
+
+        Args:
+            stage (str): Stage being started
+            fraction (float): Completed share of the work
+
+        Raises:
+            JobCancelled: When the job has been cancelled
+        """
+        if self._cancel_event.is_set():
+            raise JobCancelled(f"job {self.job_id} cancelled")
+        self.stage = stage
+        self.fraction = fraction
+
+    def cancel(self):
+        """Request cancellation; a queued job is dropped, a running one stops at its next stage."""
+        self._cancel_event.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def status(self):
+        """str: One of queued, running, done, failed or cancelled."""
+        if self.future is None or not (self.future.running() or self.future.done()):
+            return "queued"
+        if not self.future.done():
+            return "running"
+        if self.future.cancelled() or isinstance(self.future.exception(), JobCancelled):
+            return "cancelled"
+        return "failed" if self.future.exception() is not None else "done"
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    @property
+    def elapsed(self):
+        """float: Seconds spent running (so far), 0 while queued."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def result(self):
+        """
+        Return the value of the finished job.
+
+        Raises:
+            JobCancelled: When the job was cancelled
+            Exception: The error raised by the job function
+        """
+        try:
+            return self.future.result()
+        except CancelledError:
+            raise JobCancelled(f"job {self.job_id} cancelled")
+
+    def error(self):
+        """Return the exception of a failed job, or None."""
+        if self.status != "failed":
+            return None
+        return self.future.exception()
+
+
+class JobManager:
+    """
+    Bounded pool of background analysis jobs.
+
+    Args:
+        max_workers (int): Number of jobs running at once (default: 2)
+        max_jobs (int): Number of job handles kept for polling; the oldest finished jobs
+            are forgotten first (default: 50)
+    """
+
+    def __init__(self, max_workers=2, max_jobs=50):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="genemapper-job")
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Submit ``function(*args, progress_callback=..., **kwargs)`` as a job.
+
+        Args:
+            function (callable): Job function; must accept a ``progress_callback`` keyword
+                (e.g. ``run_pipeline``)
+
+        Returns:
+            Job: Handle to poll, cancel or collect the job
+        """
+        with self._lock:
+            job = Job(str(next(self._ids)))
+            self.jobs[job.job_id] = job
+            self._forget_finished()
+
+        def run():
+            job.started = time.time()
+            try:
+                # A job cancelled while queued stops before doing any work
+                job.progress("started", 0.0)
+                return function(*args, progress_callback=job.progress, **kwargs)
+            finally:
+                job.finished = time.time()
+
+        job.future = self.executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        """Return the job with this id, or None when unknown or forgotten."""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _forget_finished(self):
+        """Drop the oldest finished jobs beyond max_jobs."""
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id].done():
+                del self.jobs[job_id]
+
+    def shutdown(self, cancel=True):
+        """Stop the pool, cancelling pending and running jobs by default."""
+        if cancel:
+            for job in list(self.jobs.values()):
+                job.cancel()
+        self.executor.shutdown(wait=True)
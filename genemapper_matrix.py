@@ -0,0 +1,163 @@
+"""
+Compact classification matrix shared by the gene mapper analysis stages.
+
+The size range x sample grid is kept as int8 codes instead of a DataFrame of Python
+strings. Letters are only produced at the output boundary (``to_frame`` or the
+workbook writer), so the build, fill and render stages all work on the same array.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Integer codes of the matrix cells; code 0 is an empty cell
+CODE_EMPTY = 0
+CLASS_CODES = {"a": 1, "b": 2, "c": 3, "d": 4}
+CODE_LETTERS = np.array([np.nan, "a", "b", "c", "d"], dtype=object)
+
+
+def encode_classification(values):
+    """
+    Convert classification letters to matrix codes.
+
+    Args:
+        values (array-like): Letters "a", "b", "c", "d" or NaN
+
+    Returns:
+        np.ndarray: int8 codes, CODE_EMPTY where the value is not a known letter
+    """
+    values = np.asarray(values, dtype=object)
+    codes = np.full(len(values), CODE_EMPTY, dtype=np.int8)
+    for letter, code in CLASS_CODES.items():
+        codes[values == letter] = code
+    return codes
+
+
+def row_fill_codes(codes):
+    """
+    Return the code that completes the empty cells of every row.
+
+    A single OR-reduction of per-cell bit flags tells which letters each row contains:
+    rows containing a "c" are completed with "a", otherwise rows containing a "b" with
+    "d", other rows stay empty.
+
+    Args:
+        codes (np.ndarray): int8 code matrix of shape (ranges, samples)
+
+    Returns:
+        np.ndarray: int8 fill code of every row
+    """
+    row_bits = np.bitwise_or.reduce(np.left_shift(np.uint8(1), codes.view(np.uint8)), axis=1)
+    has_c = (row_bits & (1 << CLASS_CODES["c"])) != 0
+    has_b = (row_bits & (1 << CLASS_CODES["b"])) != 0
+    return np.where(has_c, CLASS_CODES["a"], np.where(has_b, CLASS_CODES["d"], CODE_EMPTY)).astype(np.int8)
+
+
+def fill_empty_cells(codes):
+    """
+    Complete the empty cells of a code matrix in place.
+
+    Rows containing a "c" get their empty cells set to "a"; otherwise rows containing a
+    "b" get "d" (see ``row_fill_codes``). One masked add fills the gaps (empty cells are
+    code 0).
+
+    Args:
+        codes (np.ndarray): int8 code matrix of shape (ranges, samples)
+
+    Returns:
+        np.ndarray: The same array, filled
+    """
+    fill = row_fill_codes(codes)
+    empty = (codes == CODE_EMPTY).view(np.int8)
+    empty *= fill[:, None]
+    codes += empty
+    return codes
+
+
+class ClassificationMatrix:
+    """
+    Size range x sample grid of int8 classification codes with its labels.
+
+    The codes array is used as given (no copy), so every stage that receives the matrix
+    sees the same memory.
+
+    Args:
+        codes (np.ndarray): int8 codes of shape (ranges, samples)
+        emx_mey (str or array-like): EMX_MEY label of every row (a single label is repeated)
+        size_range (array-like): Size_Range label of every row
+        samples (list): Sample numbers labelling the columns
+    """
+
+    def __init__(self, codes, emx_mey, size_range, samples):
+        self.codes = codes
+        self.size_range = np.asarray(size_range, dtype=object)
+        if isinstance(emx_mey, str):
+            emx_mey = np.full(len(self.size_range), emx_mey, dtype=object)
+        self.emx_mey = np.asarray(emx_mey, dtype=object)
+        self.samples = list(samples)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def fill_empty(self):
+        """
+        Complete empty cells with "a"/"d" in place (see ``fill_empty_cells``).
+
+        Returns:
+            ClassificationMatrix: self
+        """
+        fill_empty_cells(self.codes)
+        return self
+
+    def letters(self):
+        """
+        Decode the grid to letters.
+
+        Returns:
+            np.ndarray: object array of "a", "b", "c", "d" or NaN
+        """
+        return CODE_LETTERS[self.codes]
+
+    def to_frame(self):
+        """
+        Convert the matrix to the DataFrame layout of the output workbook.
+
+        Returns:
+            pd.DataFrame: EMX_MEY and Size_Range columns followed by one column per sample
+        """
+        df_matrix = pd.DataFrame(self.letters(), columns=self.samples)
+        df_matrix.insert(0, 'Size_Range', self.size_range)
+        df_matrix.insert(0, 'EMX_MEY', self.emx_mey)
+        return df_matrix
+
+    def to_sparse(self):
+        """
+        Return the codes as a scipy CSR matrix, for panels where most cells are empty.
+
+        Requires scipy. Empty cells are the implicit zeros of the sparse matrix.
+
+        Returns:
+            scipy.sparse.csr_matrix: int8 sparse codes
+        """
+        try:
+            from scipy import sparse
+        except ImportError as e:
+            raise ImportError("scipy is required for the sparse matrix representation") from e
+        return sparse.csr_matrix(self.codes)
+
+    @classmethod
+    def from_sparse(cls, sparse_codes, emx_mey, size_range, samples):
+        """
+        Build a matrix from sparse codes (see ``to_sparse``).
+
+        Args:
+            sparse_codes (scipy.sparse.spmatrix): int8 sparse codes
+            emx_mey (str or array-like): EMX_MEY label of every row
+            size_range (array-like): Size_Range label of every row
+            samples (list): Sample numbers labelling the columns
+
+        Returns:
+            ClassificationMatrix: Dense matrix
+        """
+        return cls(sparse_codes.toarray().astype(np.int8, copy=False), emx_mey, size_range, samples)
@@ -0,0 +1,295 @@
+"""
+Per-bin and per-sample QC statistics collected while the matrix is built.
+
+The classification stages drop information that matters for curation: peaks below the
+height threshold or outside every size range, several peaks of one sample in the same
+size range (only the last one sets the cell), overlapping size ranges and A/B rows that
+match neither classification rule. ``PeakQC`` records it as the peaks go through the
+pipeline: per-sample peak counts at each filtering stage, and the number of peaks of
+every (range, sample) cell set by ``peak_hits``, counted while it drops the duplicates.
+Only the cells hit are kept, as sorted (cell, count) int32 arrays, so the QC state grows
+with the hits rather than with the matrix, and chunks of a streamed export add up at a cost
+proportional to their hits.
+
+The tables are written as extra sheets of the output workbook and the summary goes
+into the run report.
+"""
+
+import numpy as np
+import pandas as pd
+
+from genemapper_matrix import CLASS_CODES
+
+
+# Worksheet titles of the QC tables, in workbook order
+QC_SHEETS = ("QC_summary", "QC_bins", "QC_samples")
+
+
+def overlap_counts(lower, upper):
+    """
+    Count, for every size range, the other ranges it overlaps (bounds included).
+
+    Args:
+        lower (np.ndarray): Lower bounds (NaN for invalid ranges)
+        upper (np.ndarray): Upper bounds (NaN for invalid ranges)
+
+    Returns:
+        np.ndarray: Number of overlapping ranges, 0 for invalid ranges
+    """
+    valid = ~np.isnan(lower) & ~np.isnan(upper) & (lower <= upper)
+    sorted_lower = np.sort(lower[valid])
+    sorted_upper = np.sort(upper[valid])
+    counts = np.zeros(len(lower), dtype=np.int64)
+    # Ranges starting before this one ends, minus those ending before it starts, minus itself
+    counts[valid] = (np.searchsorted(sorted_lower, upper[valid], side="right")
+                     - np.searchsorted(sorted_upper, lower[valid], side="left") - 1)
+    return counts
+
+
+class PeakQC:
+    """
+    QC counts of one run, accumulated stage by stage and chunk by chunk.
+
+    Args:
+        size_ranges (pd.DataFrame): Size ranges table
+        sample_numbers (list): Sample numbers labelling the matrix columns
+        range_index (SizeRangeIndex): Index over ``size_ranges``
+    """
+
+    # Per-sample peak counts, in pipeline order
+    PEAK_STAGES = ("peaks", "above_threshold", "in_range")
+
+    # Number of chunk counts kept per stage (and of chunk cell counts) before they are summed
+    MERGE_EVERY = 64
+
+    def __init__(self, size_ranges, sample_numbers, range_index):
+        self.size_ranges = size_ranges
+        self.sample_numbers = list(sample_numbers)
+        self.range_class = range_index.range_class
+        self._stage_counts = {stage: [] for stage in self.PEAK_STAGES}
+        n_cells = len(size_ranges) * max(len(self.sample_numbers), 1)
+        self._cell_dtype = np.int32 if n_cells <= np.iinfo(np.int32).max else np.int64
+        self._cell_counts = []
+
+    def count_peaks(self, stage, df_peaks):
+        """
+        Add the peaks per sample of a pipeline stage.
+
+        Args:
+            stage (str): One of PEAK_STAGES
+            df_peaks (pd.DataFrame): Peaks of that stage, with renamed Sample File Name
+        """
+        counts = df_peaks['Sample File Name'].value_counts(sort=False)
+        pending = self._stage_counts[stage]
+        pending.append(counts[counts > 0])
+        # Chunk counts are summed in batches rather than aligned one chunk at a time
+        if len(pending) >= self.MERGE_EVERY:
+            pending[:] = [self._merge(pending)]
+
+    def add_sample_counts(self, sample_counts):
+        """
+        Add peaks per sample counted elsewhere, e.g. those of earlier plates.
+
+        Args:
+            sample_counts (dict): Stage -> peaks per sample (a Series indexed by sample),
+                for some or all of PEAK_STAGES
+        """
+        for stage, counts in sample_counts.items():
+            self._stage_counts[stage].append(counts[counts > 0])
+
+    @staticmethod
+    def _merge(counts):
+        """Sum per-sample count Series, keeping the samples in order of first appearance."""
+        if not counts:
+            return pd.Series(dtype=np.int64)
+        return pd.concat(counts).groupby(level=0, sort=False).sum().astype(np.int64)
+
+    @property
+    def sample_counts(self):
+        """Dict of stage -> peaks per sample (a Series indexed by sample), see PEAK_STAGES."""
+        for pending in self._stage_counts.values():
+            pending[:] = [self._merge(pending)]
+        return {stage: pending[0] for stage, pending in self._stage_counts.items()}
+
+    def count_hits(self, cells, counts):
+        """
+        Add the peaks of the (range, sample) cells hit by a chunk, duplicates included.
+
+        Args:
+            cells (np.ndarray): Distinct flat cell indices (range * samples + column)
+            counts (np.ndarray): Number of peaks of every cell
+        """
+        if len(cells):
+            self._cell_counts.append((np.asarray(cells, dtype=self._cell_dtype), np.asarray(counts, dtype=np.int32)))
+            if len(self._cell_counts) >= self.MERGE_EVERY:
+                self._cell_counts[:] = [self._merge_cells(self._cell_counts)]
+
+    def add_cell_counts(self, range_ids, columns, counts, samples):
+        """
+        Add cell counts collected over another sample layout, e.g. those of earlier plates.
+
+        Args:
+            range_ids (np.ndarray): Size range of every cell
+            columns (np.ndarray): Position in ``samples`` of the sample of every cell
+            counts (np.ndarray): Number of peaks of every cell
+            samples (list): Sample numbers of that layout; cells of samples missing from
+                this run's sample numbers are dropped
+        """
+        columns = pd.Index(self.sample_numbers).get_indexer(pd.Index(samples, dtype=object))[columns]
+        kept = columns >= 0
+        cells = range_ids[kept].astype(self._cell_dtype) * max(len(self.sample_numbers), 1) + columns[kept]
+        order = np.argsort(cells)
+        self.count_hits(cells[order], counts[kept][order])
+
+    @staticmethod
+    def _merge_cells(cell_counts):
+        """Sum (cells, counts) pairs into one pair of sorted distinct cells and their counts."""
+        if len(cell_counts) == 1:
+            return cell_counts[0]
+        cells, inverse = np.unique(np.concatenate([cells for cells, _ in cell_counts]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in cell_counts]),
+                             minlength=len(cells))
+        return cells, counts.astype(np.int32)
+
+    @property
+    def cell_hits(self):
+        """Tuple of (range_ids, columns, counts) arrays of the cells hit, in cell order."""
+        if self._cell_counts:
+            self._cell_counts[:] = [self._merge_cells(self._cell_counts)]
+            cells, counts = self._cell_counts[0]
+        else:
+            cells = counts = np.zeros(0, dtype=np.int32)
+        range_ids, columns = np.divmod(cells, max(len(self.sample_numbers), 1))
+        return range_ids, columns, counts
+
+    @staticmethod
+    def _hit_stats(keys, counts, length):
+        """Return the hits, cells hit, cells with several peaks and dropped peaks per key."""
+        hits = np.bincount(keys, weights=counts, minlength=length).astype(np.int64)
+        cells = np.bincount(keys, minlength=length)
+        multi_peak = np.bincount(keys[counts > 1], minlength=length)
+        return hits, cells, multi_peak, hits - cells
+
+    def bins(self, matrix):
+        """
+        Return the per-bin table.
+
+        Args:
+            matrix (ClassificationMatrix): Matrix of the run
+
+        Returns:
+            pd.DataFrame: One row per size range with its bounds, A/B, rule ("c", "b" or
+            "none"), overlapping ranges, hits, samples, samples with several peaks,
+            dropped peaks and "c"/"b" calls
+        """
+        lower = pd.to_numeric(self.size_ranges['Lower'], errors='coerce').to_numpy(dtype=float)
+        upper = pd.to_numeric(self.size_ranges['Upper'], errors='coerce').to_numpy(dtype=float)
+        range_ids, _, counts = self.cell_hits
+        hits, samples, multi_peak, dropped = self._hit_stats(range_ids, counts, len(self.size_ranges))
+        return pd.DataFrame({
+            "Size_Range": matrix.size_range,
+            "A": self.size_ranges['A'].to_numpy(),
+            "B": self.size_ranges['B'].to_numpy(),
+            "Lower": lower,
+            "Upper": upper,
+            "rule": pd.Series(self.range_class, dtype=object).fillna("none").to_numpy(),
+            "valid_bounds": ~np.isnan(lower) & ~np.isnan(upper) & (lower <= upper),
+            "overlapping_ranges": overlap_counts(lower, upper),
+            "hits": hits,
+            "samples": samples,
+            "multi_peak_samples": multi_peak,
+            "dropped_peaks": dropped,
+            "c_calls": (matrix.codes == CLASS_CODES["c"]).sum(axis=1),
+            "b_calls": (matrix.codes == CLASS_CODES["b"]).sum(axis=1),
+        })
+
+    def samples(self, matrix):
+        """
+        Return the per-sample table.
+
+        Samples of the sample order come first, in column order, followed by the sample
+        names missing from it (their peaks never reach the matrix).
+
+        Args:
+            matrix (ClassificationMatrix): Matrix of the run
+
+        Returns:
+            pd.DataFrame: One row per sample with its peak counts at each stage, peaks
+            outside every range, size ranges hit, ranges with several peaks, dropped
+            peaks and "c"/"b" calls
+        """
+        sample_counts = self.sample_counts
+        # Every sample of a later stage has peaks: align the stages on the "peaks" index
+        samples = sample_counts["peaks"].index
+        counts = pd.DataFrame({stage: sample_counts[stage].reindex(samples, fill_value=0).to_numpy(dtype=np.int64)
+                               for stage in self.PEAK_STAGES}, index=samples)
+        known = pd.Index(self.sample_numbers)
+        extra = counts.index[known.get_indexer(counts.index) < 0]
+        counts = counts.reindex(known.append(pd.Index(extra, dtype=object)), fill_value=0)
+
+        n_extra = len(extra)
+        _, columns, cell_counts = self.cell_hits
+        _, ranges_hit, multi_peak, dropped = self._hit_stats(columns, cell_counts, len(self.sample_numbers))
+
+        def per_sample(values):
+            return np.concatenate([values, np.zeros(n_extra, dtype=np.int64)])
+
+        return pd.DataFrame({
+            "sample": np.array(self.sample_numbers + list(extra), dtype=object),
+            "in_sample_order": np.arange(len(counts)) < len(known),
+            "peaks": counts["peaks"].to_numpy(),
+            "above_threshold": counts["above_threshold"].to_numpy(),
+            "out_of_range": (counts["above_threshold"] - counts["in_range"]).to_numpy(),
+            "ranges_hit": per_sample(ranges_hit),
+            "multi_peak_ranges": per_sample(multi_peak),
+            "dropped_peaks": per_sample(dropped),
+            "c_calls": per_sample((matrix.codes == CLASS_CODES["c"]).sum(axis=0)),
+            "b_calls": per_sample((matrix.codes == CLASS_CODES["b"]).sum(axis=0)),
+        })
+
+    def summary(self, matrix):
+        """
+        Return the run totals.
+
+        Args:
+            matrix (ClassificationMatrix): Matrix of the run
+
+        Returns:
+            dict: Peak counts at each stage, peaks dropped as duplicates, cells with
+            several peaks, overlapping range pairs, ranges matching no rule (and their
+            hits), invalid ranges and samples missing from the sample order
+        """
+        sample_counts = self.sample_counts
+        totals = {stage: int(counts.sum()) for stage, counts in sample_counts.items()}
+        bins = self.bins(matrix)
+        unclassified = bins["rule"] == "none"
+        known = pd.Index(self.sample_numbers)
+        unmapped = sample_counts["peaks"].index[known.get_indexer(sample_counts["peaks"].index) < 0]
+        return {
+            "peaks": totals["peaks"],
+            "below_threshold": totals["peaks"] - totals["above_threshold"],
+            "out_of_range": totals["above_threshold"] - totals["in_range"],
+            "in_range": totals["in_range"],
+            "dropped_duplicate_peaks": int(bins["dropped_peaks"].sum()),
+            "multi_peak_cells": int(bins["multi_peak_samples"].sum()),
+            "overlapping_range_pairs": int(bins["overlapping_ranges"].sum() // 2),
+            "unclassified_ranges": int(unclassified.sum()),
+            "hits_in_unclassified_ranges": int(bins.loc[unclassified, "hits"].sum()),
+            "invalid_ranges": int((~bins["valid_bounds"]).sum()),
+            "unmapped_samples": int(len(unmapped)),
+            "peaks_of_unmapped_samples": int(sample_counts["peaks"][unmapped].sum()),
+        }
+
+    def tables(self, matrix):
+        """
+        Return the QC tables, keyed by their worksheet title (see QC_SHEETS).
+
+        Args:
+            matrix (ClassificationMatrix): Matrix of the run
+
+        Returns:
+            dict: QC_summary (metric, value), QC_bins and QC_samples DataFrames
+        """
+        summary = self.summary(matrix)
+        return dict(zip(QC_SHEETS, (pd.DataFrame({"metric": list(summary), "value": list(summary.values())}),
+                                    self.bins(matrix), self.samples(matrix))))
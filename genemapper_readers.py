@@ -0,0 +1,190 @@
+"""
+Input readers for GeneMapper peak exports.
+
+GeneMapper can export peaks as tab-delimited text as well as xlsx; text loads many times
+faster. The readers detect the format from the file extension, read only the columns
+the analysis uses and store them with compact dtypes (categorical sample names, float32
+sizes, the smallest integer type that holds the heights).
+"""
+
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+
+# Columns of the peaks export used by the analysis
+PEAKS_COLUMNS = ["Sample File Name", "Size", "Height"]
+
+# Supported peaks export extensions, in lookup order (fastest formats first)
+PEAKS_EXTENSIONS = (".txt", ".tsv", ".csv", ".xlsx", ".xls")
+
+TEXT_SEPARATORS = {".txt": "\t", ".tsv": "\t", ".csv": ","}
+
+
+def excel_engine():
+    """
+    Return the fastest available xlsx engine for ``pd.read_excel``.
+
+    python-calamine (pandas >= 2.2) parses xlsx several times faster than openpyxl.
+
+    Returns:
+        str or None: "calamine" when installed, None for the pandas default
+    """
+    if importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return None
+
+
+def find_peaks_export(input_file_path, emx_mey_label):
+    """
+    Locate the peaks export of a primer combination in any supported format.
+
+    Args:
+        input_file_path (str): Path to the input files directory
+        emx_mey_label (str): EMX_MEY label, e.g. "EM4_ME8"
+
+    Returns:
+        str: Path of the first {EMX_MEY}_peaks_exported.* file found, or the .xlsx path
+        when none exists (so that the error names the usual file)
+    """
+    base = os.path.join(input_file_path, f"{emx_mey_label}_peaks_exported")
+    for extension in PEAKS_EXTENSIONS:
+        if os.path.exists(base + extension):
+            return base + extension
+    return base + ".xlsx"
+
+
+def source_extension(source):
+    """
+    Return the lower-case file extension of a path or of a named file object.
+
+    Args:
+        source (str or file-like): Path, or file object with a ``name`` (e.g. an upload)
+
+    Returns:
+        str: Extension such as ".txt", ".xlsx" when it cannot be determined
+    """
+    name = os.fspath(source) if isinstance(source, (str, os.PathLike)) else getattr(source, "name", "")
+    return os.path.splitext(str(name))[1].lower() or ".xlsx"
+
+
+def _usecols(columns):
+    if columns is None:
+        return None
+    wanted = set(columns)
+    return lambda name: str(name).strip() in wanted
+
+
+def read_peaks_table(path, columns=PEAKS_COLUMNS):
+    """
+    Read the needed columns of a peaks export (.txt/.tsv/.csv/.xlsx/.xls).
+
+    Column names are matched after stripping surrounding whitespace.
+
+    Args:
+        path (str or file-like): Peaks export; file objects are typed by their ``name``
+        columns (list): Columns to keep (default: PEAKS_COLUMNS; None keeps every column)
+
+    Returns:
+        pd.DataFrame: Raw (not yet compacted) columns
+    """
+    extension = source_extension(path)
+    if extension in TEXT_SEPARATORS:
+        return pd.read_csv(path, sep=TEXT_SEPARATORS[extension], usecols=_usecols(columns),
+                           encoding_errors="replace", low_memory=False)
+    return pd.read_excel(path, usecols=_usecols(columns), engine=excel_engine())
+
+
+def compact_peaks(df_peaks):
+    """
+    Clean a peaks table and convert it to compact dtypes.
+
+    Column names are stripped, spaces are removed from the sample file names (stored
+    as categorical), Size becomes float32 and Height the smallest integer type that
+    holds it (float32 when heights are missing).
+
+    Args:
+        df_peaks (pd.DataFrame): Peaks table as read from the export
+
+    Returns:
+        pd.DataFrame: Cleaned peaks table
+    """
+    df_peaks.columns = df_peaks.columns.str.strip()
+    names = df_peaks['Sample File Name']
+    if not isinstance(names.dtype, pd.CategoricalDtype):
+        names = names.astype('category')
+    # De-space the (few) categories instead of every row; the trailing NaN is picked
+    # by the -1 code of missing names
+    categories = pd.Series(names.cat.categories).str.replace(' ', '', regex=False).to_numpy(dtype=object)
+    categories = np.append(categories, np.nan)
+    df_peaks['Sample File Name'] = pd.Categorical(categories[names.cat.codes.to_numpy()])
+    df_peaks['Size'] = pd.to_numeric(df_peaks['Size'], errors='coerce').astype(np.float32)
+    height = pd.to_numeric(df_peaks['Height'], errors='coerce')
+    if height.isna().any():
+        df_peaks['Height'] = height.astype(np.float32)
+    else:
+        df_peaks['Height'] = pd.to_numeric(height, downcast='integer')
+    return df_peaks
+
+
+def read_peaks_export(path, columns=PEAKS_COLUMNS):
+    """
+    Read and clean a peaks export.
+
+    Args:
+        path (str or file-like): Peaks export
+        columns (list): Columns to keep (default: PEAKS_COLUMNS; None keeps every column)
+
+    Returns:
+        pd.DataFrame: Cleaned peaks table with compact dtypes
+    """
+    return compact_peaks(read_peaks_table(path, columns=columns))
+
+
+def _iter_workbook_rows(path, columns, chunksize):
+    """Yield DataFrames of ``chunksize`` rows from the first sheet of a workbook."""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        wanted = _usecols(columns) or (lambda name: True)
+        keep = [i for i, name in enumerate(header) if name is not None and wanted(name)]
+        names = [header[i] for i in keep]
+        batch = []
+        for row in rows:
+            batch.append([row[i] if i < len(row) else None for i in keep])
+            if len(batch) == chunksize:
+                yield pd.DataFrame(batch, columns=names)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=names)
+    finally:
+        wb.close()
+
+
+def iter_peaks_export(path, chunksize=100000, columns=PEAKS_COLUMNS):
+    """
+    Read and clean a peaks export in chunks of rows.
+
+    Text exports are read with ``pd.read_csv(chunksize=...)`` and workbooks through a
+    read-only openpyxl worksheet, so only one chunk is held in memory at a time.
+
+    Args:
+        path (str or file-like): Peaks export
+        chunksize (int): Rows per chunk (default: 100000)
+        columns (list): Columns to keep (default: PEAKS_COLUMNS; None keeps every column)
+
+    Yields:
+        pd.DataFrame: Cleaned chunks with compact dtypes, in file order
+    """
+    extension = source_extension(path)
+    if extension in TEXT_SEPARATORS:
+        chunks = pd.read_csv(path, sep=TEXT_SEPARATORS[extension], usecols=_usecols(columns),
+                             encoding_errors="replace", low_memory=False, chunksize=chunksize)
+    else:
+        chunks = _iter_workbook_rows(path, columns, chunksize)
+    for chunk in chunks:
+        yield compact_peaks(chunk)
@@ -0,0 +1,322 @@
+"""
+Persistent sample registry: sample name -> sample number mapping shared across runs.
+
+The sample order workbook (Hyssop_sample_numbers_Genemapper.xlsx) is imported once into
+an indexed SQLite database and imported again only when the file changes (its size and
+modification time are checked first, then its SHA-256). Runs and batch workers read the
+sample order from the database instead of parsing the workbook, and lookups go through
+an in-memory dict built once per process. Every row of the workbook is stored as it is
+written, so the analysis sees the same table as when it reads the workbook: names are
+matched against the (de-spaced) sample file names of the peaks exports exactly as in
+the workbook, and repeated names keep all their rows.
+
+Sample names that a run could not map are recorded per panel, so the names missing from
+the workbook can be listed for a whole study at once.
+
+Environment variables:
+    GENEMAPPER_REGISTRY: registry database path, or 0 to read the workbook directly
+        (default: sample_registry.sqlite in the cache directory of genemapper_cache)
+
+Usage:
+    python genemapper_registry.py import WORKBOOK [--db PATH]
+    python genemapper_registry.py unmapped WORKBOOK [--db PATH]
+    python genemapper_registry.py lookup WORKBOOK NAME [NAME ...] [--db PATH]
+"""
+
+import argparse
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from genemapper_cache import default_cache_dir, file_digest
+from genemapper_readers import excel_engine
+
+
+# Bump when a change to import_workbook invalidates the samples stored by earlier versions
+REGISTRY_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workbooks (
+    workbook TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT, imported TEXT);
+CREATE TABLE IF NOT EXISTS samples (
+    workbook TEXT, position INTEGER, name TEXT, sample_number, PRIMARY KEY (workbook, position));
+CREATE INDEX IF NOT EXISTS samples_by_name ON samples (workbook, name);
+CREATE TABLE IF NOT EXISTS unmapped (
+    workbook TEXT, panel TEXT, name TEXT, runs INTEGER, last_seen TEXT, PRIMARY KEY (workbook, panel, name));
+"""
+
+
+def normalize_name(name):
+    """Return a sample file name without spaces, as the peaks exports are cleaned (None stays None)."""
+    return None if pd.isna(name) else str(name).replace(" ", "")
+
+
+def registry_enabled():
+    """Return False when the registry is disabled through GENEMAPPER_REGISTRY=0."""
+    return os.environ.get("GENEMAPPER_REGISTRY", "").lower() not in ("0", "false", "no", "off")
+
+
+def default_registry_path():
+    """Return the registry database from GENEMAPPER_REGISTRY or the cache directory."""
+    return os.environ.get("GENEMAPPER_REGISTRY") or os.path.join(default_cache_dir(), "sample_registry.sqlite")
+
+
+def _python_value(value):
+    """Convert numpy scalars and NaN to values sqlite3 can store."""
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class SampleRegistry:
+    """
+    Sample order of one workbook, stored in a registry database.
+
+    Registries are picklable (by path), so they can be handed to worker processes;
+    every process opens its own connections and builds its own lookup dict.
+
+    Args:
+        workbook_path (str): Path of the sample order workbook
+        db_path (str): Registry database (default: ``default_registry_path()``)
+    """
+
+    def __init__(self, workbook_path, db_path=None):
+        self.workbook_path = os.path.abspath(workbook_path)
+        self.db_path = db_path or default_registry_path()
+        self._sample_order = None
+        self._mapping = None
+
+    def __getstate__(self):
+        return {"workbook_path": self.workbook_path, "db_path": self.db_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["workbook_path"], state["db_path"])
+
+    def _connect(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def refresh(self):
+        """
+        Import the workbook when it changed since the last import.
+
+        Returns:
+            bool: True when the workbook was (re)imported
+        """
+        stat = os.stat(self.workbook_path)
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT size, mtime_ns, digest FROM workbooks WHERE workbook = ?",
+                                     (self.workbook_path,)).fetchone()
+        finally:
+            connection.close()
+        current = row is not None and str(row[2]).startswith(f"v{REGISTRY_VERSION}:")
+        if current and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return False
+        digest = f"v{REGISTRY_VERSION}:{file_digest(self.workbook_path)}"
+        if row is not None and row[2] == digest:
+            # Touched but unchanged: only remember the new modification time
+            self._record_workbook(stat, digest)
+            return False
+        self.import_workbook(stat=stat, digest=digest)
+        return True
+
+    def _record_workbook(self, stat, digest, connection=None):
+        own_connection = connection is None
+        connection = connection or self._connect()
+        try:
+            connection.execute("INSERT OR REPLACE INTO workbooks VALUES (?, ?, ?, ?, ?)",
+                               (self.workbook_path, stat.st_size, stat.st_mtime_ns, digest,
+                                datetime.datetime.now().isoformat(timespec="seconds")))
+            if own_connection:
+                connection.commit()
+        finally:
+            if own_connection:
+                connection.close()
+
+    def import_workbook(self, stat=None, digest=None):
+        """
+        Import the workbook, replacing the samples stored for it.
+
+        Raises:
+            ValueError: When the workbook lacks the Default_name/Sample_number columns
+        """
+        stat = stat or os.stat(self.workbook_path)
+        digest = digest or f"v{REGISTRY_VERSION}:{file_digest(self.workbook_path)}"
+        df = pd.read_excel(self.workbook_path, engine=excel_engine())
+        missing = {"Default_name", "Sample_number"} - set(df.columns)
+        if missing:
+            raise ValueError(f"{self.workbook_path} has no column {', '.join(sorted(missing))}")
+
+        rows = [(self.workbook_path, position, _python_value(name), _python_value(number))
+                for position, (name, number) in enumerate(zip(df["Default_name"], df["Sample_number"]))]
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM samples WHERE workbook = ?", (self.workbook_path,))
+                connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", rows)
+                self._record_workbook(stat, digest, connection)
+        finally:
+            connection.close()
+        self._sample_order = self._mapping = None
+
+    def sample_order(self):
+        """
+        Return the sample order table, in workbook order.
+
+        Returns:
+            pd.DataFrame: Default_name and Sample_number columns, one row per workbook row
+        """
+        if self._sample_order is None:
+            connection = self._connect()
+            try:
+                rows = connection.execute("SELECT name, sample_number FROM samples WHERE workbook = ? "
+                                          "ORDER BY position", (self.workbook_path,)).fetchall()
+            finally:
+                connection.close()
+            self._sample_order = pd.DataFrame(rows, columns=["Default_name", "Sample_number"])
+        return self._sample_order
+
+    def mapping(self):
+        """Return the dict of sample name -> sample number (the first row of a repeated name)."""
+        if self._mapping is None:
+            df = self.sample_order().dropna(subset=["Default_name"])
+            df = df[~df["Default_name"].duplicated()]
+            self._mapping = dict(zip(df["Default_name"], df["Sample_number"]))
+        return self._mapping
+
+    def lookup(self, names):
+        """
+        Map sample names to sample numbers.
+
+        Args:
+            names (iterable): Sample file names (spaces are removed, as in the peaks exports)
+
+        Returns:
+            list: Sample number of every name, None for unknown names
+        """
+        mapping = self.mapping()
+        return [mapping.get(normalize_name(name)) for name in names]
+
+    def unmapped(self, names):
+        """
+        Return the names missing from the registry.
+
+        Args:
+            names (iterable): Sample names
+
+        Returns:
+            list: Sorted distinct names (as given) that have no sample number
+        """
+        mapping = self.mapping()
+        return sorted({name for name in names if pd.notna(name) and pd.isna(mapping.get(normalize_name(name)))})
+
+    def record_unmapped(self, panel, names):
+        """
+        Remember the sample names a run of ``panel`` could not map.
+
+        Args:
+            panel (str): EMX_MEY label of the run
+            names (iterable): Unmapped sample names
+        """
+        names = sorted(set(names))
+        if not names:
+            return
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO unmapped VALUES (?, ?, ?, 1, ?) ON CONFLICT (workbook, panel, name) "
+                    "DO UPDATE SET runs = runs + 1, last_seen = excluded.last_seen",
+                    [(self.workbook_path, panel, str(name), now) for name in names])
+        finally:
+            connection.close()
+
+    def unmapped_report(self):
+        """
+        List the sample names recorded as unmapped for this workbook.
+
+        Returns:
+            pd.DataFrame: name, panel, runs and last_seen, names still missing only
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT name, panel, runs, last_seen FROM unmapped WHERE workbook = ? "
+                                      "ORDER BY name, panel", (self.workbook_path,)).fetchall()
+        finally:
+            connection.close()
+        df = pd.DataFrame(rows, columns=["name", "panel", "runs", "last_seen"])
+        # Names added to the workbook since are no longer reported
+        mapping = self.mapping()
+        still_missing = df["name"].map(lambda name: pd.isna(mapping.get(normalize_name(name))))
+        return df[still_missing.astype(bool)].reset_index(drop=True)
+
+
+def open_registry(workbook_path, db_path=None):
+    """
+    Return the registry of a sample order workbook, importing it when it changed.
+
+    Args:
+        workbook_path (str): Path of the sample order workbook
+        db_path (str): Registry database (default: ``default_registry_path()``)
+
+    Returns:
+        SampleRegistry: Up-to-date registry
+    """
+    registry = SampleRegistry(workbook_path, db_path)
+    registry.refresh()
+    return registry
+
+
+def sample_order_source(workbook_path):
+    """
+    Return what the analysis should read the sample order from.
+
+    Args:
+        workbook_path (str): Path of the sample order workbook
+
+    Returns:
+        SampleRegistry or str: The workbook's registry, or the workbook path itself when
+        the registry is disabled (GENEMAPPER_REGISTRY=0)
+    """
+    return open_registry(workbook_path) if registry_enabled() else workbook_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the gene mapper sample registry.")
+    parser.add_argument("--db", default=None, help="Registry database (default: $GENEMAPPER_REGISTRY)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Import a sample order workbook")
+    import_parser.add_argument("workbook")
+    unmapped_parser = subparsers.add_parser("unmapped", help="List the sample names runs could not map")
+    unmapped_parser.add_argument("workbook")
+    lookup_parser = subparsers.add_parser("lookup", help="Look sample names up")
+    lookup_parser.add_argument("workbook")
+    lookup_parser.add_argument("names", nargs="+")
+    args = parser.parse_args(argv)
+
+    registry = SampleRegistry(args.workbook, args.db)
+    if args.command == "import":
+        registry.import_workbook()
+        print(f"Imported {len(registry.sample_order())} samples into {registry.db_path}")
+        return 0
+    registry.refresh()
+    if args.command == "lookup":
+        for name, number in zip(args.names, registry.lookup(args.names)):
+            print(f"{name}\t{'-' if number is None else number}")
+        return 0
+    report = registry.unmapped_report()
+    print(report.to_string(index=False) if len(report) else "No unmapped sample names")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
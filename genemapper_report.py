@@ -0,0 +1,226 @@
+"""
+Run instrumentation: per-stage timings, row counts and memory, and optional profiling.
+
+A RunReport records, for every stage of a run, its wall time, the number of rows it
+produced and the memory of the process (current and peak RSS). The tracemalloc peak of
+each stage is added when memory tracing is enabled; tracing slows pure-Python stages
+several times, so it is off by default. Reports are written as JSON.
+
+``profiled`` wraps a run in cProfile and dumps the statistics for ``pstats`` or
+snakeviz.
+
+Environment variables:
+    GENEMAPPER_REPORT: path of the JSON run report, or a directory to write it into
+    GENEMAPPER_PROFILE: path or directory of the pstats dumps (or 1 to write them to the
+        output directory), named after the panel, process id and run number of each run
+    GENEMAPPER_TRACEMALLOC: set to 1 to record the tracemalloc peak of every stage
+"""
+
+import contextlib
+import cProfile
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger("genemapper")
+logger.addHandler(logging.NullHandler())
+
+# Number of the profiled runs of this process, to name their dumps
+_profile_runs = itertools.count(1)
+
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes", "on")
+
+
+def rss_mb():
+    """
+    Return the current and peak resident set size of the process.
+
+    The current RSS needs psutil (or /proc on Linux); the peak comes from
+    ``resource.getrusage`` where available.
+
+    Returns:
+        tuple: (current, peak) in megabytes, None for what cannot be measured
+    """
+    current = peak = None
+    try:
+        import psutil
+        current = psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        try:
+            with open("/proc/self/statm") as f:
+                current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+        except (OSError, ValueError, AttributeError):
+            pass
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = max_rss / 1024 / 1024 if sys.platform == "darwin" else max_rss / 1024
+    except ImportError:
+        # Windows
+        pass
+    return current, peak
+
+
+class RunReport:
+    """
+    Per-stage measurements of one analysis run.
+
+    Args:
+        label (str): Name of the run, e.g. the EMX_MEY label
+        trace_memory (bool): Record the tracemalloc peak of every stage (default: the
+            GENEMAPPER_TRACEMALLOC environment variable)
+    """
+
+    def __init__(self, label, trace_memory=None):
+        self.label = label
+        self.trace_memory = _env_flag("GENEMAPPER_TRACEMALLOC") if trace_memory is None else trace_memory
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self.info = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure a stage.
+
+        The context manager yields the stage record; set its ``rows`` entry to the
+        number of rows the stage produced.
+
+        Args:
+            name (str): Stage name
+
+        Yields:
+            dict: Stage record (stage, seconds, rows, rss_mb, peak_rss_mb, traced_peak_mb)
+        """
+        record = {"stage": name, "seconds": None, "rows": None}
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            traced_baseline, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["rss_mb"], record["peak_rss_mb"] = rss_mb()
+            if self.trace_memory:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                record["traced_peak_mb"] = (traced_peak - traced_baseline) / 1024 / 1024
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+            logger.info("%s: %s took %.3fs (%s rows)", self.label, name, record["seconds"],
+                        "-" if record["rows"] is None else record["rows"])
+
+    def to_dict(self):
+        """
+        Return the report as JSON-serializable data.
+
+        Returns:
+            dict: label, started, total_seconds, stages, info and versions
+        """
+        return {
+            "label": self.label,
+            "started": self.started,
+            "total_seconds": sum(stage["seconds"] for stage in self.stages),
+            "stages": self.stages,
+            "info": self.info,
+            "versions": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__},
+        }
+
+    def write(self, path):
+        """
+        Write the report as JSON.
+
+        Args:
+            path (str): File path, or an existing directory to write
+                run_report_{label}.json into
+
+        Returns:
+            str: Path of the written report
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, f"run_report_{self.label}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        logger.info("%s: run report written to %s", self.label, path)
+        return path
+
+
+def stage_context(run_report, name):
+    """Return ``run_report.stage(name)``, or a no-op context yielding a scratch dict."""
+    if run_report is None:
+        return contextlib.nullcontext({})
+    return run_report.stage(name)
+
+
+def report_path_from_env():
+    """Return the run report path or directory set in GENEMAPPER_REPORT, or None."""
+    return os.environ.get("GENEMAPPER_REPORT") or None
+
+
+def profile_path_from_env(default_dir, name):
+    """
+    Return the pstats dump path requested through GENEMAPPER_PROFILE.
+
+    Batch worker processes and daemon threads inherit the variable, so the path is made
+    unique to the run: the name, process id and run number of the process are added to
+    the file name.
+
+    Args:
+        default_dir (str): Directory of the dump when the variable is a flag such as 1
+        name (str): Job or panel name, e.g. "EM4_ME8"
+
+    Returns:
+        str or None: ``profile_{name}_{pid}_{run}.pstats`` in ``default_dir`` or in the
+        directory set, or the path set with ``_{name}_{pid}_{run}`` before its extension;
+        None when profiling is not requested
+    """
+    value = os.environ.get("GENEMAPPER_PROFILE", "")
+    if value.lower() in ("", "0", "false", "no", "off"):
+        return None
+    suffix = f"{name}_{os.getpid()}_{next(_profile_runs)}"
+    if value.lower() in ("1", "true", "yes", "on") or os.path.isdir(value):
+        directory = default_dir if value.lower() in ("1", "true", "yes", "on") else value
+        return os.path.join(directory, f"profile_{suffix}.pstats")
+    root, extension = os.path.splitext(value)
+    return f"{root}_{suffix}{extension or '.pstats'}"
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """
+    Profile the enclosed code with cProfile and dump the statistics to ``path``.
+
+    Read the dump with ``python -m pstats PATH`` or snakeviz.
+
+    Args:
+        path (str or None): Dump path; None disables profiling
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("profile written to %s", path)
@@ -0,0 +1,142 @@
+"""
+Consolidated study workbook: every EMx_MEy panel in one colour-coded workbook.
+
+The workbook opens on a combined sheet stacking the rows of all panels on the same
+sample columns, followed by one formatted sheet per panel laid out like the
+single-panel output. Panels are loaded (output workbooks parsed, matrix stores read) in
+a process pool; the parent takes them in order and streams their rows to both sheets
+of an openpyxl ``write_only`` workbook. Only a bounded window of loaded matrices is pending
+at a time, so memory does not grow with the number of panels.
+
+Usage:
+    python genemapper_cli.py study Study_matrix.xlsx "Output files" [MORE_WORKBOOKS_OR_DIRS ...] [--workers N]
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from openpyxl import Workbook
+
+from genemapper_export import expand_sources, load_matrix
+from genemapper_matrix import ClassificationMatrix
+from genemapper_writer import add_classification_rules, matrix_rows, sample_column_positions
+
+
+logger = logging.getLogger("genemapper")
+
+COMBINED_SHEET = "All_panels"
+
+# Excel limits worksheet titles to 31 characters
+MAX_TITLE_LENGTH = 31
+
+
+def panel_title(matrix, source, used):
+    """
+    Return a unique worksheet title for a panel.
+
+    Args:
+        matrix (ClassificationMatrix): Panel matrix
+        source (ClassificationMatrix or str): Where the matrix was loaded from
+        used (set): Titles already taken (the new title is added to it)
+
+    Returns:
+        str: The EMX_MEY label of the panel, or the file name when its rows carry several
+        labels, suffixed with a number when already taken
+    """
+    labels = set(matrix.emx_mey)
+    if len(labels) == 1:
+        title = str(labels.pop())
+    elif isinstance(source, ClassificationMatrix):
+        title = "Panel"
+    else:
+        title = os.path.splitext(os.path.basename(str(source)))[0]
+    title = title[:MAX_TITLE_LENGTH]
+    candidate, number = title, 1
+    while candidate in used:
+        number += 1
+        suffix = f"_{number}"
+        candidate = title[:MAX_TITLE_LENGTH - len(suffix)] + suffix
+    used.add(candidate)
+    return candidate
+
+
+def _iter_panels(sources, max_workers=None):
+    """
+    Yield (source, matrix) in source order, loading the files in a process pool.
+
+    At most twice the number of workers are loaded ahead of the panel being written.
+    """
+    if max_workers == 1 or all(isinstance(source, ClassificationMatrix) for source in sources):
+        for source in sources:
+            yield source, load_matrix(source)
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    remaining = iter(sources)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque((source, executor.submit(load_matrix, source))
+                        for source in islice(remaining, 2 * max_workers))
+        while pending:
+            source, future = pending.popleft()
+            for next_source in islice(remaining, 1):
+                pending.append((next_source, executor.submit(load_matrix, next_source)))
+            yield source, future.result()
+
+
+def write_study_workbook(sources, output_filename, samples=None, max_workers=None, combined_title=COMBINED_SHEET):
+    """
+    Write the panels of a study to one workbook with a combined sheet.
+
+    Args:
+        sources (list): ClassificationMatrix objects, output workbooks, matrix stores or
+            directories of output workbooks, in sheet order
+        output_filename (str or file-like): Destination of the xlsx file
+        samples (list): Sample columns of the combined sheet (default: those of the first
+            panel, which all panels share when they use the same sample order); samples
+            of other panels missing from them only appear in their panel sheet
+        max_workers (int): Number of worker processes loading the panels (default: one
+            per CPU; 1 loads them in this process)
+        combined_title (str): Title of the combined sheet (default: "All_panels")
+
+    Returns:
+        list: The panel sheet titles, in workbook order
+    """
+    sources = expand_sources(sources)
+    if not sources:
+        raise ValueError("no panel matrix to write")
+
+    wb = Workbook(write_only=True)
+    combined = wb.create_sheet(combined_title)
+    used = {combined_title}
+    titles = []
+    combined_rows = 0
+    combined_width = None
+    for source, matrix in _iter_panels(sources, max_workers):
+        title = panel_title(matrix, source, used)
+        titles.append(title)
+        ws = wb.create_sheet(title)
+        _, width = sample_column_positions(len(matrix.samples))
+        add_classification_rules(ws, matrix.shape[0], width)
+        for row in matrix_rows(matrix):
+            ws.append(row)
+
+        if combined_width is None:
+            samples = list(matrix.samples) if samples is None else list(samples)
+            _, combined_width = sample_column_positions(len(samples))
+            combined.append(next(matrix_rows(matrix, samples)))
+        missing = set(matrix.samples).difference(samples)
+        if missing:
+            logger.warning("%s: %d samples are not columns of the %s sheet: %s", title, len(missing),
+                           combined_title, ", ".join(map(str, sorted(missing, key=str)[:20])))
+        for row in matrix_rows(matrix, samples, header=False):
+            combined.append(row)
+        combined_rows += matrix.shape[0]
+
+    # Conditional formatting is written when the workbook is saved, so the combined
+    # sheet can be coloured once its length is known
+    add_classification_rules(combined, combined_rows, combined_width)
+    wb.save(output_filename)
+    logger.info("Study workbook %s: %d panels, %d size ranges", output_filename, len(titles), combined_rows)
+    return titles
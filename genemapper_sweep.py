@@ -0,0 +1,190 @@
+"""
+Single-pass parameter sweep over the height threshold and the size range tolerance.
+
+Tuning the height threshold used to mean one full run per candidate value. Here the
+peaks are loaded and renamed once; for every tolerance (the size ranges widened by
+``tolerance`` on both sides) their (range, sample) hits are computed once and sorted by
+cell and then by decreasing height. Lowering the threshold then only admits a longer
+prefix of every cell, so a running maximum of the peak positions gives, for any prefix,
+the peak a full run would keep (the last one of the export). The cells of a threshold
+follow from the per-cell counts of peaks above it, and the band calls and occupancy of
+the filled matrix from per-row counts, without building the matrix.
+
+Usage:
+    python genemapper_cli.py sweep INPUT_DIR [-X 4] [-Y 8] [--thresholds 100 160 200] [--tolerances 0 0.25]
+"""
+
+import numpy as np
+import pandas as pd
+
+from Python_genemapper_analysis import (SizeRangeIndex, load_peaks_export, load_sample_order, load_size_ranges,
+                                        rename_samples)
+from genemapper_matrix import CLASS_CODES, CODE_EMPTY, encode_classification
+
+
+DEFAULT_THRESHOLDS = tuple(range(50, 501, 25))
+
+# Columns of the sweep table, after height_threshold and tolerance
+SWEEP_COLUMNS = ["peaks", "band_calls", "c_calls", "b_calls", "a_filled", "d_filled", "empty", "occupancy",
+                 "ranges_called", "samples_called"]
+
+
+def widen_size_ranges(size_ranges, tolerance):
+    """
+    Widen every size range by ``tolerance`` on both sides.
+
+    Args:
+        size_ranges (pd.DataFrame): Size ranges table
+        tolerance (float): Amount subtracted from Lower and added to Upper
+
+    Returns:
+        pd.DataFrame: Copy of the table with the widened bounds
+    """
+    widened = size_ranges.copy()
+    widened['Lower'] = pd.to_numeric(widened['Lower'], errors='coerce') - tolerance
+    widened['Upper'] = pd.to_numeric(widened['Upper'], errors='coerce') + tolerance
+    return widened
+
+
+class ThresholdSweep:
+    """
+    Matrix cells of one set of size ranges for any height threshold.
+
+    Args:
+        df_peaks (pd.DataFrame): Renamed peaks with Sample File Name, Size and Height
+        size_ranges (pd.DataFrame): Size ranges table
+        sample_numbers (list): Sample numbers labelling the matrix columns
+    """
+
+    def __init__(self, df_peaks, size_ranges, sample_numbers):
+        range_index = SizeRangeIndex(size_ranges)
+        self.n_ranges = len(size_ranges)
+        self.n_samples = len(sample_numbers)
+        sizes = df_peaks['Size'].to_numpy()
+        heights = df_peaks['Height'].to_numpy(dtype=float)
+        _, classification = range_index.classify(sizes)
+        codes = encode_classification(classification)
+
+        # Every (peak, range) hit of a known sample, as in peak_hits
+        positions, range_ids = range_index.pairs(sizes)
+        columns = pd.Index(sample_numbers).get_indexer(df_peaks['Sample File Name'])[positions]
+        keep = (columns >= 0) & ~np.isnan(heights[positions])
+        positions, range_ids, columns = positions[keep], range_ids[keep], columns[keep]
+        cell = range_ids.astype(np.int64) * self.n_samples + columns
+        height = heights[positions]
+
+        # Hits sorted by cell, then by decreasing height: a threshold admits a prefix of every cell
+        order = np.argsort(-height, kind="stable")
+        order = order[np.argsort(cell[order], kind="stable")]
+        cell, height, positions = cell[order], height[order], positions[order]
+        new_cell = np.concatenate([[True], cell[1:] != cell[:-1]]) if len(cell) else np.zeros(0, dtype=bool)
+        self.cell_start = np.flatnonzero(new_cell)
+        self.cells = cell[self.cell_start]
+        cell_group = np.cumsum(new_cell) - 1
+        self.cell_group = cell_group
+        self.height = height
+        # Latest peak of every prefix (the peak that wins the cell), by a running maximum
+        # that cannot cross cells since groups are in ascending order
+        key = cell_group.astype(np.int64) * (len(df_peaks) + 1) + positions
+        latest = np.maximum.accumulate(key) - cell_group.astype(np.int64) * (len(df_peaks) + 1)
+        self.prefix_code = codes[latest] if len(latest) else np.zeros(0, dtype=np.int8)
+
+        # Heights of the peaks with at least one hit, sorted once for the peak counts
+        has_hit = np.zeros(len(heights), dtype=bool)
+        has_hit[positions] = True
+        self.peak_heights = np.sort(heights[has_hit])
+
+    def cell_codes(self, height_threshold):
+        """
+        Return the cells set by the peaks above a threshold.
+
+        Args:
+            height_threshold (float): Peaks must be strictly higher than this
+
+        Returns:
+            tuple: (cells, codes) where ``cells`` are flat indices (range * samples + column)
+            of the set cells and ``codes`` their int8 codes before the a/d fill
+        """
+        counts = np.bincount(self.cell_group[self.height > height_threshold], minlength=len(self.cells))
+        occupied = counts > 0
+        return self.cells[occupied], self.prefix_code[self.cell_start[occupied] + counts[occupied] - 1]
+
+    def codes(self, height_threshold):
+        """
+        Return the code matrix a run with this threshold builds, before the a/d fill.
+
+        Args:
+            height_threshold (float): Peaks must be strictly higher than this
+
+        Returns:
+            np.ndarray: int8 codes of shape (ranges, samples)
+        """
+        codes = np.full(self.n_ranges * self.n_samples, CODE_EMPTY, dtype=np.int8)
+        cells, cell_codes = self.cell_codes(height_threshold)
+        codes[cells] = cell_codes
+        return codes.reshape(self.n_ranges, self.n_samples)
+
+    def summary(self, height_threshold):
+        """
+        Count the band calls and the fill of the matrix a run with this threshold builds.
+
+        Args:
+            height_threshold (float): Peaks must be strictly higher than this
+
+        Returns:
+            dict: Values of SWEEP_COLUMNS
+        """
+        cells, cell_codes = self.cell_codes(height_threshold)
+        rows, columns = np.divmod(cells, max(self.n_samples, 1))
+        is_c = cell_codes == CLASS_CODES["c"]
+        is_b = cell_codes == CLASS_CODES["b"]
+        called = is_c | is_b
+        # The a/d fill completes the cells left empty in rows containing a "c" or a "b"
+        row_c = np.bincount(rows[is_c], minlength=self.n_ranges) > 0
+        row_b = np.bincount(rows[is_b], minlength=self.n_ranges) > 0
+        row_empty = self.n_samples - np.bincount(rows[called], minlength=self.n_ranges)
+        n_cells = self.n_ranges * self.n_samples
+        band_calls = int(called.sum())
+        a_filled = int(row_empty[row_c].sum())
+        d_filled = int(row_empty[row_b & ~row_c].sum())
+        return {
+            "peaks": int(len(self.peak_heights) - np.searchsorted(self.peak_heights, height_threshold, side="right")),
+            "band_calls": band_calls,
+            "c_calls": int(is_c.sum()),
+            "b_calls": int(is_b.sum()),
+            "a_filled": a_filled,
+            "d_filled": d_filled,
+            "empty": n_cells - band_calls - a_filled - d_filled,
+            "occupancy": band_calls / n_cells if n_cells else 0.0,
+            "ranges_called": int((row_c | row_b).sum()),
+            "samples_called": int(len(np.unique(columns[called]))),
+        }
+
+
+def sweep_parameters(peaks, sample_order, size_ranges, thresholds=DEFAULT_THRESHOLDS, tolerances=(0,)):
+    """
+    Evaluate many height thresholds and size range tolerances in one pass.
+
+    Args:
+        peaks (str, file-like or pd.DataFrame): Peaks export
+        sample_order (str, file-like, pd.DataFrame or SampleRegistry): Sample order workbook
+        size_ranges (str, file-like or pd.DataFrame): Size ranges
+        thresholds (iterable): Height thresholds (default: 50 to 500 by 25)
+        tolerances (iterable): Widening of the size ranges on both sides (default: none)
+
+    Returns:
+        pd.DataFrame: One row per (tolerance, threshold) with height_threshold, tolerance
+        and SWEEP_COLUMNS
+    """
+    df_sample_order = load_sample_order(sample_order)
+    size_ranges = load_size_ranges(size_ranges)
+    df_peaks = rename_samples(load_peaks_export(peaks), df_sample_order)
+    sample_numbers = df_sample_order['Sample_number'].unique().tolist()
+
+    rows = []
+    for tolerance in tolerances:
+        sweep = ThresholdSweep(df_peaks, widen_size_ranges(size_ranges, tolerance), sample_numbers)
+        for height_threshold in thresholds:
+            rows.append({"height_threshold": height_threshold, "tolerance": tolerance,
+                         **sweep.summary(height_threshold)})
+    return pd.DataFrame(rows, columns=["height_threshold", "tolerance"] + SWEEP_COLUMNS)
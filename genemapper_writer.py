@@ -0,0 +1,178 @@
+"""
+Streaming Excel writer for classification matrices.
+
+Rows are streamed through an openpyxl ``write_only`` workbook, so the sheet is never
+held in memory as cell objects. Cell colours come from four sheet-level conditional
+formatting rules (one per classification letter) instead of a fill on every cell.
+"""
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.formatting.rule import CellIsRule
+from openpyxl.styles import PatternFill
+from openpyxl.utils import get_column_letter
+
+from genemapper_matrix import CODE_LETTERS
+
+
+# Cell colour of each classification letter
+CLASS_COLORS = {
+    "c": "00B0F0",  # Light blue
+    "a": "FF0000",  # Red
+    "b": "00B050",  # Green
+    "d": "BFBFBF",  # Grey
+}
+
+# Number of sample columns between two empty spacer columns
+SPACER_EVERY = 5
+
+
+def sample_column_positions(n_samples):
+    """
+    Worksheet columns (0-based) of the samples, leaving an empty column every 5 samples.
+
+    No spacer is added after the last sample.
+
+    Args:
+        n_samples (int): Number of sample columns
+
+    Returns:
+        tuple: (positions, width) with the column of every sample and the total row width
+    """
+    positions = 2 + np.arange(n_samples) + np.arange(n_samples) // SPACER_EVERY
+    width = 2 + n_samples + max(n_samples - 1, 0) // SPACER_EVERY
+    return positions, width
+
+
+def matrix_rows(matrix, samples=None, header=True):
+    """
+    Yield the worksheet rows of a matrix: the header, then one row per size range.
+
+    Args:
+        matrix (ClassificationMatrix): Filled classification matrix
+        samples (list): Sample columns to lay the matrix out on, matched by sample number;
+            samples the matrix lacks stay empty and matrix samples not listed are left out
+            (default: the matrix samples)
+        header (bool): Yield the header row first (default: True)
+
+    Yields:
+        list: Cell values of one row (None for empty cells)
+    """
+    if samples is None:
+        samples = matrix.samples
+        columns = np.arange(len(samples))
+    else:
+        columns = pd.Index(matrix.samples).get_indexer(samples)
+    positions, width = sample_column_positions(len(samples))
+
+    if header:
+        header_row = ["EMX_MEY", "Size_Range"] + [""] * (width - 2)
+        for position, sample in zip(positions, samples):
+            header_row[position] = sample
+        yield header_row
+
+    present = columns >= 0
+    positions, columns = positions[present], columns[present]
+
+    for i in range(matrix.shape[0]):
+        row = [None] * width
+        row[0] = matrix.emx_mey[i]
+        row[1] = matrix.size_range[i]
+        for position, letter in zip(positions, CODE_LETTERS[matrix.codes[i, columns]]):
+            if pd.notna(letter):
+                row[position] = letter
+        yield row
+
+
+def add_classification_rules(ws, n_rows, width, first_row=2):
+    """
+    Colour the sample block of a worksheet with one conditional formatting rule per letter.
+
+    Args:
+        ws (Worksheet): Worksheet (write-only worksheets are supported)
+        n_rows (int): Number of data rows
+        width (int): Number of worksheet columns
+        first_row (int): First data row, 1-based (default: 2, below the header)
+    """
+    if n_rows == 0 or width <= 2:
+        return
+    cell_range = f"C{first_row}:{get_column_letter(width)}{first_row + n_rows - 1}"
+    for letter, color in CLASS_COLORS.items():
+        fill = PatternFill(start_color=color, end_color=color, fill_type="solid")
+        ws.conditional_formatting.add(cell_range, CellIsRule(operator="equal", formula=[f'"{letter}"'], fill=fill))
+
+
+def preview_page(matrix, rows=slice(None), samples=slice(None)):
+    """
+    Colour-code a page of a matrix for display, e.g. with ``st.dataframe``.
+
+    Uses the CLASS_COLORS of the workbook, without building a workbook. Only the
+    requested rows and sample columns are decoded, so wide plates can be paged through.
+
+    Args:
+        matrix (ClassificationMatrix): Filled classification matrix
+        rows (slice): Size ranges to show (default: all)
+        samples (slice): Sample columns to show (default: all)
+
+    Returns:
+        pandas.io.formats.style.Styler: EMX_MEY and Size_Range columns followed by the
+        sample columns, indexed by row number
+    """
+    row_numbers = np.arange(matrix.shape[0])[rows]
+    page = pd.DataFrame(CODE_LETTERS[matrix.codes[rows, samples]], index=row_numbers + 1,
+                        columns=[str(sample) for sample in matrix.samples[samples]])
+    page.insert(0, "Size_Range", matrix.size_range[rows])
+    page.insert(0, "EMX_MEY", matrix.emx_mey[rows])
+
+    styles = {letter: f"background-color: #{color}" for letter, color in CLASS_COLORS.items()}
+    styler = page.style
+    # Styler.map replaced Styler.applymap in pandas 2.1
+    style_map = getattr(styler, "map", None) or styler.applymap
+    return style_map(lambda letter: styles.get(letter, ""), subset=page.columns[2:])
+
+
+def table_rows(df):
+    """
+    Yield the worksheet rows of a plain table: the header, then its rows.
+
+    Args:
+        df (pd.DataFrame): Table to write
+
+    Yields:
+        list: Cell values of one row (None for missing values)
+    """
+    yield [str(column) for column in df.columns]
+    values = df.astype(object).where(df.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        yield [value.item() if isinstance(value, np.generic) else value for value in row]
+
+
+def write_matrix_workbook(matrix, output_filename, sheet_title="Sample_Matrix", extra_sheets=None):
+    """
+    Write a classification matrix to a colour-coded Excel workbook.
+
+    An empty spacer column is inserted after every 5 sample columns.
+
+    Args:
+        matrix (ClassificationMatrix): Filled classification matrix
+        output_filename (str or file-like): Destination of the xlsx file
+        sheet_title (str): Worksheet title (default: "Sample_Matrix")
+        extra_sheets (dict): Plain tables written after the matrix, as worksheet title ->
+            DataFrame (optional)
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_title)
+
+    _, width = sample_column_positions(len(matrix.samples))
+    add_classification_rules(ws, matrix.shape[0], width)
+
+    for row in matrix_rows(matrix):
+        ws.append(row)
+
+    for title, df in (extra_sheets or {}).items():
+        extra = wb.create_sheet(title)
+        for row in table_rows(df):
+            extra.append(row)
+
+    wb.save(output_filename)
@@ -3,19 +3,19 @@
 Script to run the Gene Mapper Analysis Streamlit application.
 """
 
+import importlib.util
 import subprocess
 import sys
 import os
 
 def install_requirements():
     """Install required packages if not already installed."""
-    try:
-        import streamlit
-        import pandas
-        import numpy
-        import openpyxl
+    # Look the packages up without importing them: the app runs in its own process
+    missing = [name for name in ("streamlit", "pandas", "numpy", "openpyxl")
+               if importlib.util.find_spec(name) is None]
+    if not missing:
         print("✅ All required packages are already installed.")
-    except ImportError as e:
+    else:
         print(f"Installing missing packages...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"])
         print("✅ Packages installed successfully.")
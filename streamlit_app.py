@@ -1,10 +1,16 @@
+import hashlib
+import io
+import time
+
 import streamlit as st
-import tempfile
-import os
-import shutil
-from pathlib import Path
-import pandas as pd
-from Python_genemapper_analysis import gene_mapper_analysis
+from Python_genemapper_analysis import (HEIGHT_THRESHOLD, SizeRangeIndex, auto_bins_enabled,
+                                        build_classification_matrix, classify_peaks, filter_peaks, load_peaks_export,
+                                        load_sample_order, load_size_ranges, propose_size_ranges, render_workbook,
+                                        rename_samples, report_progress)
+from genemapper_jobs import JobManager
+from genemapper_matrix import CODE_LETTERS
+from genemapper_qc import PeakQC
+from genemapper_writer import preview_page
 
 # Set page config
 st.set_page_config(
@@ -14,6 +20,151 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Cached analysis stages. Uploads are keyed by the SHA-256 of their contents (arguments
+# starting with "_" are not hashed), so changing only the size ranges or X/Y reruns just
+# the classification and matrix stages. Each cache keeps a bounded number of entries.
+CACHE_TTL_SECONDS = 3600
+
+# Analyses run in a pool shared by all sessions; the page polls its job at this interval
+MAX_CONCURRENT_JOBS = 2
+POLL_SECONDS = 0.5
+
+# Size of a page of the matrix preview; wider or taller matrices are paginated
+PREVIEW_ROWS = 100
+PREVIEW_SAMPLES = 50
+
+STAGE_LABELS = {
+    "queued": "Waiting for a free worker...",
+    "started": "Starting...",
+    "load": "Reading uploaded files...",
+    "rename": "Mapping sample names...",
+    "filter": "Filtering peaks by height...",
+    "classify": "Classifying peaks into size ranges...",
+    "matrix": "Building the sample matrix...",
+    "fill": "Filling empty cells...",
+    "done": "Analysis completed successfully!",
+}
+
+
+def upload_digest(upload):
+    """Return the SHA-256 of an uploaded file, memoized per upload in the session."""
+    if upload is None:
+        return None
+    memo_key = ("upload_digest", upload.name, upload.size, getattr(upload, "file_id", None))
+    if memo_key not in st.session_state:
+        st.session_state[memo_key] = hashlib.sha256(upload.getvalue()).hexdigest()
+    return st.session_state[memo_key]
+
+
+def named_buffer(upload):
+    """Wrap the bytes of an upload in a named buffer, so readers can detect its format."""
+    buffer = io.BytesIO(upload.getvalue())
+    buffer.name = upload.name
+    return buffer
+
+
+@st.cache_data(max_entries=4, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_peaks(digest, _upload):
+    return load_peaks_export(named_buffer(_upload))
+
+
+@st.cache_data(max_entries=4, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_sample_order(digest, _upload):
+    return load_sample_order(named_buffer(_upload))
+
+
+@st.cache_data(max_entries=16, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_size_ranges(digest, _upload):
+    return load_size_ranges(named_buffer(_upload) if _upload is not None else None)
+
+
+@st.cache_data(max_entries=4, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_proposed_ranges(peaks_digest, height_threshold, _peaks_upload):
+    return propose_size_ranges(cached_peaks(peaks_digest, _peaks_upload), height_threshold=height_threshold)
+
+
+def analysis_size_ranges(peaks_digest, ranges_digest, height_threshold, _peaks_upload, _ranges_upload):
+    """Return the uploaded size ranges, or ranges proposed from the peaks when none were uploaded."""
+    if _ranges_upload is None and auto_bins_enabled():
+        return cached_proposed_ranges(peaks_digest, height_threshold, _peaks_upload)
+    return cached_size_ranges(ranges_digest, _ranges_upload)
+
+
+def size_ranges_workbook(size_ranges):
+    """Return a size ranges table as xlsx bytes."""
+    buffer = io.BytesIO()
+    size_ranges.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+@st.cache_data(max_entries=4, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_height_filtered(peaks_digest, sample_digest, height_threshold, _peaks_upload, _sample_upload,
+                           _progress_callback=None):
+    df_sample_order = cached_sample_order(sample_digest, _sample_upload)
+    df_exported_table = cached_peaks(peaks_digest, _peaks_upload)
+    report_progress(_progress_callback, "rename")
+    df_exported_table = rename_samples(df_exported_table, df_sample_order)
+    report_progress(_progress_callback, "filter")
+    # The peaks per sample are kept for the QC sheets, the renamed table is not
+    peak_counts = df_exported_table['Sample File Name'].value_counts(sort=False)
+    return filter_peaks(df_exported_table, height_threshold), peak_counts
+
+
+@st.cache_data(max_entries=16, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_matrix(peaks_digest, sample_digest, ranges_digest, height_threshold, emx_mey_label, _peaks_upload,
+                  _sample_upload, _ranges_upload, _progress_callback=None):
+    size_ranges = analysis_size_ranges(peaks_digest, ranges_digest, height_threshold, _peaks_upload, _ranges_upload)
+    range_index = SizeRangeIndex(size_ranges)
+    height_filtered, peak_counts = cached_height_filtered(peaks_digest, sample_digest, height_threshold,
+                                                          _peaks_upload, _sample_upload, _progress_callback)
+    sample_numbers = cached_sample_order(sample_digest, _sample_upload)['Sample_number'].unique().tolist()
+    peak_qc = PeakQC(size_ranges, sample_numbers, range_index)
+    peak_qc.add_sample_counts({"peaks": peak_counts})
+    peak_qc.count_peaks("above_threshold", height_filtered)
+    report_progress(_progress_callback, "classify")
+    df_filtered = classify_peaks(height_filtered, range_index)
+    peak_qc.count_peaks("in_range", df_filtered)
+    report_progress(_progress_callback, "matrix")
+    matrix = build_classification_matrix(df_filtered, size_ranges, sample_numbers, emx_mey_label,
+                                         range_index=range_index, qc=peak_qc)
+    report_progress(_progress_callback, "fill")
+    return matrix.fill_empty(), peak_qc
+
+
+@st.cache_data(max_entries=8, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_workbook(peaks_digest, sample_digest, ranges_digest, height_threshold, emx_mey_label, _matrix, _qc):
+    return render_workbook(_matrix, extra_sheets=_qc.tables(_matrix))
+
+
+@st.cache_resource
+def job_manager():
+    """Worker pool shared by every session of the app."""
+    return JobManager(max_workers=MAX_CONCURRENT_JOBS)
+
+
+def analysis_job(keys, emx_mey_label, peaks_file, sample_file, size_ranges_file, progress_callback=None):
+    """
+    Run the cached analysis stages in a worker thread.
+
+    The workbook is not rendered here: the preview is drawn from the matrix, and the
+    xlsx is only built when the user asks for the download. The proposed size ranges
+    come from the uploads of the job, not from those in the widgets when it finishes.
+
+    Returns:
+        tuple: (matrix, qc, proposed_ranges) with the filled matrix, its PeakQC counts and
+        the size ranges proposed from the peaks (None when a size ranges file was uploaded)
+    """
+    report_progress(progress_callback, "load")
+    matrix, peak_qc = cached_matrix(*keys, emx_mey_label, peaks_file, sample_file, size_ranges_file,
+                                    progress_callback)
+    proposed_ranges = None
+    if size_ranges_file is None and auto_bins_enabled():
+        # A cache hit: cached_matrix proposed them for this upload
+        proposed_ranges = cached_proposed_ranges(keys[0], keys[3], peaks_file)
+    report_progress(progress_callback, "done")
+    return matrix, peak_qc, proposed_ranges
+
+
 # Title and description
 st.title("🧬 Gene Mapper Analysis Tool")
 st.markdown("""
@@ -25,6 +176,8 @@ Upload your input files and configure the analysis parameters to get started.
 st.sidebar.header("Analysis Parameters")
 X = st.sidebar.number_input("X value for EMX_MEY format", min_value=1, max_value=20, value=4)
 Y = st.sidebar.number_input("Y value for EMX_MEY format", min_value=1, max_value=20, value=8)
+height_threshold = st.sidebar.number_input("Height threshold (peaks must be higher)", min_value=0,
+                                           value=HEIGHT_THRESHOLD, step=10)
 
 # Display expected file names based on X and Y values
 emx_mey_label = f"EM{X}_ME{Y}"
@@ -33,6 +186,10 @@ st.sidebar.markdown(f"- `{emx_mey_label}_peaks_exported.xlsx`")
 st.sidebar.markdown(f"- `Hyssop_sample_numbers_Genemapper.xlsx`")
 st.sidebar.markdown(f"- `Size_ranges_{emx_mey_label}.xlsx` (optional)")
 
+# Parsed uploads and intermediate results are cached between runs
+if st.sidebar.button("Clear cached results"):
+    st.cache_data.clear()
+
 # Main content area
 col1, col2 = st.columns(2)
 
@@ -42,8 +199,8 @@ with col1:
     # File upload for peaks exported file
     peaks_file = st.file_uploader(
         f"Upload {emx_mey_label}_peaks_exported.xlsx",
-        type=['xlsx', 'xls'],
-        help="The main peaks data exported from GeneMapper"
+        type=['xlsx', 'xls', 'txt', 'tsv', 'csv'],
+        help="The main peaks data exported from GeneMapper (xlsx or tab-delimited text)"
     )
     
     # File upload for sample order file
@@ -57,7 +214,8 @@ with col1:
     size_ranges_file = st.file_uploader(
         f"Upload Size_ranges_{emx_mey_label}.xlsx (Optional)",
         type=['xlsx', 'xls'],
-        help="Size ranges configuration. If not provided, an empty template will be created."
+        help="Size ranges configuration. If not provided, size ranges are proposed from the peaks, with blank "
+             "A/B columns to fill in."
     )
 
 with col2:
@@ -73,8 +231,10 @@ with col2:
         st.markdown(f"- Sample file: {sample_file.name} ({sample_file.size} bytes)")
         if size_ranges_file:
             st.markdown(f"- Size ranges file: {size_ranges_file.name} ({size_ranges_file.size} bytes)")
+        elif auto_bins_enabled():
+            st.markdown("- Size ranges file: Not provided, ranges will be proposed from the peaks")
         else:
-            st.markdown("- Size ranges file: Will be created automatically")
+            st.markdown("- Size ranges file: Not provided")
     else:
         st.warning("⚠️ Please upload the required files to proceed.")
         missing_files = []
@@ -94,104 +254,128 @@ st.header("🔬 Run Analysis")
 
 if st.button("Run Gene Mapper Analysis", type="primary", disabled=not (peaks_file and sample_file)):
     if peaks_file and sample_file:
-        try:
-            # Create progress bar
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            # Create temporary directories
-            with tempfile.TemporaryDirectory() as temp_dir:
-                temp_path = Path(temp_dir)
-                input_dir = temp_path / "input"
-                config_dir = temp_path / "config"
-                output_dir = temp_path / "output"
-                
-                # Create directories
-                input_dir.mkdir()
-                config_dir.mkdir()
-                output_dir.mkdir()
-                
-                status_text.text("Setting up temporary directories...")
-                progress_bar.progress(20)
-                
-                # Save uploaded files
-                peaks_file_path = input_dir / f"{emx_mey_label}_peaks_exported.xlsx"
-                sample_file_path = input_dir / "Hyssop_sample_numbers_Genemapper.xlsx"
-                
-                with open(peaks_file_path, "wb") as f:
-                    f.write(peaks_file.getbuffer())
-                
-                with open(sample_file_path, "wb") as f:
-                    f.write(sample_file.getbuffer())
-                
-                # Handle size ranges file
-                if size_ranges_file:
-                    size_ranges_path = input_dir / f"Size_ranges_{emx_mey_label}.xlsx"
-                    with open(size_ranges_path, "wb") as f:
-                        f.write(size_ranges_file.getbuffer())
-                
-                status_text.text("Files uploaded successfully...")
-                progress_bar.progress(40)
-                
-                # Run the analysis
-                status_text.text("Running gene mapper analysis...")
-                progress_bar.progress(60)
-                
-                result_file = gene_mapper_analysis(
-                    input_file_path=str(input_dir),
-                    config_file_path=str(config_dir),
-                    output_file_path=str(output_dir),
-                    X=X,
-                    Y=Y
-                )
-                
-                progress_bar.progress(80)
-                status_text.text("Analysis completed successfully!")
-                
-                # Store result file in session state for download
-                if os.path.exists(result_file):
-                    with open(result_file, "rb") as f:
-                        st.session_state.result_file_data = f.read()
-                    st.session_state.result_file_name = f"Sample_Size_Matrix_Colored_{emx_mey_label}.xlsx"
-                    
-                    progress_bar.progress(100)
-                    status_text.text("Ready for download!")
-                    
-                    st.success("🎉 Analysis completed successfully!")
-                    
-                    # Display some basic information about the result
-                    st.markdown("**Analysis Results:**")
-                    st.markdown(f"- Output file: `{st.session_state.result_file_name}`")
-                    st.markdown(f"- File size: {len(st.session_state.result_file_data)} bytes")
-                    
-                else:
-                    st.error("❌ Analysis completed but output file not found.")
-                    
-        except Exception as e:
-            st.error(f"❌ Error during analysis: {str(e)}")
-            st.markdown("**Error Details:**")
-            st.code(str(e))
-
-# Download section
-if hasattr(st.session_state, 'result_file_data') and st.session_state.result_file_data:
+        # Submit the analysis as a background job; the upload hashes are computed here
+        # because the session state is not available in the worker thread
+        keys = (upload_digest(peaks_file), upload_digest(sample_file), upload_digest(size_ranges_file),
+                height_threshold)
+        previous_job = job_manager().get(st.session_state.get("job_id"))
+        if previous_job is not None and not previous_job.done():
+            previous_job.cancel()
+        job = job_manager().submit(analysis_job, keys, emx_mey_label, peaks_file, sample_file, size_ranges_file)
+        st.session_state.job_id = job.job_id
+        st.session_state.job_inputs = (keys, emx_mey_label)
+        st.session_state.result_matrix = None
+        st.session_state.result_file_data = None
+
+# Poll the job of this session
+job = job_manager().get(st.session_state.get("job_id"))
+if job is not None:
+    progress_bar = st.progress(job.fraction)
+    status_text = st.empty()
+
+    if not job.done():
+        status_text.text(f"{STAGE_LABELS.get(job.stage, job.stage)} ({job.elapsed:.1f}s elapsed)")
+        if st.button("Cancel analysis"):
+            job.cancel()
+        time.sleep(POLL_SECONDS)
+        st.rerun()
+
+    elif job.status == "done":
+        # Store the matrix and its QC counts in session state for the preview and the
+        # download, and the ranges proposed by the job for curation
+        if st.session_state.get("result_job_id") != job.job_id:
+            (st.session_state.result_matrix, st.session_state.result_qc,
+             st.session_state.result_size_ranges) = job.result()
+            st.session_state.result_inputs = st.session_state.job_inputs
+            st.session_state.result_file_name = f"Sample_Size_Matrix_Colored_{st.session_state.job_inputs[1]}.xlsx"
+            st.session_state.result_job_id = job.job_id
+        progress_bar.progress(1.0)
+        status_text.text(f"Analysis completed in {job.elapsed:.1f}s")
+
+        st.success("🎉 Analysis completed successfully!")
+
+        # Display some basic information about the result
+        matrix = st.session_state.result_matrix
+        st.markdown("**Analysis Results:**")
+        st.markdown(f"- Matrix: {matrix.shape[0]} size ranges x {matrix.shape[1]} samples")
+        counts = [(letter, int((matrix.codes == code).sum())) for code, letter in enumerate(CODE_LETTERS) if code]
+        st.markdown("- Cells: " + ", ".join(f'"{letter}" {count:,}' for letter, count in counts))
+
+    elif job.status == "cancelled":
+        status_text.text(f"Cancelled after {job.elapsed:.1f}s")
+        st.warning("Analysis cancelled.")
+
+    else:
+        e = job.error()
+        st.error(f"❌ Error during analysis: {str(e)}")
+        st.markdown("**Error Details:**")
+        st.code(str(e))
+
+# Matrix preview, coloured like the Excel output
+matrix = st.session_state.get("result_matrix")
+if matrix is not None:
+    st.markdown("---")
+    st.header("🔎 Matrix Preview")
+
+    n_rows, n_samples = matrix.shape
+    row_pages = max(1, -(-n_rows // PREVIEW_ROWS))
+    sample_pages = max(1, -(-n_samples // PREVIEW_SAMPLES))
+    col1, col2 = st.columns(2)
+    with col1:
+        row_page = st.number_input(f"Size range page (of {row_pages})", min_value=1, max_value=row_pages, value=1)
+    with col2:
+        sample_page = st.number_input(f"Sample page (of {sample_pages})", min_value=1, max_value=sample_pages,
+                                      value=1)
+    rows = slice((row_page - 1) * PREVIEW_ROWS, row_page * PREVIEW_ROWS)
+    samples = slice((sample_page - 1) * PREVIEW_SAMPLES, sample_page * PREVIEW_SAMPLES)
+    st.caption(f"Size ranges {rows.start + 1}-{min(rows.stop, n_rows)} of {n_rows}, "
+               f"samples {samples.start + 1}-{min(samples.stop, n_samples)} of {n_samples}")
+    st.dataframe(preview_page(matrix, rows, samples))
+
+# Download section: the workbook is only rendered when asked for
+if matrix is not None:
     st.markdown("---")
     st.header("📥 Download Results")
     
     col1, col2, col3 = st.columns([1, 2, 1])
     
     with col2:
-        st.download_button(
-            label="📥 Download Analysis Results",
-            data=st.session_state.result_file_data,
-            file_name=st.session_state.result_file_name,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            type="primary"
-        )
-        
-        st.markdown("**File Details:**")
-        st.markdown(f"- Filename: `{st.session_state.result_file_name}`")
-        st.markdown(f"- Format: Excel (.xlsx)")
-        st.markdown(f"- Size: {len(st.session_state.result_file_data):,} bytes")
+        if not st.session_state.get("result_file_data"):
+            if st.button("📄 Prepare Excel Download"):
+                with st.spinner("Writing the Excel workbook..."):
+                    keys, emx_mey_label = st.session_state.result_inputs
+                    st.session_state.result_file_data = cached_workbook(*keys, emx_mey_label, matrix,
+                                                                        st.session_state.result_qc)
+
+        if st.session_state.get("result_file_data"):
+            st.download_button(
+                label="📥 Download Analysis Results",
+                data=st.session_state.result_file_data,
+                file_name=st.session_state.result_file_name,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                type="primary"
+            )
+            
+            st.markdown("**File Details:**")
+            st.markdown(f"- Filename: `{st.session_state.result_file_name}`")
+            st.markdown(f"- Format: Excel (.xlsx)")
+            st.markdown(f"- Size: {len(st.session_state.result_file_data):,} bytes")
+
+# Proposed size ranges, when none were uploaded
+proposed_ranges = st.session_state.get("result_size_ranges") if matrix is not None else None
+if proposed_ranges is not None:
+    st.markdown("---")
+    st.header("📏 Proposed Size Ranges")
+    st.markdown(f"No size ranges file was uploaded, so {len(proposed_ranges)} ranges were proposed from the "
+                "sizes of the peaks above the height threshold. Their **A** and **B** columns are blank, so they "
+                "classify nothing yet: fill them in and upload the file to run the analysis with them.")
+    st.dataframe(proposed_ranges)
+    st.download_button(
+        label="📥 Download Proposed Size Ranges",
+        data=size_ranges_workbook(proposed_ranges),
+        file_name=f"Size_ranges_{st.session_state.result_inputs[1]}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
 
 # Footer with information
 st.markdown("---")
@@ -203,7 +387,8 @@ with st.expander("How to use this tool"):
     2. **Upload Files**: Upload the required Excel files:
        - Peaks exported file from GeneMapper
        - Sample numbers file
-       - Size ranges file (optional - will be created if not provided)
+       - Size ranges file (optional - if not provided, ranges are proposed from the peaks and can be
+         downloaded, with blank A/B columns to fill in before running the analysis again)
     3. **Run Analysis**: Click the "Run Gene Mapper Analysis" button
     4. **Download Results**: Once complete, download the formatted Excel output
     
@@ -212,6 +397,7 @@ with st.expander("How to use this tool"):
     - Proper sample naming
     - Size range analysis
     - Conditional formatting for easy visualization
+    - QC sheets per size range and per sample
     """)
 
 with st.expander("File Requirements"):
@@ -221,7 +407,7 @@ with st.expander("File Requirements"):
     - `Hyssop_sample_numbers_Genemapper.xlsx`: Sample order and naming
     
     **Optional Files:**
-    - `Size_ranges_EM{X}_ME{Y}.xlsx`: Size ranges configuration
+    - `Size_ranges_EM{X}_ME{Y}.xlsx`: Size ranges configuration (proposed from the peaks when missing)
     
     **Output:**
     - `Sample_Size_Matrix_Colored_EM{X}_ME{Y}.xlsx`: Formatted results with conditional formatting
@@ -238,7 +424,7 @@ with st.expander("Technical Details"):
     **Processing Steps:**
     1. File validation and upload
     2. Data cleaning and sample name mapping
-    3. Height filtering (>160)
+    3. Height filtering (above the height threshold, 160 by default)
     4. Size range classification
     5. Matrix generation with conditional formatting
     6. Excel output with color coding